@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import filecmp
+import functools
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import encrypt_indexpage as indexer
+
+# Timing differences below this are never reported as regressions
+NOISE_SECONDS = 0.005
+# Peak RSS a full generator run should stay under, whatever the shape and scale
+MAX_RSS_BYTES = 100 << 20
+
+# Synthetic tree shapes: name -> (description, builder)
+SHAPES = {}
+
+def shape(name, description):
+    """Register a tree builder under a shape name"""
+    def register(builder):
+        SHAPES[name] = (description, builder)
+        return builder
+    return register
+
+def write_file(path, rng, max_size):
+    """Create a file of random size filled with cheap, reproducible bytes"""
+    with open(path, 'wb') as f:
+        f.write(b'x' * rng.randint(0, max_size))
+
+@shape('wide', 'one flat directory with many files')
+def build_wide(root, scale, rng):
+    for i in range(int(20000 * scale)):
+        write_file(os.path.join(root, f'file-{i:07d}.dat'), rng, 64)
+
+@shape('spill', 'one directory too wide to sort in memory, rendered as a stream')
+def build_spill(root, scale, rng):
+    for i in range(int(3 * indexer.LISTING_BUFFER_ROWS * scale)):
+        write_file(os.path.join(root, f'spilled-{i:07d}.dat'), rng, 64)
+
+@shape('deep', 'a long chain of nested directories with a few files each')
+def build_deep(root, scale, rng):
+    parentdir = root
+    for level in range(int(200 * scale)):
+        parentdir = os.path.join(parentdir, f'level-{level:04d}')
+        os.mkdir(parentdir)
+        for i in range(5):
+            write_file(os.path.join(parentdir, f'file-{i}.txt'), rng, 256)
+
+@shape('tiny', 'many directories full of tiny files')
+def build_tiny(root, scale, rng):
+    for d in range(int(200 * scale)):
+        parentdir = os.path.join(root, f'dir-{d // 20:03d}', f'sub-{d:05d}')
+        os.makedirs(parentdir)
+        for i in range(100):
+            write_file(os.path.join(parentdir, f'tiny-{i:03d}.txt'), rng, 16)
+
+@shape('unicode', 'directories and files with non-ASCII names')
+def build_unicode(root, scale, rng):
+    alphabet = 'aéßøΩжд漢字ファイル🙂 -_'
+    for d in range(int(50 * scale)):
+        parentdir = os.path.join(root, f'{"".join(rng.choice(alphabet) for _ in range(8))}-{d}')
+        os.mkdir(parentdir)
+        for i in range(50):
+            name = ''.join(rng.choice(alphabet) for _ in range(12)).strip() or 'x'
+            write_file(os.path.join(parentdir, f'{name}-{i}.txt'), rng, 4096)
+
+def build_tree(root, name, scale, seed):
+    """Build a reproducible synthetic tree of the given shape under root"""
+    os.makedirs(root)
+    SHAPES[name][1](root, scale, random.Random(seed))
+
+def benchmark_options(top_dir, manifest, extra_args=()):
+    """Generator options as the command line would produce them"""
+    return indexer.build_parser().parse_args(
+        [top_dir, '--password', 'benchmark', '--manifest', manifest, *extra_args])
+
+def remove_generated(top_dir):
+    """Delete every page a previous run wrote into the tree; generated trees hold no page-named files of their own"""
+    for parentdir, _, files in os.walk(top_dir):
+        for name in files:
+            if indexer.is_generated_file(name) or indexer.is_page_name(name):
+                os.remove(os.path.join(parentdir, name))
+
+def time_phases(top_dir, out_dir, opts, cipher):
+    """Run traversal, render, encrypt and write one after another and time each phase"""
+    timings = {}
+    started = time.perf_counter()
+    listings = []
+    for parentdir, dirs, files in indexer.walk_tree(top_dir):
+        rows = indexer.scan_files(parentdir, files, opts.filter)
+        listings.append((parentdir, dirs, rows))
+        if isinstance(files, indexer.SpillSorter) and files is not rows:
+            files.close()
+    timings['traversal'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    rel_paths = [os.path.relpath(parentdir, top_dir) for parentdir, _, _ in listings]
+    contents = [indexer.generate_directory_listing(parentdir, dirs, rows, head=indexer.listing_head(rel_path))
+                for (parentdir, dirs, rows), rel_path in zip(listings, rel_paths)]
+    timings['render'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    pages = [indexer.render_login_page(content, cipher, opts, rel_path) for content, rel_path in zip(contents, rel_paths)]
+    timings['encrypt'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    output_bytes = 0
+    output = indexer.DirectoryOutput(out_dir, in_place=False)
+    for rel_path, page in zip(rel_paths, pages):
+        output.write(rel_path, indexer.index_file_name, [page])
+        output_bytes += len(page.encode('utf-8'))
+    timings['write'] = time.perf_counter() - started
+
+    counts = {'dirs': len(listings), 'files': sum(len(rows) for _, _, rows in listings),
+              'output_bytes': output_bytes}
+    for _, _, rows in listings:
+        if isinstance(rows, indexer.SpillSorter):
+            rows.close()
+    return timings, counts
+
+def run_end_to_end(top_dir, opts):
+    """Time one full process_dir run, the way the command line runs it"""
+    remove_generated(top_dir)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(opts.manifest)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        indexer.process_dir(top_dir, opts.password, opts)
+    return time.perf_counter() - started
+
+def measure_rss(top_dir, opts, extra_args):
+    """Peak RSS of a full command line run in a fresh process, as its --stats-json reports it"""
+    remove_generated(top_dir)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(opts.manifest)
+    stats_file = opts.manifest + '.stats.json'
+    subprocess.run([sys.executable, indexer.__file__, top_dir, '--password', opts.password,
+                    '--manifest', opts.manifest, '--stats-json', stats_file, *extra_args],
+                   stdout=subprocess.DEVNULL, check=True)
+    with open(stats_file) as f:
+        return json.load(f)['peak_rss_bytes']
+
+def run_shape(name, scale, seed, repeat, extra_args):
+    """Benchmark one tree shape; runs in its own process so peak RSS is per shape"""
+    workdir = tempfile.mkdtemp(prefix=f'bench-{name}-')
+    try:
+        top_dir = os.path.join(workdir, 'tree')
+        build_tree(top_dir, name, scale, seed)
+        opts = benchmark_options(top_dir, os.path.join(workdir, 'manifest.sqlite'), extra_args)
+
+        started = time.perf_counter()
+        cipher = indexer.PageCipher(opts.password, b'\0' * 16, opts.kdf_iterations)
+        kdf = time.perf_counter() - started
+
+        # Best of N keeps the comparison stable on a noisy machine
+        phases = {}
+        for _ in range(repeat):
+            out_dir = os.path.join(workdir, 'out')
+            shutil.rmtree(out_dir, ignore_errors=True)
+            timings, counts = time_phases(top_dir, out_dir, opts, cipher)
+            for phase, seconds in timings.items():
+                phases[phase] = min(phases.get(phase, seconds), seconds)
+            total = run_end_to_end(top_dir, opts)
+            phases['total'] = min(phases.get('total', total), total)
+        phases['kdf'] = kdf
+
+        # Memory is measured on a separate run since tracemalloc slows everything down
+        tracemalloc.start()
+        run_end_to_end(top_dir, opts)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            'description': SHAPES[name][0],
+            'phases': phases,
+            'counts': counts,
+            'peak_traced_bytes': peak,
+            'max_rss_bytes': measure_rss(top_dir, opts, extra_args),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+class SlowDirEntry:
+    """os.DirEntry whose stat() pays the round trip a network mount would"""
+
+    def __init__(self, entry, seconds):
+        self.entry = entry
+        self.seconds = seconds
+        self.name = entry.name
+        self.path = entry.path
+
+    def __getattr__(self, name):
+        return getattr(self.entry, name)
+
+    def stat(self, **kwargs):
+        time.sleep(self.seconds)
+        return self.entry.stat(**kwargs)
+
+@contextlib.contextmanager
+def injected_latency(seconds):
+    """Delay every directory read, stat and page write by `seconds`, like NFS or sshfs would"""
+    real_scandir, real_stat, real_write_page = os.scandir, os.stat, indexer.write_page
+
+    @contextlib.contextmanager
+    def scandir(path):
+        time.sleep(seconds)
+        with real_scandir(path) as it:
+            yield (SlowDirEntry(entry, seconds) for entry in it)
+
+    def delayed(function):
+        @functools.wraps(function)
+        def call(*args, **kwargs):
+            time.sleep(seconds)
+            return function(*args, **kwargs)
+        return call
+
+    os.scandir, os.stat, indexer.write_page = scandir, delayed(real_stat), delayed(real_write_page)
+    try:
+        yield
+    finally:
+        os.scandir, os.stat, indexer.write_page = real_scandir, real_stat, real_write_page
+
+def same_tree(left, right):
+    """Whether two folders hold the same files with the same bytes"""
+    compared = filecmp.dircmp(left, right, ignore=[])
+    if compared.left_only or compared.right_only or compared.funny_files:
+        return False
+    _, mismatch, errors = filecmp.cmpfiles(left, right, compared.common_files, shallow=False)
+    return not mismatch and not errors and all(
+        same_tree(os.path.join(left, name), os.path.join(right, name)) for name in compared.common_dirs)
+
+def run_latency(name, scale, seed, latency, jobs, extra_args):
+    """Time a full run of one shape under injected latency, serially and with jobs threads, and check
+    both write the same pages"""
+    workdir = tempfile.mkdtemp(prefix=f'bench-{name}-')
+    try:
+        top_dir = os.path.join(workdir, 'tree')
+        build_tree(top_dir, name, scale, seed)
+        # Both runs start from a manifest with the same key salt, so they encrypt to the same bytes
+        seed_manifest = os.path.join(workdir, 'seed.sqlite')
+        db = indexer.open_manifest(seed_manifest)
+        indexer.manifest_salt(db)
+        db.commit()
+        db.close()
+        timings = {}
+        for mode, args in (('serial', ['--jobs', '1', '--list-jobs', '1']),
+                           ('concurrent', ['--jobs', str(jobs), '--list-jobs', str(jobs)])):
+            # A folder of its own, so the checksum cache is not shared either
+            manifest = os.path.join(workdir, f'{mode}-manifest', 'manifest.sqlite')
+            os.mkdir(os.path.dirname(manifest))
+            shutil.copy(seed_manifest, manifest)
+            opts = benchmark_options(top_dir, manifest, ['--output', os.path.join(workdir, mode), *args, *extra_args])
+            with injected_latency(latency), contextlib.redirect_stdout(io.StringIO()):
+                started = time.perf_counter()
+                indexer.process_dir(top_dir, opts.password, opts)
+                timings[mode] = time.perf_counter() - started
+        return {
+            'description': SHAPES[name][0],
+            'latency_ms': latency * 1000,
+            'jobs': jobs,
+            'phases': timings,
+            'identical': same_tree(os.path.join(workdir, 'serial'), os.path.join(workdir, 'concurrent')),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def git_revision():
+    """Commit being benchmarked, if this is a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results):
+    """Summary table of one benchmark run"""
+    print(f"{'shape':<10}{'dirs':>8}{'files':>9}{'traversal':>11}{'render':>9}{'encrypt':>9}"
+          f"{'write':>9}{'total':>9}{'output':>10}{'peak mem':>10}{'peak RSS':>10}")
+    for name, result in results['shapes'].items():
+        phases, counts = result['phases'], result['counts']
+        print(f"{name:<10}{counts['dirs']:>8}{counts['files']:>9}{phases['traversal']:>10.3f}s"
+              f"{phases['render']:>8.3f}s{phases['encrypt']:>8.3f}s{phases['write']:>8.3f}s"
+              f"{phases['total']:>8.3f}s{indexer.pretty_size(counts['output_bytes']):>10}"
+              f"{indexer.pretty_size(result['peak_traced_bytes']):>10}"
+              f"{indexer.pretty_size(result['max_rss_bytes'] or 0):>10}")
+
+def print_latency(results):
+    """Summary table of a --latency run"""
+    print(f"{'shape':<10}{'latency':>9}{'serial':>10}{'jobs':>6}{'concurrent':>12}{'speedup':>9}  pages")
+    for name, result in results['shapes'].items():
+        phases = result['phases']
+        print(f"{name:<10}{result['latency_ms']:>7.1f}ms{phases['serial']:>9.3f}s{result['jobs']:>6}"
+              f"{phases['concurrent']:>11.3f}s{phases['serial'] / phases['concurrent']:>8.1f}x  "
+              f"{'identical' if result['identical'] else 'DIFFERENT'}")
+
+def check_rss(results, limit):
+    """Print the shapes whose full run went over the RSS target, returning how many did"""
+    over = [(name, result['max_rss_bytes']) for name, result in results['shapes'].items()
+            if result['max_rss_bytes'] and result['max_rss_bytes'] > limit]
+    for name, rss in over:
+        print(f'{name}: peak RSS {indexer.pretty_size(rss)} is over the {indexer.pretty_size(limit)} target')
+    return len(over)
+
+def compare_results(baseline, results, threshold):
+    """Print per-phase changes against a baseline file, returning the number of regressions"""
+    regressions = 0
+    print(f"\nCompared with {baseline.get('revision') or 'baseline'} (threshold {threshold:.0f}%):")
+    for name, result in results['shapes'].items():
+        old = baseline['shapes'].get(name)
+        if not old:
+            continue
+        metrics = dict(result['phases'], peak_traced_bytes=result['peak_traced_bytes'])
+        old_metrics = dict(old['phases'], peak_traced_bytes=old['peak_traced_bytes'])
+        for metric, value in metrics.items():
+            if metric not in old_metrics or not old_metrics[metric]:
+                continue
+            change = 100 * (value - old_metrics[metric]) / old_metrics[metric]
+            flag = ''
+            # Sub-millisecond phases are pure noise, only flag changes that cost real time
+            noise = metric != 'peak_traced_bytes' and abs(value - old_metrics[metric]) < NOISE_SECONDS
+            if change > threshold and not noise:
+                flag = '  <-- REGRESSION'
+                regressions += 1
+            print(f'  {name:<10}{metric:<20}{old_metrics[metric]:>14.3f}{value:>14.3f}{change:>+9.1f}%{flag}')
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='''DESCRIPTION:
+    Benchmark encrypt_indexpage.py on reproducible synthetic directory trees.
+    Times traversal, render, encrypt and write separately, plus a full run,
+    and records peak memory and output size as JSON for comparison between commits.''')
+
+    parser.add_argument('--shapes', '-s',
+                      default=','.join(SHAPES),
+                      help=f'comma-separated tree shapes to run (default: {",".join(SHAPES)})',
+                      required=False)
+
+    parser.add_argument('--scale',
+                      type=float,
+                      default=1.0,
+                      help='multiply the size of every tree (default: 1.0)',
+                      required=False)
+
+    parser.add_argument('--seed',
+                      type=int,
+                      default=42,
+                      help='random seed for tree generation (default: 42)',
+                      required=False)
+
+    parser.add_argument('--repeat', '-r',
+                      type=int,
+                      default=3,
+                      help='keep the best of N timings (default: 3)',
+                      required=False)
+
+    parser.add_argument('--output', '-o',
+                      help='write results as JSON to this file',
+                      required=False)
+
+    parser.add_argument('--compare', '-c',
+                      help='JSON results of an earlier run to compare against',
+                      required=False)
+
+    parser.add_argument('--threshold',
+                      type=float,
+                      default=10.0,
+                      help='percent slowdown counted as a regression (default: 10)',
+                      required=False)
+
+    parser.add_argument('--max-rss',
+                      type=float,
+                      default=MAX_RSS_BYTES / (1 << 20),
+                      help=f'peak RSS target of a full run in MB, exceeding it fails the benchmark '
+                           f'(default: {MAX_RSS_BYTES >> 20})',
+                      required=False)
+
+    parser.add_argument('--generator-args',
+                      default='',
+                      help='extra encrypt_indexpage.py options for every run, e.g. "--page-size 1000"',
+                      required=False)
+
+    parser.add_argument('--latency',
+                      type=float,
+                      metavar='MS',
+                      help='delay every directory read, stat and page write by MS milliseconds, as on NFS or sshfs, '
+                           'and compare a serial run against a concurrent one instead',
+                      required=False)
+
+    parser.add_argument('--latency-jobs',
+                      type=int,
+                      default=16,
+                      help='--jobs and --list-jobs of the concurrent run with --latency (default: 16)',
+                      required=False)
+
+    config = parser.parse_args()
+    shapes = [name.strip() for name in config.shapes.split(',') if name.strip()]
+    for name in shapes:
+        if name not in SHAPES:
+            parser.error(f"Unknown shape '{name}', expected one of: {', '.join(SHAPES)}")
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': config.scale,
+        'seed': config.seed,
+        'generator_args': config.generator_args,
+        'shapes': {},
+    }
+    if config.latency is not None:
+        results['latency_ms'] = config.latency
+        for name in shapes:
+            print(f'Benchmarking {name} at {config.latency:g} ms latency...', file=sys.stderr)
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                results['shapes'][name] = pool.submit(run_latency, name, config.scale, config.seed,
+                                                      config.latency / 1000, config.latency_jobs,
+                                                      config.generator_args.split()).result()
+        print_latency(results)
+        if config.output:
+            with open(config.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        sys.exit(0 if all(result['identical'] for result in results['shapes'].values()) else 1)
+
+    for name in shapes:
+        print(f'Benchmarking {name}...', file=sys.stderr)
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results['shapes'][name] = pool.submit(run_shape, name, config.scale, config.seed, config.repeat,
+                                                  config.generator_args.split()).result()
+
+    print_results(results)
+    if config.output:
+        with open(config.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = check_rss(results, config.max_rss * (1 << 20))
+    if config.compare:
+        with open(config.compare) as f:
+            baseline = json.load(f)
+        failed += compare_results(baseline, results, config.threshold)
+    if failed:
+        sys.exit(1)
@@ -1,22 +1,134 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import cProfile
+import ctypes
+import ctypes.util
+import errno
 import fnmatch
+import functools
 import os
+import re
 import sys
+import tempfile
+import threading
+import gzip
 import hashlib
+import heapq
+import hmac
+import html
+import http.server
+import itertools
+import mimetypes
+import pathlib
+import multiprocessing
+import posixpath
+import shutil
 import base64
+import bisect
 import json
 import secrets
+import select
+import sqlite3
+import stat
+import struct
+import tarfile
+import time
+import zipfile
+import zlib
+from collections import Counter, OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
-from Crypto.Random import get_random_bytes
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 index_file_name = 'index.html'
+manifest_file_name = '.indexmanifest.sqlite'
+# Exclude patterns read from the top folder unless --ignore-file names another file
+ignore_file_name = '.indexignore'
+# File checksums kept across runs for --checksums, next to the manifest
+checksum_cache_file_name = '.indexchecksums.sqlite'
+# Written into every directory with --sha256sums, in the format of sha256sum -c
+checksums_file_name = 'SHA256SUMS'
+# Entries of zip and tar archives kept across runs for --archive-contents, next to the manifest
+archive_cache_file_name = '.indexarchives.sqlite'
+# index.html, index-2.html, ... and their precompressed variants
+PAGE_FILE_RE = re.compile(r'index(?:-([0-9]+))?\.html(\.gz|\.br)?$')
+# Contents page of an archive with --archive-contents: data.zip.index.html, ...
+ARCHIVE_PAGE_RE = re.compile(r'(.+\.(?:zip|tar))\.index\.html(\.gz|\.br)?$', re.IGNORECASE)
+# Leftovers of an interrupted atomic write of any page, SHA256SUMS or shard (see write_page), and of
+# pages and SHA256SUMS files written before those shared a prefix
+TEMP_FILE_PREFIX = '.indexpage-'
+TEMP_FILE_RE = re.compile(r'\.(?:indexpage-.*|(?:index(-[0-9]+)?|.+\.(?:zip|tar)\.index)\.html(\.gz|\.br)?\..*'
+                          r'|sha256sums\..*)\.tmp$')
+
+# inotify(7) constants used by --watch
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED = 0x400, 0x800, 0x4000, 0x8000
+IN_ONLYDIR, IN_DONT_FOLLOW, IN_ISDIR = 0x01000000, 0x02000000, 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+# Content-Encoding -> file suffix of precompressed pages
+COMPRESSED_SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+# Pages are written through temp files, which need the permissions open() would have given them
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# A listed file, as carried from the walker into the manifest and the renderer; sha256 is only
+# known with --checksums
+FileEntry = namedtuple('FileEntry', ['name', 'size', 'mtime_ns', 'sha256'], defaults=(None,))
+
+# Recursive totals of a directory: bytes, number of files and newest file mtime below it
+SubtreeTotals = namedtuple('SubtreeTotals', ['size', 'files', 'mtime_ns'])
+
+# Listings with more files than this are sorted on disk and rendered as a stream, which keeps
+# memory flat no matter how wide a directory is
+LISTING_BUFFER_ROWS = 10000
+# Files of one directory stat'ed per task on the I/O pool (--io-jobs)
+STAT_BATCH = 64
+# Rendered HTML is gzipped and encrypted in blocks of this size when streaming
+STREAM_BLOCK_SIZE = 1 << 16
+
+# Seconds between commits of the manifest during a run, which is all --resume loses of an interrupted one
+JOURNAL_SECONDS = 10
 
-# CSS for directory listings
-DIRECTORY_CSS = """ <style>
-body {
+# Bump whenever the generated HTML changes so incremental runs re-render everything
+TEMPLATE_VERSION = 7
+
+# Support files (tree manifest shards, search index, ...) live under this folder at the top of the tree
+support_dir_name = '_vault'
+
+# Search index layout: name trigrams hash into a fixed number of posting shards,
+# paths are stored in shards of consecutive ids
+SEARCH_BUCKETS = 256
+SEARCH_CHUNK = 1024
+# Posting shards rebuilt per pass over the index; fewer means more passes but less memory
+SEARCH_PASS_BUCKETS = 64
+
+# Archives whose contents get a page with --archive-contents, and the most entries shown on it
+ARCHIVE_SUFFIXES = ('.zip', '.tar')
+ARCHIVE_ENTRIES = 10000
+
+# Files looked up in the checksum cache per query, and days an unused checksum (or archive listing) is kept
+CHECKSUM_BATCH = 512
+CHECKSUM_CACHE_DAYS = 30
+# Most bytes hashed in one task on the process pool
+CHECKSUM_TASK_BYTES = 64 << 20
+
+# PBKDF2-SHA256 work factor; the browser pays it once per visit, not per page
+KDF_ITERATIONS = 600000
+
+# Stylesheet of directory listings
+LISTING_CSS = """body {
     background: #f4f4f4;
     margin: 2em 2em;
 }
@@ -50,6 +162,13 @@ li {
     float: right;
     color: gray;
 }
+.sha256 {
+    float: right;
+    margin-right: 2em;
+    color: #aaa;
+    font-size: 9pt;
+    user-select: all;
+}
 h1 {
     padding: 10px;
     margin: 15px;
@@ -84,110 +203,468 @@ a:focus::before {
 a::after {
     border-bottom: 2px solid #fff;
 }
-</style>
 """
 
-# Simple encryption for login page
-SIMPLE_LOGIN_TEMPLATE = """<!DOCTYPE html>
-<html>
-<head>
-    <meta charset="UTF-8">
-    <title>Protected File Server</title>
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    
-    <style>
-        body { 
-            font-family: Arial, sans-serif;
-            margin: 0; 
-            overflow: hidden; 
-            height: 100vh;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-        }
-        
-        #skyline-canvas {
-            position: fixed;
-            top: 0;
-            left: 0;
-            width: 100%;
-            height: 100%;
-            z-index: -1;
+# The same, inlined for listings rendered without the shared assets
+DIRECTORY_CSS = f""" <style>
+{LISTING_CSS}</style>
+"""
+
+# Stylesheet of the login page
+LOGIN_CSS = """body { 
+    font-family: Arial, sans-serif;
+    margin: 0; 
+    overflow: hidden; 
+    height: 100vh;
+    display: flex;
+    align-items: center;
+    justify-content: center;
+}
+
+#skyline-canvas {
+    position: fixed;
+    top: 0;
+    left: 0;
+    width: 100%;
+    height: 100%;
+    z-index: -1;
+}
+
+.login-container {
+    background: rgba(255, 255, 255, 0.9);
+    backdrop-filter: blur(5px);
+    padding: 2rem;
+    border-radius: 8px;
+    box-shadow: 0 4px 20px rgba(0, 0, 0, 0.3);
+    width: 90%;
+    max-width: 360px;
+    text-align: center;
+    z-index: 1;
+}
+
+h1 {
+    color: #145DA0;
+    font-size: 1.5rem;
+    margin-bottom: 1.5rem;
+}
+
+input[type="password"] {
+    width: 100%;
+    padding: 12px;
+    margin: 8px 0 20px;
+    display: inline-block;
+    border: 1px solid #ccc;
+    box-sizing: border-box;
+    border-radius: 4px;
+    font-size: 1rem;
+}
+
+button {
+    background-color: #4F5AFD;
+    color: white;
+    padding: 14px 20px;
+    margin: 8px 0;
+    border: none;
+    cursor: pointer;
+    width: 100%;
+    border-radius: 4px;
+    font-size: 1rem;
+    text-transform: uppercase;
+}
+
+button:hover {
+    background-color: #145DA0;
+}
+
+.remember-me {
+    display: flex;
+    align-items: center;
+    justify-content: center;
+    margin-bottom: 20px;
+}
+
+.remember-me input {
+    margin-right: 10px;
+    transform: scale(1.2);
+}
+
+.footer {
+    position: fixed;
+    bottom: 0;
+    right: 0;
+    padding: 10px;
+    color: white;
+    font-size: 14px;
+}
+
+#error-message {
+    color: red;
+    margin-top: 10px;
+    display: none;
+}
+
+.unlocking .login-container {
+    visibility: hidden;
+}
+"""
+
+# Login and decryption logic; reads the salt, iterations and payload from the page's inline `vault`
+LOGIN_JS = """const KEY_STORAGE = 'fileserver_key';
+
+function fromBase64(text) {
+    const binary = atob(text);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return bytes;
+}
+
+function toBase64(bytes) {
+    let binary = '';
+    for (let i = 0; i < bytes.length; i++) {
+        binary += String.fromCharCode(bytes[i]);
+    }
+    return btoa(binary);
+}
+
+// The expensive part, done once per visitor: every page shares the same key
+async function deriveKey(password) {
+    const material = await crypto.subtle.importKey(
+        'raw', new TextEncoder().encode(password), 'PBKDF2', false, ['deriveBits']);
+    const bits = await crypto.subtle.deriveBits(
+        { name: 'PBKDF2', hash: 'SHA-256', salt: fromBase64(vault.salt), iterations: vault.iterations },
+        material, 256);
+    return new Uint8Array(bits);
+}
+
+// The cheap part, done on every page: one symmetric decryption
+async function decryptPage(rawKey) {
+    const key = await crypto.subtle.importKey('raw', rawKey, 'AES-GCM', false, ['decrypt']);
+    const data = fromBase64(vault.payload);
+    const plain = await crypto.subtle.decrypt(
+        { name: 'AES-GCM', iv: data.subarray(0, 12) }, key, data.subarray(12));
+    // Listings are gzipped before encryption, since ciphertext no longer compresses
+    const stream = new Blob([plain]).stream().pipeThrough(new DecompressionStream('gzip'));
+    return await new Response(stream).text();
+}
+
+function showPage(html) {
+    function write() {
+        document.open();
+        document.write(html);
+        document.close();
+    }
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', write);
+    } else {
+        write();
+    }
+}
+
+// Derived key cached for the session, or for 7 days with "remember me"
+function cachedKey() {
+    let entry = sessionStorage.getItem(KEY_STORAGE);
+    if (!entry) {
+        const expiry = localStorage.getItem('fileserver_expiry');
+        if (expiry && Date.now() < parseInt(expiry)) {
+            entry = localStorage.getItem(KEY_STORAGE);
         }
-        
-        .login-container {
-            background: rgba(255, 255, 255, 0.9);
-            backdrop-filter: blur(5px);
-            padding: 2rem;
-            border-radius: 8px;
-            box-shadow: 0 4px 20px rgba(0, 0, 0, 0.3);
-            width: 90%;
-            max-width: 360px;
-            text-align: center;
-            z-index: 1;
+    }
+    if (!entry) {
+        return null;
+    }
+    const parts = entry.split(':');
+    return parts[0] === vault.salt ? fromBase64(parts[1]) : null;
+}
+
+function forgetKey() {
+    sessionStorage.removeItem(KEY_STORAGE);
+    localStorage.removeItem(KEY_STORAGE);
+    localStorage.removeItem('fileserver_expiry');
+}
+
+// Already authenticated: decrypt straight away without showing the form
+const rawKey = window.crypto && crypto.subtle ? cachedKey() : null;
+if (rawKey) {
+    document.documentElement.className = 'unlocking';
+    decryptPage(rawKey).then(showPage, function() {
+        forgetKey();
+        document.documentElement.className = '';
+    });
+}
+
+document.getElementById('login-form').addEventListener('submit', async function(e) {
+    e.preventDefault();
+
+    const errorMessage = document.getElementById('error-message');
+    if (!window.crypto || !crypto.subtle) {
+        errorMessage.textContent = 'Decryption needs a secure (HTTPS) connection.';
+        errorMessage.style.display = 'block';
+        return;
+    }
+
+    const password = document.getElementById('password').value;
+    const remember = document.getElementById('remember').checked;
+    const key = await deriveKey(password);
+
+    let html;
+    try {
+        html = await decryptPage(key);
+    } catch (err) {
+        // Authentication tag mismatch: wrong password
+        errorMessage.style.display = 'block';
+        return;
+    }
+
+    const entry = vault.salt + ':' + toBase64(key);
+    sessionStorage.setItem(KEY_STORAGE, entry);
+    if (remember) {
+        localStorage.setItem(KEY_STORAGE, entry);
+        localStorage.setItem('fileserver_expiry', 
+            Date.now() + (7 * 24 * 60 * 60 * 1000)); // 7 days
+    }
+    showPage(html);
+});
+"""
+
+# Skyline animation behind the login form
+SKYLINE_JS = """(function() {
+    const canvas = document.getElementById('skyline-canvas');
+    const ctx = canvas.getContext('2d');
+
+    // Set canvas size
+    function resizeCanvas() {
+        canvas.width = window.innerWidth;
+        canvas.height = window.innerHeight;
+    }
+    resizeCanvas();
+    window.addEventListener('resize', resizeCanvas);
+
+    // Mouse tracking
+    let mouseX = canvas.width / 10;
+    let mouseY = canvas.height;
+
+    document.addEventListener('mousemove', function(e) {
+        mouseX = e.pageX;
+        mouseY = e.pageY;
+    });
+
+    // Utility functions
+    function random(min, max) { return Math.random() * (max - min) + min; }
+    const floor = Math.floor;
+    const round = Math.round;
+
+    const skylines = [];
+    let dt = 1;
+    let lastTime = 0;
+
+    // Building class
+    function Building(config) {
+        this.reset(config);
+    }
+
+    Building.prototype.reset = function(config) {
+        this.layer = config.layer;
+        this.x = config.x;
+        this.y = config.y;
+        this.width = config.width;
+        this.height = config.height;
+        this.color = config.color;
+
+        // 5% chance to deepen gray
+        if (Math.random() < 0.05) {
+            const m = this.color.match(/hsl\\(200,\\s*(\\d+)%\\s*,\\s*(\\d+)%\\s*\\)/);
+            if (m) {
+                const s = parseInt(m[1], 10);
+                let b = parseInt(m[2], 10);
+                const delta = floor(random(10, 20));
+                b = Math.max(0, b - delta);
+                this.color = `hsl(200, ${s}%, ${b}%)`;
+            }
         }
-        
-        h1 {
-            color: #145DA0;
-            font-size: 1.5rem;
-            margin-bottom: 1.5rem;
+
+        // Random roof details
+        this.slantedTop = floor(random(0, 10)) === 0;
+        this.slantedTopHeight = this.width / random(2, 4);
+        this.slantedTopDirection = round(random(0, 1)) === 0;
+
+        this.spireTop = floor(random(0, 15)) === 0;
+        this.spireTopWidth = random(this.width * 0.01, this.width * 0.07);
+        this.spireTopHeight = random(10, 20);
+
+        this.antennaTop = !this.spireTop && floor(random(0, 10)) === 0;
+        this.antennaTopWidth = this.layer / 2;
+        this.antennaTopHeight = random(5, 20);
+    };
+
+    Building.prototype.render = function() {
+        ctx.fillStyle = ctx.strokeStyle = this.color;
+        ctx.lineWidth = 2;
+
+        // Main rectangle
+        ctx.beginPath();
+        ctx.rect(this.x, this.y, this.width, this.height);
+        ctx.fill();
+        ctx.stroke();
+
+        // Slanted roof
+        if (this.slantedTop) {
+            ctx.beginPath();
+            ctx.moveTo(this.x, this.y);
+            ctx.lineTo(this.x + this.width, this.y);
+            if (this.slantedTopDirection) {
+                ctx.lineTo(this.x + this.width, this.y - this.slantedTopHeight);
+            } else {
+                ctx.lineTo(this.x, this.y - this.slantedTopHeight);
+            }
+            ctx.closePath();
+            ctx.fill();
+            ctx.stroke();
         }
-        
-        input[type="password"] {
-            width: 100%;
-            padding: 12px;
-            margin: 8px 0 20px;
-            display: inline-block;
-            border: 1px solid #ccc;
-            box-sizing: border-box;
-            border-radius: 4px;
-            font-size: 1rem;
+
+        // Spire
+        if (this.spireTop) {
+            ctx.beginPath();
+            const midX = this.x + this.width / 2;
+            ctx.moveTo(midX, this.y - this.spireTopHeight);
+            ctx.lineTo(midX + this.spireTopWidth, this.y);
+            ctx.lineTo(midX - this.spireTopWidth, this.y);
+            ctx.closePath();
+            ctx.fill();
+            ctx.stroke();
         }
-        
-        button {
-            background-color: #4F5AFD;
-            color: white;
-            padding: 14px 20px;
-            margin: 8px 0;
-            border: none;
-            cursor: pointer;
-            width: 100%;
-            border-radius: 4px;
-            font-size: 1rem;
-            text-transform: uppercase;
+
+        // Antenna
+        if (this.antennaTop) {
+            ctx.beginPath();
+            const midX = this.x + this.width / 2;
+            ctx.moveTo(midX, this.y - this.antennaTopHeight);
+            ctx.lineTo(midX, this.y);
+            ctx.lineWidth = this.antennaTopWidth;
+            ctx.stroke();
+            ctx.lineWidth = 2;
         }
-        
-        button:hover {
-            background-color: #145DA0;
+    };
+
+    // Skyline class
+    function Skyline(config) {
+        this.x = 0;
+        this.buildings = [];
+        this.layer = config.layer;
+        this.width = { min: config.width.min, max: config.width.max };
+        this.height = { min: config.height.min, max: config.height.max };
+        this.speed = config.speed;
+        this.color = config.color;
+        this.populate();
+    }
+
+    Skyline.prototype.populate = function() {
+        let total = 0;
+        while (total <= canvas.width + this.width.max * 2) {
+            const w = round(random(this.width.min, this.width.max));
+            const h = round(random(this.height.min, this.height.max));
+            const lastX = this.buildings.length
+                ? this.buildings[this.buildings.length - 1].x + this.buildings[this.buildings.length - 1].width
+                : 0;
+            this.buildings.push(
+                new Building({
+                    layer: this.layer,
+                    x: lastX,
+                    y: canvas.height - h,
+                    width: w,
+                    height: h,
+                    color: this.color
+                })
+            );
+            total += w;
         }
-        
-        .remember-me {
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            margin-bottom: 20px;
+    };
+
+    Skyline.prototype.update = function() {
+        this.x -= mouseX * this.speed * dt;
+        const first = this.buildings[0];
+        if (first.x + first.width + this.x < 0) {
+            const w = round(random(this.width.min, this.width.max));
+            const h = round(random(this.height.min, this.height.max));
+            const last = this.buildings[this.buildings.length - 1];
+            first.reset({
+                layer: this.layer,
+                x: last.x + last.width,
+                y: canvas.height - h,
+                width: w,
+                height: h,
+                color: this.color
+            });
+            this.buildings.push(this.buildings.shift());
         }
-        
-        .remember-me input {
-            margin-right: 10px;
-            transform: scale(1.2);
+    };
+
+    Skyline.prototype.render = function() {
+        ctx.save();
+        ctx.translate(this.x, (canvas.height - mouseY) / 20 * this.layer);
+        for (let i = this.buildings.length - 1; i >= 0; i--) {
+            this.buildings[i].render();
         }
-        
-        .footer {
-            position: fixed;
-            bottom: 0;
-            right: 0;
-            padding: 10px;
-            color: white;
-            font-size: 14px;
+        ctx.restore();
+    };
+
+    // Initialize skylines
+    function init() {
+        for (let i = 5; i > 0; i--) {
+            skylines.push(
+                new Skyline({
+                    layer: i,
+                    width: { min: i * 30, max: i * 40 },
+                    height: { min: 150 - (i - 1) * 35, max: 300 - (i - 1) * 35 },
+                    speed: i * 0.003,
+                    color: `hsl(200, ${(i) + 10}%, ${75 - (i - 1) * 13}%)`
+                })
+            );
         }
-        
-        #error-message {
-            color: red;
-            margin-top: 10px;
-            display: none;
+    }
+
+    // Animation loop
+    function animate(currentTime) {
+        if (!lastTime) lastTime = currentTime;
+
+        dt = (currentTime - lastTime) < 100 ? 0.1 : (currentTime - lastTime) / 16;
+        dt = dt > 5 ? 5 : dt;
+        lastTime = currentTime;
+
+        ctx.clearRect(0, 0, canvas.width, canvas.height);
+
+        for (let i = skylines.length - 1; i >= 0; i--) {
+            skylines[i].update();
+            skylines[i].render();
         }
-    </style>
+
+        requestAnimationFrame(animate);
+    }
+
+    // Start animation
+    init();
+    requestAnimationFrame(animate);
+
+    // Handle window resize
+    window.addEventListener('resize', function() {
+        skylines.forEach(skyline => {
+            skyline.buildings = [];
+            skyline.populate();
+        });
+    });
+})();
+"""
+
+# Simple encryption for login page
+SIMPLE_LOGIN_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>Protected File Server</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    
+    <link rel="stylesheet" href="{{ login_css }}">
 </head>
 <body>
     <canvas id="skyline-canvas"></canvas>
@@ -209,407 +686,3569 @@ SIMPLE_LOGIN_TEMPLATE = """<!DOCTYPE html>
     <div class="footer">{{ footer_text }}</div>
 
     <script>
-        // Encoded content - will be replaced with actual protected content
-        const protectedContent = "{{ encrypted_content }}";
-        const password_hash = "{{ password_hash }}";
-        
-        document.getElementById('login-form').addEventListener('submit', function(e) {
-            e.preventDefault();
-            
-            const password = document.getElementById('password').value;
-            const remember = document.getElementById('remember').checked;
-            
-            // Simple hash function for password verification
-            function hashPassword(password) {
-                let hash = 0;
-                for (let i = 0; i < password.length; i++) {
-                    const char = password.charCodeAt(i);
-                    hash = ((hash << 5) - hash) + char;
-                    hash = hash & hash; // Convert to 32bit integer
-                }
-                return hash.toString();
-            }
-            
-            // Check if password is correct
-            if (hashPassword(password) === password_hash) {
-                // Store in localStorage if remember is checked
-                if (remember) {
-                    localStorage.setItem('fileserver_auth', 'true');
-                    localStorage.setItem('fileserver_expiry', 
-                        Date.now() + (7 * 24 * 60 * 60 * 1000)); // 7 days
-                }
-                
-                // Decode and display content
-                const decodedContent = atob(protectedContent);
-                document.open();
-                document.write(decodedContent);
-                document.close();
-            } else {
-                document.getElementById('error-message').style.display = 'block';
-            }
-        });
-        
-        // Check if already authenticated
-        window.addEventListener('load', function() {
-            const isAuthenticated = localStorage.getItem('fileserver_auth');
-            const expiry = localStorage.getItem('fileserver_expiry');
-            
-            if (isAuthenticated && expiry && Date.now() < parseInt(expiry)) {
-                const decodedContent = atob(protectedContent);
-                document.open();
-                document.write(decodedContent);
-                document.close();
-            }
-        });
+        // Encrypted page - AES-GCM under a key derived from the password with PBKDF2
+        const vault = {
+            salt: "{{ salt }}",
+            iterations: {{ iterations }},
+            payload: "{{ encrypted_content }}"
+        };
     </script>
+    <script src="{{ login_js }}"></script>
+    <script src="{{ skyline_js }}"></script>
+</body>
+</html>
+"""
 
-    <script>
-        // Skyline animation code
-        (function() {
-            const canvas = document.getElementById('skyline-canvas');
-            const ctx = canvas.getContext('2d');
-            
-            // Set canvas size
-            function resizeCanvas() {
-                canvas.width = window.innerWidth;
-                canvas.height = window.innerHeight;
-            }
-            resizeCanvas();
-            window.addEventListener('resize', resizeCanvas);
-            
-            // Mouse tracking
-            let mouseX = canvas.width / 10;
-            let mouseY = canvas.height;
-            
-            document.addEventListener('mousemove', function(e) {
-                mouseX = e.pageX;
-                mouseY = e.pageY;
-            });
-            
-            // Utility functions
-            function random(min, max) { return Math.random() * (max - min) + min; }
-            const floor = Math.floor;
-            const round = Math.round;
-            
-            const skylines = [];
-            let dt = 1;
-            let lastTime = 0;
-            
-            // Building class
-            function Building(config) {
-                this.reset(config);
-            }
-            
-            Building.prototype.reset = function(config) {
-                this.layer = config.layer;
-                this.x = config.x;
-                this.y = config.y;
-                this.width = config.width;
-                this.height = config.height;
-                this.color = config.color;
-                
-                // 5% chance to deepen gray
-                if (Math.random() < 0.05) {
-                    const m = this.color.match(/hsl\\(200,\\s*(\\d+)%\\s*,\\s*(\\d+)%\\s*\\)/);
-                    if (m) {
-                        const s = parseInt(m[1], 10);
-                        let b = parseInt(m[2], 10);
-                        const delta = floor(random(10, 20));
-                        b = Math.max(0, b - delta);
-                        this.color = `hsl(200, ${s}%, ${b}%)`;
-                    }
-                }
-                
-                // Random roof details
-                this.slantedTop = floor(random(0, 10)) === 0;
-                this.slantedTopHeight = this.width / random(2, 4);
-                this.slantedTopDirection = round(random(0, 1)) === 0;
-                
-                this.spireTop = floor(random(0, 15)) === 0;
-                this.spireTopWidth = random(this.width * 0.01, this.width * 0.07);
-                this.spireTopHeight = random(10, 20);
-                
-                this.antennaTop = !this.spireTop && floor(random(0, 10)) === 0;
-                this.antennaTopWidth = this.layer / 2;
-                this.antennaTopHeight = random(5, 20);
-            };
-            
-            Building.prototype.render = function() {
-                ctx.fillStyle = ctx.strokeStyle = this.color;
-                ctx.lineWidth = 2;
-                
-                // Main rectangle
-                ctx.beginPath();
-                ctx.rect(this.x, this.y, this.width, this.height);
-                ctx.fill();
-                ctx.stroke();
-                
-                // Slanted roof
-                if (this.slantedTop) {
-                    ctx.beginPath();
-                    ctx.moveTo(this.x, this.y);
-                    ctx.lineTo(this.x + this.width, this.y);
-                    if (this.slantedTopDirection) {
-                        ctx.lineTo(this.x + this.width, this.y - this.slantedTopHeight);
-                    } else {
-                        ctx.lineTo(this.x, this.y - this.slantedTopHeight);
-                    }
-                    ctx.closePath();
-                    ctx.fill();
-                    ctx.stroke();
-                }
-                
-                // Spire
-                if (this.spireTop) {
-                    ctx.beginPath();
-                    const midX = this.x + this.width / 2;
-                    ctx.moveTo(midX, this.y - this.spireTopHeight);
-                    ctx.lineTo(midX + this.spireTopWidth, this.y);
-                    ctx.lineTo(midX - this.spireTopWidth, this.y);
-                    ctx.closePath();
-                    ctx.fill();
-                    ctx.stroke();
-                }
-                
-                // Antenna
-                if (this.antennaTop) {
-                    ctx.beginPath();
-                    const midX = this.x + this.width / 2;
-                    ctx.moveTo(midX, this.y - this.antennaTopHeight);
-                    ctx.lineTo(midX, this.y);
-                    ctx.lineWidth = this.antennaTopWidth;
-                    ctx.stroke();
-                    ctx.lineWidth = 2;
-                }
-            };
-            
-            // Skyline class
-            function Skyline(config) {
-                this.x = 0;
-                this.buildings = [];
-                this.layer = config.layer;
-                this.width = { min: config.width.min, max: config.width.max };
-                this.height = { min: config.height.min, max: config.height.max };
-                this.speed = config.speed;
-                this.color = config.color;
-                this.populate();
+# Search client for --search, shared by every listing
+SEARCH_JS = """(function() {
+    // Settings come with the search box, inside the encrypted listing
+    const input = document.getElementById('search');
+    const SEARCH_KEY = input.dataset.key;
+    const SEARCH_ROOT = input.dataset.root;
+    const SEARCH_DIR = SEARCH_ROOT + input.dataset.dir;
+    const SPA = input.dataset.spa === 'true';
+    const BUCKETS = parseInt(input.dataset.buckets, 10);
+    const CHUNK = parseInt(input.dataset.chunk, 10);
+    const INDEX_FILE = input.dataset.index;
+    const MAX_RESULTS = 100;
+    const results = document.getElementById('search-results');
+    const shards = {};
+    let latest = 0;
+
+    function fromBase64(text) {
+        const binary = atob(text);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return bytes;
+    }
+
+    function prettySize(bytes) {
+        const units = [[1024 ** 5, ' PB'], [1024 ** 4, ' TB'], [1024 ** 3, ' GB'], [1024 ** 2, ' MB'], [1024, ' KB']];
+        for (const [factor, suffix] of units) {
+            if (bytes >= factor) {
+                return Math.floor(bytes / factor) + suffix;
             }
-            
-            Skyline.prototype.populate = function() {
-                let total = 0;
-                while (total <= canvas.width + this.width.max * 2) {
-                    const w = round(random(this.width.min, this.width.max));
-                    const h = round(random(this.height.min, this.height.max));
-                    const lastX = this.buildings.length
-                        ? this.buildings[this.buildings.length - 1].x + this.buildings[this.buildings.length - 1].width
-                        : 0;
-                    this.buildings.push(
-                        new Building({
-                            layer: this.layer,
-                            x: lastX,
-                            y: canvas.height - h,
-                            width: w,
-                            height: h,
-                            color: this.color
-                        })
-                    );
-                    total += w;
-                }
-            };
-            
-            Skyline.prototype.update = function() {
-                this.x -= mouseX * this.speed * dt;
-                const first = this.buildings[0];
-                if (first.x + first.width + this.x < 0) {
-                    const w = round(random(this.width.min, this.width.max));
-                    const h = round(random(this.height.min, this.height.max));
-                    const last = this.buildings[this.buildings.length - 1];
-                    first.reset({
-                        layer: this.layer,
-                        x: last.x + last.width,
-                        y: canvas.height - h,
-                        width: w,
-                        height: h,
-                        color: this.color
-                    });
-                    this.buildings.push(this.buildings.shift());
-                }
-            };
-            
-            Skyline.prototype.render = function() {
-                ctx.save();
-                ctx.translate(this.x, (canvas.height - mouseY) / 20 * this.layer);
-                for (let i = this.buildings.length - 1; i >= 0; i--) {
-                    this.buildings[i].render();
-                }
-                ctx.restore();
-            };
-            
-            // Initialize skylines
-            function init() {
-                for (let i = 5; i > 0; i--) {
-                    skylines.push(
-                        new Skyline({
-                            layer: i,
-                            width: { min: i * 30, max: i * 40 },
-                            height: { min: 150 - (i - 1) * 35, max: 300 - (i - 1) * 35 },
-                            speed: i * 0.003,
-                            color: `hsl(200, ${(i) + 10}%, ${75 - (i - 1) * 13}%)`
-                        })
-                    );
+        }
+        return bytes + (bytes === 1 ? ' byte' : ' bytes');
+    }
+
+    // Shards are fetched on first use only, a query touches a handful of them
+    function loadShard(name) {
+        if (!shards[name]) {
+            shards[name] = (async function() {
+                const response = await fetch(SEARCH_DIR + '/' + name + '.bin');
+                if (!response.ok) {
+                    return {};
                 }
+                const data = new Uint8Array(await response.arrayBuffer());
+                const key = await crypto.subtle.importKey('raw', fromBase64(SEARCH_KEY), 'AES-GCM', false, ['decrypt']);
+                const plain = await crypto.subtle.decrypt(
+                    { name: 'AES-GCM', iv: data.subarray(0, 12) }, key, data.subarray(12));
+                const stream = new Blob([plain]).stream().pipeThrough(new DecompressionStream('gzip'));
+                return JSON.parse(await new Response(stream).text());
+            })();
+        }
+        return shards[name];
+    }
+
+    function trigrams(text) {
+        const chars = Array.from(text);
+        const grams = new Set();
+        for (let i = 0; i + 3 <= chars.length; i++) {
+            grams.add(chars.slice(i, i + 3).join(''));
+        }
+        return Array.from(grams);
+    }
+
+    // FNV-1a over the UTF-8 bytes, as in gram_bucket()
+    function bucket(gram) {
+        let hash = 0x811c9dc5;
+        for (const byte of new TextEncoder().encode(gram)) {
+            hash = Math.imul(hash ^ byte, 0x01000193) >>> 0;
+        }
+        return 'g' + (hash % BUCKETS).toString(16).padStart(2, '0');
+    }
+
+    async function postings(gram) {
+        const deltas = (await loadShard(bucket(gram)))[gram] || [];
+        let id = 0;
+        return deltas.map(delta => id += delta);
+    }
+
+    function intersect(a, b) {
+        const out = [];
+        for (let i = 0, j = 0; i < a.length && j < b.length; ) {
+            if (a[i] === b[j]) {
+                out.push(a[i]);
+                i++;
+                j++;
+            } else if (a[i] < b[j]) {
+                i++;
+            } else {
+                j++;
             }
-            
-            // Animation loop
-            function animate(currentTime) {
-                if (!lastTime) lastTime = currentTime;
-                
-                dt = (currentTime - lastTime) < 100 ? 0.1 : (currentTime - lastTime) / 16;
-                dt = dt > 5 ? 5 : dt;
-                lastTime = currentTime;
-                
-                ctx.clearRect(0, 0, canvas.width, canvas.height);
-                
-                for (let i = skylines.length - 1; i >= 0; i--) {
-                    skylines[i].update();
-                    skylines[i].render();
+        }
+        return out;
+    }
+
+    async function search(query) {
+        const lists = await Promise.all(trigrams(query).map(postings));
+        lists.sort((a, b) => a.length - b.length);
+        let ids = lists[0];
+        for (const list of lists.slice(1)) {
+            ids = intersect(ids, list);
+        }
+        // Trigram hits are candidates; the name itself decides
+        const matches = [];
+        for (let i = 0; i < ids.length && matches.length < MAX_RESULTS; ) {
+            const chunk = Math.floor(ids[i] / CHUNK);
+            const paths = await loadShard('p' + chunk);
+            for (; i < ids.length && Math.floor(ids[i] / CHUNK) === chunk; i++) {
+                const entry = paths[ids[i]];
+                if (entry && entry[1].toLowerCase().includes(query) && matches.length < MAX_RESULTS) {
+                    matches.push(entry);
                 }
-                
-                requestAnimationFrame(animate);
             }
-            
-            // Start animation
-            init();
-            requestAnimationFrame(animate);
-            
-            // Handle window resize
-            window.addEventListener('resize', function() {
-                skylines.forEach(skyline => {
-                    skyline.buildings = [];
-                    skyline.populate();
-                });
-            });
-        })();
-    </script>
-</body>
-</html>
+        }
+        return matches;
+    }
+
+    function encodePath(path) {
+        return path.split('/').map(encodeURIComponent).join('/');
+    }
+
+    function resultRow([dir, name, size]) {
+        const path = dir ? dir + '/' + name : name;
+        const li = document.createElement('li');
+        const a = document.createElement('a');
+        if (size === null) {
+            a.href = SPA ? '#/' + encodePath(path) : SEARCH_ROOT + encodePath(path) + '/' + INDEX_FILE;
+            a.textContent = '\\u{1F4C1} ' + path;
+            li.appendChild(a);
+        } else {
+            a.href = SEARCH_ROOT + encodePath(path);
+            a.textContent = '\\u{1F4C4} ' + path;
+            li.appendChild(a);
+            const span = document.createElement('span');
+            span.className = 'size';
+            span.textContent = prettySize(size);
+            li.appendChild(span);
+        }
+        return li;
+    }
+
+    input.addEventListener('input', async function() {
+        const query = input.value.trim().toLowerCase();
+        const current = ++latest;
+        if (Array.from(query).length < 3) {
+            results.textContent = '';
+            return;
+        }
+        const matches = await search(query);
+        if (current !== latest) {
+            return;
+        }
+        const fragment = document.createDocumentFragment();
+        for (const entry of matches) {
+            fragment.appendChild(resultRow(entry));
+        }
+        if (!matches.length) {
+            const li = document.createElement('li');
+            li.textContent = 'No matches';
+            fragment.appendChild(li);
+        }
+        results.textContent = '';
+        results.appendChild(fragment);
+    });
+})();
 """
 
-def generate_directory_listing(parentdir, dirs, files, file_filter=None):
-    """Generate HTML for directory listing"""
-    html = f'''<!DOCTYPE html>
+# Search box for --search, embedded in every listing
+SEARCH_TEMPLATE = """
+   <li><input id="search" type="search" placeholder="Search all folders" autocomplete="off"
+        data-key="{{ search_key }}" data-root="{{ search_root }}" data-dir="{{ search_dir }}" data-spa="{{ spa }}"
+        data-buckets="{{ buckets }}" data-chunk="{{ chunk }}" data-index="{{ index_file }}"
+        style="width:100%; box-sizing:border-box; font-family:monospace; font-size:12pt; padding:4px"></li>
+   <div id="search-results"></div>
+  <script src="{{ search_js }}"></script>"""
+
+# Shared stylesheets and scripts, written once under support_dir_name/assets with a hash of their
+# content in the file name, so pages can link them and browsers can cache them forever
+ASSETS = {
+    'listing.css': LISTING_CSS,
+    'login.css': LOGIN_CSS,
+    'login.js': LOGIN_JS,
+    'skyline.js': SKYLINE_JS,
+    'search.js': SEARCH_JS,
+}
+# Cache-Control that publish sets on assets; a changed asset gets a new name instead
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Single-page viewer for --mode spa, rendering any directory from the encrypted tree manifest
+SPA_VIEWER_TEMPLATE = """<!DOCTYPE html>
 <html>
- <head>{DIRECTORY_CSS}</head>
+ <head>{{ css }}
+  <style>
+#rows {
+    position: relative;
+    margin: 0;
+    padding: 0;
+}
+#rows li {
+    position: absolute;
+    left: 0;
+    right: 0;
+    height: 14pt;
+    overflow: hidden;
+    white-space: nowrap;
+}
+  </style>
+ </head>
  <body>
   <div class="content">
-   <h1>{os.path.basename(os.path.abspath(parentdir))}</h1>
-   <li><a style="display:block; width:100%" href="../{index_file_name}">&#x21B0;</a></li>'''
-    
-    # Add directories - link to index.html in each subdirectory
-    for dirname in sorted(dirs):
-        html += f'''
-   <li><a style="display:block; width:100%" href="{dirname}/{index_file_name}">&#128193; {dirname}</a></li>'''
-    
-    # Add files
-    for filename in sorted(files):
-        # Skip index.html
-        if filename.strip().lower() == index_file_name.lower():
-            continue
-            
-        # Apply filter if provided
-        if file_filter and not fnmatch.fnmatch(filename, file_filter):
-            continue
-            
-        try:
-            size = os.path.getsize(os.path.join(parentdir, filename))
-            html += f'''
-   <li>&#x1f4c4; <a href="{filename}">{filename}</a><span class="size">{pretty_size(size)}</span></li>'''
-        except Exception as e:
-            print(f'ERROR writing file name: {e}')
-    
-    html += '''
+   <h1 id="title">{{ title }}</h1>{{ search }}
+   <ul id="rows"></ul>
   </div>
- </body>
-</html>'''
-    
-    return html
-
-def simple_hash(password):
-    """Create a simple hash for password verification"""
-    hash_value = 0
-    for char in password:
-        hash_value = ((hash_value << 5) - hash_value) + ord(char)
-        hash_value = hash_value & 0xFFFFFFFF  # Convert to 32bit integer
-    return str(hash_value)
-
-def process_dir(top_dir, password, opts):
-    """Process directory recursively and create index files"""
-    for parentdir, dirs, files in os.walk(top_dir):
-        # Skip if directory is not writable
-        if not os.access(parentdir, os.W_OK):
-            print(f"***ERROR*** folder {parentdir} is not writable! SKIPPING!")
-            continue
-            
-        if opts.verbose:
-            print(f'Processing directory: {parentdir}')
+  <script>
+    (function() {
+        const TREE_KEY = "{{ tree_key }}";
+        const SHARD_DEPTH = {{ shard_depth }};
+        const ROOT_TITLE = document.getElementById('title').textContent;
+        const container = document.getElementById('rows');
+        const shards = {};
+        let rows = [];
+        let rowHeight = 0;
+        let shown = '';
         
-        # Generate the directory listing HTML
-        content = generate_directory_listing(parentdir, dirs, files, opts.filter)
+        function fromBase64(text) {
+            const binary = atob(text);
+            const bytes = new Uint8Array(binary.length);
+            for (let i = 0; i < binary.length; i++) {
+                bytes[i] = binary.charCodeAt(i);
+            }
+            return bytes;
+        }
         
-        if not opts.dryrun:
-            # Determine if this is the top-level directory
-            is_top_level = (os.path.abspath(parentdir) == os.path.abspath(top_dir))
-            
-            abs_path = os.path.join(parentdir, index_file_name)
-            
-            try:
-                if is_top_level:
-                    # Only encrypt the top-level index.html
-                    # Base64 encode the content
-                    encoded_content = base64.b64encode(content.encode('utf-8')).decode('utf-8')
-                    
-                    # Create a simple hash of the password
-                    password_hash = simple_hash(password)
-                    
-                    # Create login page with embedded content
-                    login_html = SIMPLE_LOGIN_TEMPLATE
-                    login_html = login_html.replace('{{ encrypted_content }}', encoded_content)
-                    login_html = login_html.replace('{{ password_hash }}', password_hash)
-                    login_html = login_html.replace('{{ footer_text }}', opts.footer or "(c) Sourav Mishra")
-                    
-                    with open(abs_path, "w") as index_file:
-                        index_file.write(login_html)
-                        
-                    if opts.verbose:
-                        print(f'Created encrypted: {abs_path}')
-                else:
-                    # Write unencrypted index.html for subdirectories
-                    with open(abs_path, "w") as index_file:
-                        index_file.write(content)
-                        
-                    if opts.verbose:
-                        print(f'Created unencrypted: {abs_path}')
-                        
-            except Exception as e:
-                print(f'Cannot create file {abs_path}: {e}')
-
-# Bytes pretty-printing
-UNITS_MAPPING = [
-    (1024 ** 5, ' PB'),
-    (1024 ** 4, ' TB'),
-    (1024 ** 3, ' GB'),
-    (1024 ** 2, ' MB'),
-    (1024 ** 1, ' KB'),
-    (1024 ** 0, (' byte', ' bytes')),
-]
-
-def pretty_size(bytes, units=UNITS_MAPPING):
-    """Human-readable file sizes."""
-    for factor, suffix in units:
-        if bytes >= factor:
-            break
-    amount = int(bytes / factor)
-
+        function prettySize(bytes) {
+            const units = [[1024 ** 5, ' PB'], [1024 ** 4, ' TB'], [1024 ** 3, ' GB'], [1024 ** 2, ' MB'], [1024, ' KB']];
+            for (const [factor, suffix] of units) {
+                if (bytes >= factor) {
+                    return Math.floor(bytes / factor) + suffix;
+                }
+            }
+            return bytes + (bytes === 1 ? ' byte' : ' bytes');
+        }
+        
+        // Same format as subtree_summary()
+        function subtreeSummary(subtree) {
+            let summary = prettySize(subtree.size) + ', ' + subtree.files + (subtree.files === 1 ? ' file' : ' files');
+            if (subtree.files) {
+                summary += ', ' + new Date(subtree.mtime * 1000).toISOString().slice(0, 10);
+            }
+            return summary;
+        }
+        
+        // Directories below SHARD_DEPTH live in the shard of their ancestor at that depth
+        function shardPrefix(path) {
+            const parts = path ? path.split('/') : [];
+            return !SHARD_DEPTH || parts.length < SHARD_DEPTH ? '' : parts.slice(0, SHARD_DEPTH).join('/');
+        }
+        
+        async function fetchShard(prefix) {
+            const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', new TextEncoder().encode(prefix)));
+            const name = Array.from(digest.subarray(0, 8), b => b.toString(16).padStart(2, '0')).join('');
+            const response = await fetch('{{ tree_dir }}/' + name + '.bin');
+            if (!response.ok) {
+                return {};
+            }
+            const data = new Uint8Array(await response.arrayBuffer());
+            const key = await crypto.subtle.importKey('raw', fromBase64(TREE_KEY), 'AES-GCM', false, ['decrypt']);
+            const plain = await crypto.subtle.decrypt(
+                { name: 'AES-GCM', iv: data.subarray(0, 12) }, key, data.subarray(12));
+            const stream = new Blob([plain]).stream().pipeThrough(new DecompressionStream('gzip'));
+            return JSON.parse(await new Response(stream).text());
+        }
+        
+        function loadShard(prefix) {
+            if (!shards[prefix]) {
+                shards[prefix] = fetchShard(prefix);
+            }
+            return shards[prefix];
+        }
+        
+        function encodePath(path) {
+            return path.split('/').map(encodeURIComponent).join('/');
+        }
+        
+        function makeRow(row) {
+            const li = document.createElement('li');
+            const a = document.createElement('a');
+            if (row.kind === 'file') {
+                li.appendChild(document.createTextNode('\\u{1F4C4} '));
+                a.href = encodePath(row.path);
+                a.textContent = row.name;
+                li.appendChild(a);
+                const size = document.createElement('span');
+                size.className = 'size';
+                size.textContent = prettySize(row.size);
+                li.appendChild(size);
+                if (row.sha256) {
+                    const checksum = document.createElement('code');
+                    checksum.className = 'sha256';
+                    checksum.textContent = row.sha256;
+                    li.appendChild(checksum);
+                }
+            } else {
+                if (row.subtree) {
+                    const size = document.createElement('span');
+                    size.className = 'size';
+                    size.textContent = subtreeSummary(row.subtree);
+                    li.appendChild(size);
+                }
+                a.style.display = 'block';
+                a.style.width = '100%';
+                a.href = '#/' + encodePath(row.path);
+                a.textContent = row.kind === 'up' ? '\\u21B0' : '\\u{1F4C1} ' + row.name;
+                li.appendChild(a);
+            }
+            return li;
+        }
+        
+        // Only the rows in (and just around) the viewport exist in the DOM
+        function render() {
+            if (!rowHeight) {
+                container.appendChild(makeRow({ kind: 'up', path: '' }));
+                rowHeight = container.firstChild.getBoundingClientRect().height || 20;
+                rowHeight += 6;
+            }
+            const top = container.getBoundingClientRect().top;
+            const first = Math.max(0, Math.floor(-top / rowHeight) - 20);
+            const last = Math.min(rows.length, Math.ceil((window.innerHeight - top) / rowHeight) + 20);
+            const range = first + ':' + last;
+            if (range === shown) {
+                return;
+            }
+            shown = range;
+            const fragment = document.createDocumentFragment();
+            for (let i = first; i < last; i++) {
+                const li = makeRow(rows[i]);
+                li.style.top = (i * rowHeight) + 'px';
+                fragment.appendChild(li);
+            }
+            container.textContent = '';
+            container.appendChild(fragment);
+        }
+        
+        async function show() {
+            const path = location.hash.replace(/^#\\/?/, '').split('/').filter(Boolean).map(decodeURIComponent).join('/');
+            const shard = await loadShard(shardPrefix(path));
+            const listing = shard[path] || [[], []];
+            const parent = path.includes('/') ? path.slice(0, path.lastIndexOf('/')) : '';
+            const prefix = path ? path + '/' : '';
+            rows = [{ kind: 'up', path: parent }];
+            for (const [name, size, files, mtime] of listing[0]) {
+                const subtree = size === undefined ? null : { size: size, files: files, mtime: mtime };
+                rows.push({ kind: 'dir', name: name, path: prefix + name, subtree: subtree });
+            }
+            for (const [name, size, sha256] of listing[1]) {
+                rows.push({ kind: 'file', name: name, size: size, sha256: sha256, path: prefix + name });
+            }
+            document.getElementById('title').textContent = path ? path.slice(path.lastIndexOf('/') + 1) : ROOT_TITLE;
+            shown = '';
+            render();
+            container.style.height = (rows.length * rowHeight) + 'px';
+            window.scrollTo(0, 0);
+            render();
+        }
+        
+        let scheduled = false;
+        window.addEventListener('scroll', function() {
+            if (!scheduled) {
+                scheduled = true;
+                requestAnimationFrame(function() {
+                    scheduled = false;
+                    render();
+                });
+            }
+        });
+        window.addEventListener('resize', render);
+        window.addEventListener('hashchange', show);
+        show();
+    })();
+  </script>
+ </body>
+</html>"""
+
+def is_generated_file(filename, pages=()):
+    """Check whether a file is produced by this script and must stay out of listings. index.html and the
+    manifest, caches and temporary files are known by name; other pages (index-2.html, precompressed
+    variants, archive contents pages) only when the manifest records them as written, in `pages`
+    (see recorded_pages), so a file of the visitor's own by such a name stays listed and untouched"""
+    name = filename.strip().lower()
+    return (name == index_file_name or name in pages
+            or TEMP_FILE_RE.match(name) is not None or name.startswith(manifest_file_name)
+            or name.startswith(checksum_cache_file_name) or name.startswith(archive_cache_file_name))
+
+def is_page_name(filename):
+    """Whether a file is named like a page (or SHA256SUMS file) this script may write, which then must not
+    be a listed file"""
+    name = filename.lower()
+    return (PAGE_FILE_RE.match(name) is not None or ARCHIVE_PAGE_RE.match(name) is not None
+            or name == checksums_file_name.lower())
+
+# Line of the login template every encrypted page carries near its top, which tells the script's own
+# pages from a visitor's files by the same name when the manifest has no record of them
+PAGE_MARKER = b'// Encrypted page - AES-GCM'
+
+def is_own_page(path):
+    """Whether a page-named file is an encrypted page this script wrote, judged by the start of its login
+    page, plain, gzipped or brotli-compressed. Only needed for pages the manifest does not know of, after
+    it was lost or with another --manifest"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(4096)
+        if head.startswith(b'\x1f\x8b'):
+            # Partial input is fine: only the first few hundred bytes of the page matter
+            head = zlib.decompressobj(wbits=31).decompress(head)
+        elif path.lower().endswith(COMPRESSED_SUFFIXES['br']):
+            import brotli
+            head = brotli.Decompressor().process(head)
+    except Exception:
+        return False
+    return PAGE_MARKER in head
+
+def is_generated_entry(parentdir, filename, pages=()):
+    """is_generated_file() for a file in parentdir, which also recognises the script's own pages the manifest
+    has no record of by their content, so losing the manifest does not turn them into listed files"""
+    return is_generated_file(filename, pages) or (is_page_name(filename)
+                                                  and is_own_page(os.path.join(parentdir, filename)))
+
+def page_file_name(page):
+    """File name of the given 1-based listing page: index.html, index-2.html, ..."""
+    return index_file_name if page == 1 else f'index-{page}.html'
+
+def archive_page_name(name):
+    """File name of the contents page of an archive, next to it: data.zip.index.html"""
+    return f'{name}.{index_file_name}'
+
+@functools.lru_cache(maxsize=None)
+def asset_name(name):
+    """Content-hashed file name of a shared asset, e.g. listing.3f2a9c0e1b7d.css"""
+    stem, extension = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(ASSETS[name].encode("utf-8")).hexdigest()[:12]}{extension}'
+
+def root_url(rel_path):
+    """Relative URL of the top folder from the listing of rel_path"""
+    return '../' * (0 if rel_path == os.curdir else rel_path.count(os.sep) + 1)
+
+def asset_url(rel_path, name):
+    """Relative URL of a shared asset from the listing of rel_path"""
+    return f'{root_url(rel_path)}{support_dir_name}/assets/{asset_name(name)}'
+
+def listing_head(rel_path):
+    """Head of a listing, linking the shared stylesheet"""
+    return f' <link rel="stylesheet" href="{asset_url(rel_path, "listing.css")}">\n'
+
+def listing_page_count(dirs, files, page_size=None):
+    """Number of pages a listing is split into"""
+    if not page_size:
+        return 1
+    return max(1, -(-(len(dirs) + len(files)) // page_size))
+
+def subtree_summary(totals):
+    """Size, file count and newest change of a directory, as shown next to it in a listing"""
+    summary = f"{pretty_size(totals.size)}, {totals.files} {'file' if totals.files == 1 else 'files'}"
+    if totals.files:
+        summary += time.strftime(', %Y-%m-%d', time.gmtime(totals.mtime_ns // 1000000000))
+    return summary
+
+def iter_directory_listing(parentdir, dirs, files, file_filter=None, page=1, page_size=None, search='',
+                           subtrees=None, head=DIRECTORY_CSS, archives=None):
+    """Yield the HTML for a directory listing piece by piece, one entry at a time. head is what goes into
+    the page's <head>: the inline stylesheet, or a link to the shared one (see listing_head). Files named
+    in archives link their contents page too"""
+    # Walker output already carries sizes; bare file names still get stat'ed here
+    files = scan_files(parentdir, files, file_filter)
+    dirs = sorted(dirs)
+    page_count = listing_page_count(dirs, files, page_size)
+
+    if page_size:
+        # Directories come first, then files, cut into consecutive pages
+        start = (page - 1) * page_size
+        end = start + page_size
+        if isinstance(files, SpillSorter):
+            files = itertools.islice(files, max(0, start - len(dirs)), max(0, end - len(dirs)))
+        else:
+            files = files[max(0, start - len(dirs)):max(0, end - len(dirs))]
+        dirs = dirs[start:end]
+
+    yield f'''<!DOCTYPE html>
+<html>
+ <head>{head}</head>
+ <body>
+  <div class="content">
+   <h1>{os.path.basename(os.path.abspath(parentdir))}</h1>{search}
+   <li><a style="display:block; width:100%" href="../{index_file_name}">&#x21B0;</a></li>'''
+    
+    # Add directories - link to index.html in each subdirectory, with their recursive totals when known
+    subtrees = subtrees or {}
+    for dirname in dirs:
+        summary = f'<span class="size">{subtree_summary(subtrees[dirname])}</span>' if dirname in subtrees else ''
+        yield f'''
+   <li>{summary}<a style="display:block; width:100%" href="{dirname}/{index_file_name}">&#128193; {dirname}</a></li>'''
+    
+    # Add files, with their checksum when it is known
+    archives = archives or ()
+    for entry in files:
+        checksum = f'<code class="sha256">{entry.sha256}</code>' if entry.sha256 else ''
+        contents = (f' <a href="{archive_page_name(entry.name)}" title="Contents">&#x1F4E6;</a>'
+                    if entry.name in archives else '')
+        yield f'''
+   <li>&#x1f4c4; <a href="{entry.name}">{entry.name}</a>{contents}<span class="size">{pretty_size(entry.size)}</span>{checksum}</li>'''
+
+    if page_count > 1:
+        yield '''
+   <li style="text-align:center">'''
+        if page > 1:
+            yield f'<a href="{page_file_name(1)}">&laquo;</a> <a href="{page_file_name(page - 1)}">&lsaquo; prev</a> '
+        yield f'page {page} of {page_count}'
+        if page < page_count:
+            yield f' <a href="{page_file_name(page + 1)}">next &rsaquo;</a> <a href="{page_file_name(page_count)}">&raquo;</a>'
+        yield '</li>'
+    
+    yield '''
+  </div>
+ </body>
+</html>'''
+
+def generate_directory_listing(parentdir, dirs, files, file_filter=None, page=1, page_size=None, search='',
+                               subtrees=None, head=DIRECTORY_CSS, archives=None):
+    """Generate HTML for directory listing"""
+    return ''.join(iter_directory_listing(parentdir, dirs, files, file_filter, page, page_size, search, subtrees,
+                                          head, archives))
+
+def generate_archive_listing(name, entries, more=False, head=DIRECTORY_CSS):
+    """Generate HTML for the contents page of an archive: its (name, size) entries, size None for folders.
+    Entry names come from the archive itself, so unlike file names they are escaped"""
+    rows = []
+    for entry_name, size in entries:
+        if size is None:
+            rows.append(f'''
+   <li>&#128193; {html.escape(entry_name)}</li>''')
+        else:
+            rows.append(f'''
+   <li>&#x1f4c4; {html.escape(entry_name)}<span class="size">{pretty_size(size)}</span></li>''')
+    if more:
+        rows.append(f'''
+   <li style="text-align:center">first {len(entries)} entries shown</li>''')
+    return f'''<!DOCTYPE html>
+<html>
+ <head>{head}</head>
+ <body>
+  <div class="content">
+   <h1>{name}</h1>
+   <li><a style="display:block; width:100%" href="{index_file_name}">&#x21B0;</a></li>{''.join(rows)}
+  </div>
+ </body>
+</html>'''
+
+class PageCipher:
+    """AES-GCM page encryption under one key, derived from the password once per run"""
+
+    def __init__(self, password, salt, iterations=KDF_ITERATIONS, key=None):
+        self.salt = salt
+        self.iterations = iterations
+        # Same PBKDF2 parameters as the browser's WebCrypto deriveBits call
+        self.key = key or hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+        self.nonce_key = hmac.new(self.key, b'page-nonce', hashlib.sha256).digest()
+        # Identifies the key in the manifest so a new password re-renders everything
+        self.key_id = hmac.new(self.key, b'key-id', hashlib.sha256).hexdigest()[:16]
+
+    def encrypt(self, data):
+        """Encrypt bytes as nonce || ciphertext || tag"""
+        # The nonce is derived from the content (as in SIV), so unchanged pages encrypt to
+        # identical bytes and a nonce can only repeat together with its plaintext
+        nonce = hmac.new(self.nonce_key, data, hashlib.sha256).digest()[:12]
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return nonce + ciphertext + tag
+
+    def encrypt_stream(self, make_chunks):
+        """encrypt() for data too large to hold in memory, given as a function returning an iterator over
+        its chunks. The data is produced twice: once to derive the nonce, once to encrypt it"""
+        mac = hmac.new(self.nonce_key, digestmod=hashlib.sha256)
+        for chunk in make_chunks():
+            mac.update(chunk)
+        nonce = mac.digest()[:12]
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        yield nonce
+        for chunk in make_chunks():
+            yield cipher.encrypt(chunk)
+        yield cipher.digest()
+
+    def subkey(self, label):
+        """Independent cipher for data whose key travels inside an encrypted page"""
+        key = hmac.new(self.key, b'subkey:' + label.encode('utf-8'), hashlib.sha256).digest()
+        return PageCipher(None, self.salt, self.iterations, key=key)
+
+    def decrypt(self, blob):
+        """Reverse encrypt(), raising ValueError if the data was not encrypted under this key"""
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=blob[:12])
+        return cipher.decrypt_and_verify(blob[12:-16], blob[-16:])
+
+def open_manifest(path):
+    """Open the incremental manifest, creating its tables on first use"""
+    db = sqlite3.connect(path)
+    db.execute('''CREATE TABLE IF NOT EXISTS dirs (
+        path TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        entries TEXT NOT NULL,
+        options TEXT NOT NULL,
+        run INTEGER NOT NULL)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS pages (
+        path TEXT PRIMARY KEY,
+        dir TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        encoding TEXT)''')
+    # Manifests written before directories carried recursive totals
+    columns = [row[1] for row in db.execute('PRAGMA table_info(dirs)')]
+    for column in ('tree_size', 'tree_files', 'tree_mtime_ns'):
+        if column not in columns:
+            db.execute(f'ALTER TABLE dirs ADD COLUMN {column} INTEGER')
+    # Manifests written before runs could be resumed
+    if 'stamp' not in columns:
+        db.execute('ALTER TABLE dirs ADD COLUMN stamp TEXT')
+    # Manifests written before pages could be precompressed
+    if 'encoding' not in [row[1] for row in db.execute('PRAGMA table_info(pages)')]:
+        db.execute('ALTER TABLE pages ADD COLUMN encoding TEXT')
+    db.execute('CREATE INDEX IF NOT EXISTS pages_dir ON pages (dir)')
+    db.execute('''CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started REAL NOT NULL,
+        finished REAL)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS settings (
+        name TEXT PRIMARY KEY,
+        value TEXT NOT NULL)''')
+    db.execute('''CREATE TABLE IF NOT EXISTS published (
+        dest TEXT NOT NULL,
+        key TEXT NOT NULL,
+        signature TEXT NOT NULL,
+        PRIMARY KEY (dest, key))''')
+    # File rows of listings too wide to keep as JSON in dirs.entries
+    db.execute('''CREATE TABLE IF NOT EXISTS spilled_files (
+        dir TEXT NOT NULL,
+        name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        PRIMARY KEY (dir, name))''')
+    # Manifests written before files carried checksums
+    if 'sha256' not in [row[1] for row in db.execute('PRAGMA table_info(spilled_files)')]:
+        db.execute('ALTER TABLE spilled_files ADD COLUMN sha256 TEXT')
+    # Search index: every listed path under a stable id with the posting shards its name
+    # appears in (one byte each), and the shards that need rewriting
+    db.execute('''CREATE TABLE IF NOT EXISTS search_paths (
+        id INTEGER PRIMARY KEY,
+        dir TEXT NOT NULL,
+        name TEXT NOT NULL,
+        size INTEGER,
+        buckets BLOB NOT NULL,
+        UNIQUE (dir, name))''')
+    db.execute('''CREATE TABLE IF NOT EXISTS search_dirty (
+        shard TEXT PRIMARY KEY)''')
+    return db
+
+def recorded_pages(db, rel_path):
+    """Lower-cased names of the pages the manifest records as written into a directory"""
+    return frozenset(key.rsplit('/', 1)[-1].lower()
+                     for key, in db.execute('SELECT path FROM pages WHERE dir = ?', (rel_path,)))
+
+def manifest_salt(db):
+    """KDF salt of this tree, created on first use and kept so pages stay byte-stable across runs"""
+    row = db.execute("SELECT value FROM settings WHERE name = 'salt'").fetchone()
+    if row:
+        return bytes.fromhex(row[0])
+    salt = secrets.token_bytes(16)
+    db.execute("INSERT INTO settings (name, value) VALUES ('salt', ?)", (salt.hex(),))
+    return salt
+
+class SpillSorter:
+    """Sort an unbounded sequence of rows (names or FileEntry tuples) in bounded memory: rows are
+    buffered, written to temporary files as sorted runs once the buffer is full, and merged back
+    on every iteration, so the sorted rows can be read as often as needed"""
+
+    def __init__(self, row_type=None, limit=None):
+        self.row_type = row_type
+        self.limit = limit or LISTING_BUFFER_ROWS
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+
+    def add(self, row):
+        self.buffer.append(row)
+        self.count += 1
+        if len(self.buffer) >= self.limit:
+            self.buffer.sort()
+            fd, path = tempfile.mkstemp(prefix='indexpage-', suffix='.run')
+            self.runs.append(path)
+            with os.fdopen(fd, 'w', encoding='utf-8') as run:
+                for row in self.buffer:
+                    run.write(json.dumps(row, ensure_ascii=False))
+                    run.write('\n')
+            self.buffer = []
+
+    def __len__(self):
+        return self.count
+
+    def read_run(self, path):
+        with open(path, encoding='utf-8') as run:
+            for line in run:
+                row = json.loads(line)
+                yield self.row_type(*row) if self.row_type else row
+
+    def __iter__(self):
+        self.buffer.sort()
+        return heapq.merge(self.buffer, *(self.read_run(path) for path in self.runs))
+
+    def close(self):
+        for path in self.runs:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.runs = []
+        self.buffer = []
+
+def glob_regex(pattern):
+    """Regular expression for a glob in which * and ? stay within one path component and ** spans any number"""
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif pattern[i] == '[':
+            # A ] right after [ or [! is part of the set, as in fnmatch
+            j = i + 1
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                parts.append(re.escape('['))
+                i += 1
+                continue
+            chars = pattern[i + 1:j].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^/' + chars[1:]
+            elif chars.startswith('^'):
+                chars = '\\' + chars
+            parts.append(f'[{chars}]')
+            i = j + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(parts)
+
+class PathMatcher:
+    """--include, --exclude and ignore file patterns, compiled once into a few regular expressions.
+    Patterns follow .gitignore: one with a slash (other than a trailing one) is matched against the
+    path below the top folder, any other against the name at every depth, and a trailing slash only
+    matches directories. Includes only select files; excluded directories are pruned from the walk"""
+
+    def __init__(self, top_dir, include=(), exclude=()):
+        self.top_dir = os.path.abspath(top_dir)
+        self.patterns = {'include': list(include), 'exclude': list(exclude)}
+        self.include = self.compile(include) if include else None
+        self.exclude_files = self.compile(pattern for pattern in exclude if not pattern.endswith('/'))
+        self.exclude_dirs = self.compile(pattern.rstrip('/') for pattern in exclude)
+        # Entries left out, reported by --stats
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def compile(patterns):
+        """One (name regex, path regex) pair for a list of patterns, either None if no pattern needs it"""
+        names, paths = [], []
+        for pattern in patterns:
+            if '/' in pattern:
+                paths.append(glob_regex(pattern.lstrip('/')))
+            else:
+                names.append(glob_regex(pattern))
+        # Match case the way fnmatch would on this platform
+        flags = re.IGNORECASE if os.path.normcase('A') == 'a' else 0
+        return tuple(re.compile(f'(?:{"|".join(group)})\\Z', flags) if group else None for group in (names, paths))
+
+    @staticmethod
+    def matches(compiled, prefix, name):
+        names, paths = compiled
+        return bool((names and names.match(name)) or (paths and paths.match(prefix + name)))
+
+    def prefix(self, parentdir):
+        """Path of a directory below the top folder, as patterns see it: '' or 'a/b/'"""
+        rel_path = os.path.relpath(os.path.abspath(parentdir), self.top_dir)
+        return '' if rel_path == os.curdir else rel_path.replace(os.sep, '/') + '/'
+
+    def skips(self, prefix, name, is_dir):
+        """Whether an entry of the directory at prefix is left out of its listing"""
+        if is_dir:
+            return self.matches(self.exclude_dirs, prefix, name)
+        return (self.matches(self.exclude_files, prefix, name)
+                or (self.include is not None and not self.matches(self.include, prefix, name)))
+
+def path_matcher(top_dir, opts):
+    """Compile --filter, --include, --exclude and the ignore file into one PathMatcher"""
+    include = list(opts.include or ())
+    if opts.filter:
+        include.append(opts.filter)
+    exclude = list(opts.exclude or ())
+    ignore_file = opts.ignore_file or os.path.join(top_dir, ignore_file_name)
+    try:
+        with open(ignore_file, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    exclude.append(line)
+    except FileNotFoundError:
+        if opts.ignore_file:
+            raise SystemExit(f'***ERROR*** ignore file {opts.ignore_file} does not exist')
+
+    # Output placed inside the tree must neither be listed nor walked into
+    for output in filter(None, (opts.output, opts.output_tar, opts.output_tar and opts.output_tar + '.part')):
+        rel_path = os.path.relpath(os.path.abspath(output), os.path.abspath(top_dir))
+        if rel_path != os.curdir and not rel_path.startswith(os.pardir + os.sep):
+            exclude.append('/' + re.sub(r'([*?[])', r'[\1]', rel_path.replace(os.sep, '/')))
+    return PathMatcher(top_dir, include, exclude)
+
+def scan_dir(parentdir, is_top_level=False, matcher=None):
+    """Read one directory, returning (dirs, file DirEntry objects, subdirectories to descend into).
+    Entries the matcher skips are left out, and excluded directories are not descended into. The script's
+    own files are kept whatever the patterns say, for the clean-up of stale pages; the listing drops them"""
+    dirs, files, descend = [], [], []
+    prefix = matcher.prefix(parentdir) if matcher else ''
+    skipped = Counter()
+    with os.scandir(parentdir) as it:
+        for entry in it:
+            if is_top_level and entry.name == support_dir_name:
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if (matcher and matcher.skips(prefix, entry.name, is_dir)
+                    and (is_dir or not is_generated_entry(parentdir, entry.name))):
+                skipped['dirs_pruned' if is_dir else 'files_excluded'] += 1
+                continue
+            if is_dir:
+                dirs.append(entry.name)
+                # Like os.walk, list symlinked directories but don't follow them
+                if not entry.is_symlink():
+                    descend.append(entry.path)
+            elif isinstance(files, SpillSorter):
+                files.add(entry.name)
+            else:
+                files.append(entry)
+                if len(files) > LISTING_BUFFER_ROWS:
+                    # Too wide to keep DirEntry objects around: keep (spilled) names, stat'ed later
+                    names = SpillSorter()
+                    for file in files:
+                        names.add(file.name)
+                    files = names
+    if skipped:
+        # Directories may be read on several threads at once
+        with matcher.lock:
+            matcher.counts.update(skipped)
+    return dirs, files, descend
+
+def walk_ahead(read, report, top, pool=None, ahead=0):
+    """The bottom-up walk behind walk_tree() and walk_bucket(): read(node) returns (listing, child nodes),
+    and failures are passed to report(node, error), which returns a listing to yield in the node's place,
+    or None to leave the node out. Yields (node, listing) with
+    every node after everything below it. With a pool, the nodes next in line are read on it, up to
+    `ahead` of them, so reads that mostly wait on the network overlap"""
+    reading = {}
+    stack = [(top, None)]
+    try:
+        while stack:
+            node, listing = stack.pop()
+            if listing is not None:
+                yield node, listing
+                continue
+            future = reading.pop(node, None)
+            try:
+                listing, children = future.result() if future else read(node)
+            except Exception as e:
+                listing = report(node, e)
+                if listing is not None:
+                    yield node, listing
+                continue
+
+            # Revisited once all children are done
+            stack.append((node, listing))
+            stack.extend((child, None) for child in reversed(children))
+            if pool is None:
+                continue
+            # The nodes on top of the stack are the next ones to be walked
+            for next_node, next_listing in itertools.islice(reversed(stack), 2 * ahead):
+                if len(reading) >= ahead:
+                    break
+                if next_listing is None and next_node not in reading:
+                    reading[next_node] = pool.submit(read, next_node)
+    finally:
+        for future in reading.values():
+            future.cancel()
+
+def walk_tree(top_dir, matcher=None, pool=None, ahead=0):
+    """Walk the tree like os.walk(topdown=False): every directory comes after everything below it, so
+    recursive totals can be summed up on the way. File DirEntry objects are yielded so their stat can be
+    reused. With a pool, up to `ahead` directories are read ahead of the walk"""
+    def read(parentdir):
+        dirs, files, descend = scan_dir(parentdir, parentdir == top_dir, matcher)
+        return (dirs, files), sorted(descend)
+
+    def report(parentdir, e):
+        if not isinstance(e, OSError):
+            raise e
+        print(f'ERROR reading directory {parentdir}: {e}')
+
+    for parentdir, (dirs, files) in walk_ahead(read, report, top_dir, pool, ahead):
+        yield parentdir, dirs, files
+
+def scan_files(parentdir, files, file_filter=None, errors=None, checksums=None, pool=None, ahead=0, generated=()):
+    """Turn DirEntry objects (or bare names) into sorted FileEntry rows, skipping generated and filtered files;
+    generated holds the pages the manifest records for the directory; pages of the script it has no
+    record of are told by their content (see is_generated_entry).
+    Spilled names give a SpillSorter of rows, so wide directories never sit in memory as a whole.
+    With a ChecksumCache, rows also carry the SHA-256 of the file. With a pool, files are stat'ed on it
+    in batches, up to `ahead` batches at a time, so a wide directory on a slow mount is not stat'ed one
+    file after another"""
+    if isinstance(files, SpillSorter):
+        if files.row_type is FileEntry and not generated:
+            return files
+        rows = SpillSorter(FileEntry)
+    else:
+        rows = []
+
+    def stat_batch(batch):
+        results = []
+        for file in batch:
+            try:
+                # DirEntry.stat() is cached and costs no syscall at all on Windows
+                results.append(os.stat(os.path.join(parentdir, file)) if isinstance(file, str) else file.stat())
+            except OSError as e:
+                results.append(e)
+        return batch, results
+
+    def batches():
+        batch = []
+        for file in files:
+            if isinstance(file, FileEntry):
+                if not is_generated_file(file.name, generated):
+                    rows.add(file) if isinstance(rows, SpillSorter) else rows.append(file)
+                continue
+            filename = file if isinstance(file, str) else file.name
+            if is_generated_entry(parentdir, filename, generated):
+                continue
+            if file_filter and not fnmatch.fnmatch(filename, file_filter):
+                continue
+            batch.append(file)
+            if len(batch) == STAT_BATCH:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def stat_ahead():
+        pending = deque()
+        try:
+            for batch in batches():
+                pending.append(pool.submit(stat_batch, batch))
+                if len(pending) >= ahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def statted():
+        for batch, stats in (stat_ahead() if pool is not None else map(stat_batch, batches())):
+            for file, st in zip(batch, stats):
+                filename = file if isinstance(file, str) else file.name
+                if isinstance(st, OSError):
+                    message = f'ERROR reading file {filename}: {st}'
+                    if errors is None:
+                        print(message)
+                    else:
+                        errors.append(message)
+                    continue
+                yield filename, st
+
+    if checksums is not None:
+        new_rows = checksums.rows(parentdir, statted(), errors)
+    else:
+        new_rows = (FileEntry(filename, st.st_size, st.st_mtime_ns) for filename, st in statted())
+    for row in new_rows:
+        if isinstance(rows, SpillSorter):
+            rows.add(row)
+        else:
+            rows.append(row)
+    if isinstance(rows, list):
+        rows.sort()
+    return rows
+
+def listing_signature(dirs, file_rows, opts, cipher, subtrees=None):
+    """Describe everything a listing depends on, returning (digest, entries, options) for the manifest.
+    Spilled file rows are hashed as a stream and left out of the entries; the manifest keeps them in
+    the spilled_files table instead"""
+    subtrees = subtrees or {}
+    spilled = isinstance(file_rows, SpillSorter)
+    entries = json.dumps({'dirs': sorted(dirs), 'files': None if spilled else file_rows,
+                          'subtrees': {name: subtrees[name] for name in sorted(subtrees)}},
+                         ensure_ascii=False, separators=(',', ':'))
+    options = listing_options(opts, cipher)
+    digest = hashlib.sha256(f'{options}\n{entries}'.encode('utf-8'))
+    if spilled:
+        for row in file_rows:
+            digest.update(json.dumps(row, ensure_ascii=False).encode('utf-8'))
+            digest.update(b'\n')
+    return digest.hexdigest(), entries, options
+
+def listing_options(opts, cipher):
+    """The options every listing of a run is rendered with, as recorded in the manifest"""
+    return json.dumps({'filter': opts.matcher.patterns, 'page_size': opts.page_size, 'footer': opts.footer, 'mode': opts.mode,
+                       'search': opts.search, 'sha256sums': opts.sha256sums, 'archives': opts.archive_contents,
+                       'precompress': sorted(opts.precompress or ()), 'compressed': opts.compressed_pages,
+                       'key': cipher.key_id, 'iterations': cipher.iterations, 'template': TEMPLATE_VERSION},
+                      sort_keys=True, separators=(',', ':'))
+
+def dir_stamp(parentdir):
+    """mtime of a directory, which moves whenever an entry is added, removed or renamed; None once it is gone"""
+    try:
+        return os.stat(parentdir).st_mtime_ns
+    except OSError:
+        return None
+
+def listing_stamp(dirs, files, generated=()):
+    """Digest of the entries a directory listed, leaving out the script's own files (see is_generated_file),
+    which lets --resume see that an entry was added, removed or renamed without stat'ing anything. Pages
+    written next to the files do not change it, unlike the directory's mtime. Rows listed from a bucket
+    carry their size and mtime already, so a rewritten object shows up too; a local file rewritten in
+    place does not"""
+    digest = hashlib.sha256()
+    for name in sorted(dirs):
+        digest.update(os.fsencode(name) + b'/\0')
+    # Spilled listings come back sorted already, and are too wide to sort in memory
+    if not isinstance(files, SpillSorter):
+        files = sorted(files, key=lambda file: file if isinstance(file, str) else file.name)
+    for file in files:
+        name = file if isinstance(file, str) else file.name
+        if is_generated_file(name, generated):
+            continue
+        digest.update(os.fsencode(name) + b'\0')
+        if isinstance(file, FileEntry):
+            digest.update(f'{file.size}:{file.mtime_ns}\0'.encode('ascii'))
+    return digest.hexdigest()
+
+def listing_files(db, rel_path, entries):
+    """File rows of a recorded listing, from its entries or, for wide directories, streamed from spilled_files"""
+    if entries['files'] is not None:
+        # Listings recorded before checksums have no sha256 column
+        return [FileEntry(*row) for row in entries['files']]
+    return db.execute('SELECT name, size, mtime_ns, sha256 FROM spilled_files WHERE dir = ? ORDER BY name',
+                      (rel_path,))
+
+def login_template(cipher, opts, rel_path=os.curdir):
+    """Login page for the listing of rel_path with everything but the encrypted content filled in"""
+    login_html = SIMPLE_LOGIN_TEMPLATE
+    for name in ('login.css', 'login.js', 'skyline.js'):
+        login_html = login_html.replace(f'{{{{ {name.replace(".", "_")} }}}}', asset_url(rel_path, name))
+    login_html = login_html.replace('{{ salt }}', base64.b64encode(cipher.salt).decode('ascii'))
+    login_html = login_html.replace('{{ iterations }}', str(cipher.iterations))
+    login_html = login_html.replace('{{ footer_text }}', opts.footer or "(c) Sourav Mishra")
+    return login_html
+
+def render_login_page(content, cipher, opts, rel_path=os.curdir):
+    """Wrap the listing of rel_path in the password-protected login page"""
+    compressed = gzip.compress(content.encode('utf-8'), compresslevel=9, mtime=0)
+    encrypted_content = base64.b64encode(cipher.encrypt(compressed)).decode('ascii')
+    
+    # Create login page with embedded content
+    return login_template(cipher, opts, rel_path).replace('{{ encrypted_content }}', encrypted_content)
+
+def stream_blocks(chunks, size=STREAM_BLOCK_SIZE):
+    """Regroup a stream of small str or bytes chunks into bytes blocks of about `size` bytes"""
+    block, length = [], 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        block.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield b''.join(block)
+            block, length = [], 0
+    if block:
+        yield b''.join(block)
+
+def gzip_stream(chunks):
+    """gzip.compress(data, compresslevel=9, mtime=0) over a stream of bytes blocks"""
+    # zlib writes the gzip header (mtime 0) and trailer itself, as gzip.compress does for mtime=0
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    for block in chunks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def base64_stream(chunks):
+    """Base64 of a stream of bytes blocks, identical to encoding their concatenation"""
+    rest = b''
+    for chunk in chunks:
+        data = rest + chunk
+        cut = len(data) - len(data) % 3
+        if cut:
+            yield base64.b64encode(data[:cut])
+        rest = data[cut:]
+    yield base64.b64encode(rest)
+
+def stream_login_page(make_content, cipher, opts, rel_path=os.curdir):
+    """render_login_page() for listings too large to hold in memory: make_content returns an iterator
+    over the listing's HTML, which is consumed twice (see PageCipher.encrypt_stream)"""
+    head, tail = login_template(cipher, opts, rel_path).split('{{ encrypted_content }}')
+    yield head.encode('utf-8')
+    yield from base64_stream(cipher.encrypt_stream(lambda: gzip_stream(stream_blocks(make_content()))))
+    yield tail.encode('utf-8')
+
+class RunStats:
+    """Per-phase wall and CPU time, counters and slowest directories of a run, shared by all worker threads"""
+
+    def __init__(self, slowest=10):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = Counter()
+        self.slowest = []
+        self.slowest_size = slowest
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.wall = self.cpu = None
+
+    @contextmanager
+    def phase(self, name):
+        """Time a block of work, in wall time and in CPU time of the calling thread"""
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            with self.lock:
+                totals = self.phases.setdefault(name, [0.0, 0.0, 0])
+                totals[0] += wall
+                totals[1] += cpu
+                totals[2] += 1
+
+    def timed(self, name, iterable):
+        """Iterate while charging the time spent producing each item to a phase"""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def directory(self, path, seconds):
+        """Remember a directory if it is among the slowest so far"""
+        with self.lock:
+            if len(self.slowest) < self.slowest_size:
+                heapq.heappush(self.slowest, (seconds, path))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, path))
+
+    def finish(self):
+        self.wall = time.perf_counter() - self.started
+        self.cpu = time.process_time() - self.cpu_started
+
+    def as_dict(self):
+        return {
+            'wall_seconds': self.wall,
+            'cpu_seconds': self.cpu,
+            'peak_rss_bytes': peak_rss(),
+            'phases': {name: {'wall_seconds': wall, 'cpu_seconds': cpu, 'calls': calls}
+                       for name, (wall, cpu, calls) in self.phases.items()},
+            'counters': dict(self.counters),
+            'slowest_dirs': [{'path': path, 'seconds': seconds}
+                             for seconds, path in sorted(self.slowest, reverse=True)],
+        }
+
+    def print_summary(self):
+        print(f"{'phase':<12}{'wall (s)':>11}{'cpu (s)':>11}{'calls':>10}")
+        for name, (wall, cpu, calls) in sorted(self.phases.items(), key=lambda item: -item[1][0]):
+            print(f'{name:<12}{wall:>11.3f}{cpu:>11.3f}{calls:>10}')
+        rss = peak_rss()
+        print(f'run: {self.wall:.3f}s wall, {self.cpu:.3f}s CPU'
+              + (f', peak RSS {pretty_size(rss)}' if rss else '')
+              + ' (phase times are summed over worker threads)')
+        print(', '.join(f'{name.replace("_", " ")}: {value}' for name, value in sorted(self.counters.items())))
+        if self.slowest:
+            print('slowest directories:')
+            for seconds, path in sorted(self.slowest, reverse=True):
+                print(f'  {seconds:8.3f}s  {path}')
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, where the platform reports it"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class DirResult:
+    """Outcome of processing one directory, handed back to the main thread in walk order"""
+
+    def __init__(self, parentdir, rel_path):
+        self.parentdir = parentdir
+        self.rel_path = rel_path
+        self.status = 'failed'
+        self.messages = []
+        self.errors = []
+        self.digest = self.entries = self.options = None
+        # listing_stamp() of the entries the directory listed, which lets --resume trust the listing
+        self.stamp = None
+        # SubtreeTotals of everything below this directory, once its files were read
+        self.subtree = None
+        # SpillSorter of a wide directory's file rows, stored in the manifest by the main thread
+        self.spilled_rows = None
+        self.pages = []
+        self.pages_written = self.pages_skipped = 0
+        # Content-Encoding -> [uncompressed bytes, compressed bytes]
+        self.compression = {}
+
+    def release(self):
+        """Drop everything but the totals once the result is recorded"""
+        if self.spilled_rows is not None:
+            self.spilled_rows.close()
+        self.spilled_rows = self.entries = None
+        self.pages = []
+
+def counted(chunks, sizes, index):
+    """Pass chunks through, adding their total length to sizes[index]"""
+    for chunk in chunks:
+        sizes[index] += len(chunk)
+        yield chunk
+
+def write_variants(rel_dir, name, html, opts, stats, result):
+    """Write a rendered page and its precompressed variants to the output target, recording them in a
+    DirResult. html is either the page's bytes or, for streamed listings, a function returning an
+    iterator over them"""
+    if callable(html):
+        return write_streamed_variants(rel_dir, name, html, opts, stats, result)
+
+    variants = []
+    if opts.compressed_pages:
+        # The page itself is stored gzipped, to be served with Content-Encoding: gzip
+        variants.append((name, 'gzip'))
+    else:
+        variants.append((name, None))
+    for encoding in opts.precompress or ():
+        variants.append((name + COMPRESSED_SUFFIXES[encoding], encoding))
+
+    for variant, encoding in variants:
+        if encoding:
+            with stats.phase('compress'):
+                data = compress_page(html, encoding)
+            sizes = result.compression.setdefault(encoding, [0, 0])
+            sizes[0] += len(html)
+            sizes[1] += len(data)
+        else:
+            data = html
+
+        with stats.phase('write'):
+            changed, digest = opts.target.write(rel_dir, variant, [data])
+        result.pages.append((variant, digest, encoding))
+        if changed:
+            stats.count('bytes_written', len(data))
+            result.pages_written += 1
+        else:
+            result.pages_skipped += 1
+        if opts.verbose:
+            path = opts.target.path(rel_dir, variant)
+            result.messages.append(f'Created encrypted: {path}' if changed else f'Unchanged encrypted: {path}')
+
+def write_streamed_variants(rel_dir, name, make_html, opts, stats, result):
+    """write_variants() for pages too large to hold in memory: every variant renders, encrypts and
+    compresses the page again on the fly"""
+    variants = [(name, 'gzip' if opts.compressed_pages else None)]
+    variants.extend((name + COMPRESSED_SUFFIXES[encoding], encoding) for encoding in opts.precompress or ())
+
+    for variant, encoding in variants:
+        sizes = [0, 0]
+        data = counted(make_html(), sizes, 0)
+        if encoding:
+            data = compress_stream(data, encoding)
+        # Rendering, encryption, compression and writing are interleaved, so they are timed as one phase
+        with stats.phase('stream'):
+            changed, digest = opts.target.write(rel_dir, variant, counted(data, sizes, 1))
+        if encoding:
+            total = result.compression.setdefault(encoding, [0, 0])
+            total[0] += sizes[0]
+            total[1] += sizes[1]
+        result.pages.append((variant, digest, encoding))
+        if changed:
+            stats.count('bytes_written', sizes[1])
+            result.pages_written += 1
+        else:
+            result.pages_skipped += 1
+        if opts.verbose:
+            path = opts.target.path(rel_dir, variant)
+            result.messages.append(f'Created encrypted: {path}' if changed else f'Unchanged encrypted: {path}')
+
+def process_one_dir(top_dir, parentdir, dirs, files, subtrees, cipher, opts, stored_digest, stats, resumed=None,
+                    generated=()):
+    """Stat, render and write the index of a single directory; safe to run on a worker thread.
+    subtrees maps subdirectory names to their SubtreeTotals, as far as they are known. resumed is the
+    (stamp, SubtreeTotals) of a listing the interrupted run being resumed already finished, and generated
+    the pages the manifest records for the directory"""
+    started = time.perf_counter()
+    result = None
+    try:
+        result = _process_one_dir(top_dir, parentdir, dirs, files, subtrees, cipher, opts, stored_digest, stats,
+                                  resumed, generated)
+        return result
+    finally:
+        # Rows listed from a bucket arrive spilled already, and are still needed for the manifest
+        if isinstance(files, SpillSorter) and (result is None or files is not result.spilled_rows):
+            files.close()
+        stats.directory(parentdir, time.perf_counter() - started)
+
+def _process_one_dir(top_dir, parentdir, dirs, files, subtrees, cipher, opts, stored_digest, stats, resumed=None,
+                     generated=()):
+    rel_path = os.path.relpath(parentdir, top_dir)
+    result = DirResult(parentdir, rel_path)
+
+    # Skip if directory is not writable
+    if not opts.dryrun and not opts.target.writable(rel_path):
+        result.errors.append(f"***ERROR*** folder {parentdir} is not writable! SKIPPING!")
+        return result
+
+    with stats.phase('stat'):
+        result.stamp = listing_stamp(dirs, files, generated)
+    # Done before the interruption, and no file came or went since: none of its files is stat'ed again
+    if (resumed is not None and result.stamp == resumed[0]
+            and (opts.mode == 'spa' or opts.target.exists(rel_path, index_file_name))):
+        result.status = 'resumed'
+        result.subtree = resumed[1]
+        if opts.verbose:
+            result.messages.append(f'Resumed directory: {parentdir}')
+        return result
+
+    with stats.phase('stat'):
+        # Filtering happened while the directory was read (see PathMatcher)
+        file_rows = scan_files(parentdir, files, errors=result.errors, checksums=opts.checksum_cache,
+                               pool=opts.io_pool, ahead=2 * opts.list_jobs, generated=generated)
+        result.digest, result.entries, result.options = listing_signature(dirs, file_rows, opts, cipher, subtrees)
+    stats.count('entries_statted', len(file_rows))
+    if isinstance(file_rows, SpillSorter):
+        result.spilled_rows = file_rows
+
+    # The one stat per file above is all the totals need; subdirectories were summed up before.
+    # Listed files named like pages are the visitor's own, and are never written over
+    size = newest = 0
+    listed_pages = set()
+    for row in file_rows:
+        size += row.size
+        newest = max(newest, row.mtime_ns)
+        if is_page_name(row.name):
+            listed_pages.add(row.name.lower())
+    result.subtree = SubtreeTotals(
+        size + sum(totals.size for totals in subtrees.values()),
+        len(file_rows) + sum(totals.files for totals in subtrees.values()),
+        max([newest] + [totals.mtime_ns for totals in subtrees.values()]))
+
+    # In SPA mode only the top folder gets a page, written by write_spa
+    if (opts.incremental and stored_digest == result.digest
+            and (opts.mode == 'spa' or opts.target.exists(rel_path, index_file_name))):
+        result.status = 'unchanged'
+        if opts.verbose:
+            result.messages.append(f'Unchanged directory: {parentdir}')
+        return result
+
+    if opts.verbose:
+        result.messages.append(f'Processing directory: {parentdir}')
+    
+    result.status = 'rendered'
+    if opts.mode == 'spa':
+        page_count = 1 if rel_path == os.curdir else 0
+    else:
+        page_count = listing_page_count(dirs, file_rows, opts.page_size)
+    if opts.dryrun:
+        # Render into the void so a dry run exercises the same code path
+        if opts.mode != 'spa':
+            for page in range(1, page_count + 1):
+                deque(iter_directory_listing(parentdir, dirs, file_rows, page=page, page_size=opts.page_size,
+                                             subtrees=subtrees), maxlen=0)
+        return result
+
+    def clash(name):
+        """A listed file that a page, or one of its precompressed variants, would overwrite"""
+        for variant in [name] + [name + COMPRESSED_SUFFIXES[encoding] for encoding in opts.precompress or ()]:
+            if variant.lower() in listed_pages:
+                return variant
+        return None
+
+    # Archives get a page of their contents, linked from their row in the listing
+    archives = set()
+    if opts.archive_cache is not None:
+        for row in file_rows:
+            if not row.name.lower().endswith(ARCHIVE_SUFFIXES):
+                continue
+            if clash(archive_page_name(row.name)):
+                result.errors.append(f'Cannot create contents page of {os.path.join(parentdir, row.name)}: '
+                                     f'{clash(archive_page_name(row.name))} is a listed file')
+                continue
+            try:
+                with stats.phase('peek'):
+                    entries, more = opts.archive_cache.entries(os.path.join(parentdir, row.name))
+                with stats.phase('render'):
+                    content = generate_archive_listing(row.name, entries, more, head=listing_head(rel_path))
+                with stats.phase('encrypt'):
+                    html = render_login_page(content, cipher, opts, rel_path).encode('utf-8')
+                stats.count('pages_rendered')
+                write_variants(rel_path, archive_page_name(row.name), html, opts, stats, result)
+            except Exception as e:
+                result.errors.append(f'ERROR reading archive {os.path.join(parentdir, row.name)}: {e}')
+                continue
+            archives.add(row.name)
+
+    # Pages of a spilled listing that hold more than the buffer are streamed from disk
+    stream = (isinstance(file_rows, SpillSorter)
+              and not (opts.page_size and opts.page_size <= LISTING_BUFFER_ROWS))
+    for page in range(1, page_count + 1) if opts.mode != 'spa' else ():
+        if clash(page_file_name(page)):
+            result.errors.append(f'Cannot create file {os.path.join(parentdir, page_file_name(page))}: '
+                                 f'{clash(page_file_name(page))} is a listed file')
+            result.status = 'failed'
+            return result
+        try:
+            if stream:
+                def make_html(page=page):
+                    return stream_login_page(
+                        lambda: iter_directory_listing(parentdir, dirs, file_rows, page=page, page_size=opts.page_size,
+                                                       search=search_box(cipher, rel_path, opts), subtrees=subtrees,
+                                                       head=listing_head(rel_path), archives=archives),
+                        cipher, opts, rel_path)
+                stats.count('pages_rendered')
+                stats.count('pages_streamed')
+                write_variants(rel_path, page_file_name(page), make_html, opts, stats, result)
+                continue
+
+            # Every page is encrypted, so it needs the whole listing at once
+            with stats.phase('render'):
+                content = generate_directory_listing(parentdir, dirs, file_rows, page=page, page_size=opts.page_size,
+                                                     search=search_box(cipher, rel_path, opts), subtrees=subtrees,
+                                                     head=listing_head(rel_path), archives=archives)
+            with stats.phase('encrypt'):
+                html = render_login_page(content, cipher, opts, rel_path).encode('utf-8')
+            stats.count('pages_rendered')
+            write_variants(rel_path, page_file_name(page), html, opts, stats, result)
+        except Exception as e:
+            result.errors.append(f'Cannot create file {os.path.join(parentdir, page_file_name(page))}: {e}')
+            result.status = 'failed'
+            return result
+
+    if opts.sha256sums and checksums_file_name.lower() in listed_pages:
+        result.errors.append(f'Cannot create file {os.path.join(parentdir, checksums_file_name)}: '
+                             f'{checksums_file_name} is a listed file not written by this script')
+    elif opts.sha256sums:
+        try:
+            with stats.phase('write'):
+                changed, digest = opts.target.write(rel_path, checksums_file_name, sha256sums_lines(file_rows))
+        except Exception as e:
+            result.errors.append(f'Cannot create file {os.path.join(parentdir, checksums_file_name)}: {e}')
+            result.status = 'failed'
+            return result
+        result.pages.append((checksums_file_name, digest, None))
+        if changed:
+            result.pages_written += 1
+        else:
+            result.pages_skipped += 1
+
+    # Drop pages left over from a run when this directory was bigger or used other variants; a mirror
+    # holds nothing but pages, so its folder is the one to look at. Next to the files, only pages the
+    # manifest knows of, or that carry the login page of the script, are ours to remove
+    for file in files if opts.target.in_place else opts.target.listdir(rel_path):
+        name = file if isinstance(file, str) else file.name
+        if opts.target.in_place and not is_generated_entry(parentdir, name, generated):
+            continue
+        match = PAGE_FILE_RE.match(name)
+        archive_match = ARCHIVE_PAGE_RE.match(name)
+        if match:
+            stale = int(match.group(1) or 1) > page_count
+            suffix = match.group(2)
+        elif archive_match:
+            stale = archive_match.group(1) not in archives
+            suffix = archive_match.group(2)
+        else:
+            continue
+        if stale or (suffix and suffix not in [COMPRESSED_SUFFIXES[encoding] for encoding in opts.precompress or ()]):
+            try:
+                opts.target.remove(rel_path, name)
+            except OSError as e:
+                result.errors.append(f'Cannot remove stale page {name}: {e}')
+
+    return result
+
+def sha256sums_lines(file_rows):
+    """Lines of a SHA256SUMS file for the rows that have a checksum, as sha256sum writes them: names
+    holding a backslash or a newline are escaped, and the line is marked with a leading backslash"""
+    for row in file_rows:
+        if not row.sha256:
+            continue
+        if '\\' in row.name or '\n' in row.name:
+            name = row.name.replace('\\', '\\\\').replace('\n', '\\n')
+            yield f'\\{row.sha256}  {name}\n'
+        else:
+            yield f'{row.sha256}  {row.name}\n'
+
+def spa_shard_prefix(rel_path, shard_depth):
+    """Tree manifest shard a directory belongs to, named by its ancestor at the shard depth"""
+    parts = [] if rel_path == os.curdir else rel_path.split(os.sep)
+    if not shard_depth or len(parts) < shard_depth:
+        return ''
+    return '/'.join(parts[:shard_depth])
+
+def write_spa(top_dir, db, cipher, opts, stats):
+    """Write the tree manifest shards and the single viewer page for --mode spa"""
+    result = DirResult(top_dir, os.curdir)
+    tree_dir = os.path.join(support_dir_name, 'tree')
+    opts.target.makedirs(tree_dir)
+    tree_cipher = cipher.subkey('tree')
+
+    # The manifest holds every listing, including those an incremental run did not re-scan
+    shards = {}
+    for rel_path, entries in db.execute('SELECT path, entries FROM dirs ORDER BY path'):
+        entries = json.loads(entries)
+        path = '' if rel_path == os.curdir else rel_path.replace(os.sep, '/')
+        shard = shards.setdefault(spa_shard_prefix(rel_path, opts.shard_depth), {})
+        subtrees = entries.get('subtrees', {})
+        # Subdirectories carry [size, files, newest mtime in seconds] when their totals are known
+        shard[path] = [[[name, *subtrees[name][:2], subtrees[name][2] // 1000000000] if name in subtrees else [name]
+                        for name in entries['dirs']],
+                       [[name, size, sha256] if sha256 else [name, size]
+                        for name, size, _, sha256 in listing_files(db, rel_path, entries)]]
+
+    written = set()
+    for prefix, shard in shards.items():
+        name = hashlib.sha256(prefix.encode('utf-8')).hexdigest()[:16] + '.bin'
+        with stats.phase('encrypt'):
+            data = json.dumps(shard, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            data = tree_cipher.encrypt(gzip.compress(data, compresslevel=9, mtime=0))
+        with stats.phase('write'):
+            changed, digest = opts.target.write(tree_dir, name, [data])
+        result.pages.append((f'{support_dir_name}/tree/{name}', digest, None))
+        if changed:
+            stats.count('bytes_written', len(data))
+            result.pages_written += 1
+        else:
+            result.pages_skipped += 1
+        written.add(name)
+
+    # Shards of subtrees that no longer exist
+    for name in opts.target.listdir(tree_dir):
+        if name.endswith('.bin') and name not in written:
+            opts.target.remove(tree_dir, name)
+
+    viewer = SPA_VIEWER_TEMPLATE
+    viewer = viewer.replace('{{ css }}', listing_head(os.curdir))
+    viewer = viewer.replace('{{ title }}', os.path.basename(os.path.abspath(top_dir)))
+    viewer = viewer.replace('{{ tree_key }}', base64.b64encode(tree_cipher.key).decode('ascii'))
+    viewer = viewer.replace('{{ shard_depth }}', str(opts.shard_depth))
+    viewer = viewer.replace('{{ tree_dir }}', f'{support_dir_name}/tree')
+    viewer = viewer.replace('{{ search }}', search_box(cipher, os.curdir, opts))
+    with stats.phase('encrypt'):
+        html = render_login_page(viewer, cipher, opts).encode('utf-8')
+    write_variants(os.curdir, index_file_name, html, opts, stats, result)
+
+    db.execute('DELETE FROM pages WHERE dir = ?', (os.curdir,))
+    db.executemany('INSERT OR REPLACE INTO pages (path, dir, digest, encoding) VALUES (?, ?, ?, ?)',
+                   [(key, os.curdir, digest, encoding) for key, digest, encoding in result.pages])
+    return result
+
+def write_assets(top_dir, db, opts, stats):
+    """Write the shared stylesheets and scripts the pages link to, removing those of older versions"""
+    result = DirResult(top_dir, support_dir_name)
+    assets_dir = os.path.join(support_dir_name, 'assets')
+    opts.target.makedirs(assets_dir)
+    for name, content in ASSETS.items():
+        if name == 'search.js' and not opts.search:
+            continue
+        write_variants(assets_dir, asset_name(name), content.encode('utf-8'), opts, stats, result)
+
+    # Assets are named by their content, so anything else in the folder is outdated
+    written = {variant for variant, _, _ in result.pages}
+    for name in opts.target.listdir(assets_dir):
+        if name not in written:
+            opts.target.remove(assets_dir, name)
+
+    prefix = f'{support_dir_name}/assets/'
+    db.execute("DELETE FROM pages WHERE path LIKE ? ESCAPE '!'",
+               (prefix.replace('!', '!!').replace('%', '!%').replace('_', '!_') + '%',))
+    db.executemany('INSERT INTO pages (path, dir, digest, encoding) VALUES (?, ?, ?, ?)',
+                   [(prefix + variant, support_dir_name, digest, encoding)
+                    for variant, digest, encoding in result.pages])
+    return result
+
+def name_trigrams(name):
+    """Distinct lower-case trigrams of a name, the unit of the search index"""
+    name = name.lower()
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+@functools.lru_cache(maxsize=None)
+def gram_bucket(gram):
+    """Posting shard of a trigram: FNV-1a over its UTF-8 bytes, which the browser computes the same way"""
+    value = 0x811c9dc5
+    for byte in gram.encode('utf-8'):
+        value = ((value ^ byte) * 0x01000193) & 0xffffffff
+    return value % SEARCH_BUCKETS
+
+def name_buckets(name):
+    """Posting shards a name is listed in"""
+    return {gram_bucket(gram) for gram in name_trigrams(name)}
+
+def search_box(cipher, rel_path, opts):
+    """Search box for the listing of rel_path, or nothing without --search"""
+    if not opts.search:
+        return ''
+    box = SEARCH_TEMPLATE
+    box = box.replace('{{ search_key }}', base64.b64encode(cipher.subkey('search').key).decode('ascii'))
+    box = box.replace('{{ search_root }}', root_url(rel_path))
+    box = box.replace('{{ search_dir }}', f'{support_dir_name}/search')
+    box = box.replace('{{ spa }}', 'true' if opts.mode == 'spa' else 'false')
+    box = box.replace('{{ buckets }}', str(SEARCH_BUCKETS))
+    box = box.replace('{{ chunk }}', str(SEARCH_CHUNK))
+    box = box.replace('{{ index_file }}', index_file_name)
+    box = box.replace('{{ search_js }}', asset_url(rel_path, 'search.js'))
+    return box
+
+def stored_search_paths(db, rel_path, last_id):
+    """Search index rows of one directory with ids up to last_id, in name order. Rows are read in
+    batches, so the caller can change the table in between"""
+    name = ''
+    while True:
+        rows = db.execute('SELECT id, name, size, buckets FROM search_paths WHERE dir = ? AND name > ? AND id <= ? '
+                          'ORDER BY name LIMIT ?', (rel_path, name, last_id, SEARCH_CHUNK)).fetchall()
+        yield from rows
+        if len(rows) < SEARCH_CHUNK:
+            return
+        name = rows[-1][1]
+
+def update_search_paths(db, rel_path, dirs, files):
+    """Bring the search index rows of one directory in line with its listing, marking touched shards dirty.
+    dirs and files are sorted by name and merged against the stored rows, so wide listings are never
+    held in memory"""
+    wanted = heapq.merge(((name, None) for name in dirs), ((name, size) for name, size, _, _ in files))
+    # New rows get consecutive ids above the current maximum, which tells the path shards they land in
+    last_id = next_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM search_paths').fetchone()[0]
+    stored = stored_search_paths(db, rel_path, last_id)
+    dirty = set()
+    removed, added = [], []
+
+    def flush(limit):
+        if len(removed) >= limit:
+            db.executemany('DELETE FROM search_paths WHERE id = ?', removed)
+            removed.clear()
+        if len(added) >= limit:
+            db.executemany('INSERT INTO search_paths (id, dir, name, size, buckets) VALUES (?, ?, ?, ?, ?)', added)
+            added.clear()
+
+    def remove(path_id, buckets):
+        removed.append((path_id,))
+        dirty.update(f'g{bucket:02x}' for bucket in buckets)
+        dirty.add(f'p{path_id // SEARCH_CHUNK}')
+
+    current = next(stored, None)
+    for name, size in wanted:
+        while current is not None and current[1] < name:
+            remove(current[0], current[3])
+            current = next(stored, None)
+        if current is not None and current[1] == name:
+            if current[2] != size:
+                db.execute('UPDATE search_paths SET size = ? WHERE id = ?', (size, current[0]))
+                dirty.add(f'p{current[0] // SEARCH_CHUNK}')
+            current = next(stored, None)
+        else:
+            next_id += 1
+            buckets = bytes(sorted(name_buckets(name)))
+            dirty.update(f'g{bucket:02x}' for bucket in buckets)
+            dirty.add(f'p{next_id // SEARCH_CHUNK}')
+            added.append((next_id, rel_path, name, size, buckets))
+        flush(SEARCH_CHUNK)
+    while current is not None:
+        remove(current[0], current[3])
+        current = next(stored, None)
+    flush(0)
+
+    db.executemany('INSERT OR IGNORE INTO search_dirty (shard) VALUES (?)', [(shard,) for shard in dirty])
+
+def prune_search_paths(db):
+    """Drop the search index rows of directories that are gone from the manifest"""
+    for rel_path, in db.execute('SELECT DISTINCT dir FROM search_paths WHERE dir NOT IN (SELECT path FROM dirs)'
+                                ).fetchall():
+        update_search_paths(db, rel_path, (), ())
+
+def reset_search(top_dir, db, cipher, opts):
+    """Throw the search index away when --search is off or the password changed; listings re-render then
+    anyway, since both are part of their signature, and refill it"""
+    row = db.execute("SELECT value FROM settings WHERE name = 'search_key'").fetchone()
+    wanted = cipher.key_id if opts.search else None
+    if (row and row[0]) == wanted:
+        return
+    for table in ('search_paths', 'search_dirty'):
+        db.execute(f'DELETE FROM {table}')
+    db.execute('DELETE FROM pages WHERE dir = ?', (support_dir_name,))
+    opts.target.rmtree(os.path.join(support_dir_name, 'search'))
+    db.execute("DELETE FROM settings WHERE name = 'search_key'")
+    if wanted:
+        db.execute("INSERT INTO settings (name, value) VALUES ('search_key', ?)", (wanted,))
+
+def write_search_shard(db, search_cipher, shard, content, opts, stats, result):
+    """Encrypt and write one search index shard, or remove it once it is empty"""
+    key = f'{support_dir_name}/search/{shard}.bin'
+    if not content:
+        opts.target.remove(*target_key_path(key))
+        db.execute('DELETE FROM pages WHERE path = ?', (key,))
+        return
+
+    with stats.phase('encrypt'):
+        data = json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        data = search_cipher.encrypt(gzip.compress(data, compresslevel=9, mtime=0))
+    with stats.phase('write'):
+        changed, digest = opts.target.write(*target_key_path(key), [data])
+    db.execute('INSERT OR REPLACE INTO pages (path, dir, digest, encoding) VALUES (?, ?, ?, NULL)',
+               (key, support_dir_name, digest))
+    if changed:
+        stats.count('bytes_written', len(data))
+        result.pages_written += 1
+    else:
+        result.pages_skipped += 1
+
+def write_search(top_dir, db, cipher, opts, stats):
+    """Rewrite the search index shards marked dirty since the last run"""
+    result = DirResult(top_dir, support_dir_name)
+    opts.target.makedirs(os.path.join(support_dir_name, 'search'))
+    search_cipher = cipher.subkey('search')
+
+    dirty = [shard for shard, in db.execute('SELECT shard FROM search_dirty ORDER BY shard')]
+    buckets = [int(shard[1:], 16) for shard in dirty if shard.startswith('g')]
+    for group in range(0, len(buckets), SEARCH_PASS_BUCKETS):
+        postings = {bucket: {} for bucket in buckets[group:group + SEARCH_PASS_BUCKETS]}
+        # One pass in id order over the names listed in any shard of the group; ids are kept in
+        # compact arrays since a full rebuild holds every posting list of the group at once
+        for path_id, name, listed in db.execute('SELECT id, name, buckets FROM search_paths ORDER BY id'):
+            if postings.keys().isdisjoint(listed):
+                continue
+            for gram in name_trigrams(name):
+                grams = postings.get(gram_bucket(gram))
+                if grams is not None:
+                    ids = grams.get(gram)
+                    if ids is None:
+                        ids = grams[gram] = array.array('q')
+                    ids.append(path_id)
+        for bucket, grams in postings.items():
+            # Ids are delta-encoded, which keeps long posting lists small after gzip
+            content = {gram: [b - a for a, b in zip([0, *ids], ids)] for gram, ids in grams.items()}
+            write_search_shard(db, search_cipher, f'g{bucket:02x}', content, opts, stats, result)
+            grams.clear()
+
+    for shard in dirty:
+        if shard.startswith('p'):
+            first = int(shard[1:]) * SEARCH_CHUNK
+            content = {str(path_id): ['' if rel_path == os.curdir else rel_path.replace(os.sep, '/'), name, size]
+                       for path_id, rel_path, name, size in db.execute(
+                           'SELECT id, dir, name, size FROM search_paths WHERE id >= ? AND id < ? ORDER BY id',
+                           (first, first + SEARCH_CHUNK))}
+            write_search_shard(db, search_cipher, shard, content, opts, stats, result)
+
+    db.execute('DELETE FROM search_dirty')
+    return result
+
+def index_listings(top_dir, listings, cipher, db, run, opts, stats):
+    """Process (parentdir, dirs, files) listings on the worker pool and record them in the manifest.
+    The manifest is committed every JOURNAL_SECONDS, so an interrupted run keeps the listings it finished"""
+    totals = {'rendered': 0, 'unchanged': 0, 'resumed': 0, 'failed': 0, 'written': 0, 'skipped': 0,
+              'compression': {}, 'errors': []}
+    committed = time.monotonic()
+    # Listings of a resumed run are only trusted as they were rendered with the same options
+    options = listing_options(opts, cipher) if opts.resume else None
+
+    def finish(result):
+        """Report a directory's outcome and record it in the manifest"""
+        nonlocal committed
+        with stats.phase('manifest'):
+            record(result)
+            if not opts.dryrun and time.monotonic() - committed > JOURNAL_SECONDS:
+                db.commit()
+                committed = time.monotonic()
+        result.release()
+
+    def resumable(rel_path, dirs, subtrees):
+        """(stamp, SubtreeTotals) of a listing the resumed run finished, if its folders still add up the same"""
+        if not opts.resume:
+            return None
+        row = db.execute('''SELECT entries, stamp, tree_size, tree_files, tree_mtime_ns FROM dirs
+                            WHERE path = ? AND run = ? AND options = ? AND stamp IS NOT NULL''',
+                         (rel_path, run, options)).fetchone()
+        if row is None:
+            return None
+        entries = json.loads(row[0])
+        if entries['dirs'] != sorted(dirs) or entries['subtrees'] != {name: list(totals)
+                                                                       for name, totals in subtrees.items()}:
+            return None
+        return row[1], SubtreeTotals(*row[2:])
+
+    def record(result):
+        for message in result.messages:
+            print(message)
+        for message in result.errors:
+            print(message)
+        totals['errors'].extend(result.errors)
+        totals[result.status] += 1
+        totals['written'] += result.pages_written
+        totals['skipped'] += result.pages_skipped
+        for encoding, (raw, packed) in result.compression.items():
+            sizes = totals['compression'].setdefault(encoding, [0, 0])
+            sizes[0] += raw
+            sizes[1] += packed
+        if result.status == 'unchanged':
+            db.execute('''UPDATE dirs SET run = ?, tree_size = ?, tree_files = ?, tree_mtime_ns = ?, stamp = ?
+                          WHERE path = ?''', (run, *result.subtree, result.stamp, result.rel_path))
+        elif result.status == 'rendered':
+            db.execute('''INSERT OR REPLACE INTO dirs (path, digest, entries, options, run,
+                                                  tree_size, tree_files, tree_mtime_ns, stamp)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (result.rel_path, result.digest, result.entries, result.options, run, *result.subtree,
+                        result.stamp))
+            db.execute('DELETE FROM spilled_files WHERE dir = ?', (result.rel_path,))
+            if result.spilled_rows is not None:
+                db.executemany('INSERT INTO spilled_files (dir, name, size, mtime_ns, sha256) VALUES (?, ?, ?, ?, ?)',
+                               ((result.rel_path, *row) for row in result.spilled_rows))
+            if opts.search and not opts.dryrun:
+                entries = json.loads(result.entries)
+                update_search_paths(db, result.rel_path, entries['dirs'], listing_files(db, result.rel_path, entries))
+            db.execute('DELETE FROM pages WHERE dir = ?', (result.rel_path,))
+            db.executemany('INSERT OR REPLACE INTO pages (path, dir, digest, encoding) VALUES (?, ?, ?, ?)',
+                           [(object_key(result.rel_path, name), result.rel_path, digest, encoding)
+                            for name, digest, encoding in result.pages])
+
+    jobs = max(1, opts.jobs or 1)
+    pool = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    # Futures are drained in submission order, which keeps the output ordered and
+    # bounds how far the walk can run ahead of the workers
+    pending = deque()
+    # Results (or futures) of directories whose parent has not come up yet; listings
+    # arrive bottom-up, so every parent finds its subdirectories here
+    below = {}
+
+    try:
+        for parentdir, dirs, files in stats.timed('walk', listings):
+            stats.count('dirs_walked')
+            rel_path = os.path.relpath(parentdir, top_dir)
+            if dirs is None:
+                # A folder the walk could not list (see walk_bucket), with the error in place of its files
+                result = DirResult(parentdir, rel_path)
+                result.errors.append(files)
+                if pool is None:
+                    below[rel_path] = result
+                    finish(result)
+                else:
+                    below[rel_path] = future = Future()
+                    future.set_result(result)
+                    pending.append(future)
+                continue
+            subtrees = {}
+            for name in dirs:
+                sub_rel = os.path.normpath(os.path.join(rel_path, name))
+                done = below.pop(sub_rel, None)
+                if done is not None:
+                    totals_below = (done if pool is None else done.result()).subtree
+                else:
+                    # Not part of this walk (watch mode), or a symlink that is listed but not followed
+                    row = db.execute('SELECT tree_size, tree_files, tree_mtime_ns FROM dirs WHERE path = ?',
+                                     (sub_rel,)).fetchone()
+                    totals_below = SubtreeTotals(*row) if row and row[0] is not None else None
+                if totals_below is not None:
+                    subtrees[name] = totals_below
+            row = db.execute('SELECT digest FROM dirs WHERE path = ?', (rel_path,)).fetchone()
+            task = (top_dir, parentdir, dirs, files, subtrees, cipher, opts, row and row[0], stats,
+                    resumable(rel_path, dirs, subtrees), recorded_pages(db, rel_path))
+
+            if pool is None:
+                below[rel_path] = result = process_one_dir(*task)
+                finish(result)
+                continue
+
+            below[rel_path] = future = pool.submit(process_one_dir, *task)
+            pending.append(future)
+            while len(pending) >= jobs * 4 or (pending and pending[0].done()):
+                finish(pending.popleft().result())
+
+        while pending:
+            finish(pending.popleft().result())
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    return totals
+
+def add_support_totals(totals, result):
+    """Fold pages written outside the walk (assets, SPA viewer, tree and search shards) into a run's totals"""
+    totals['written'] += result.pages_written
+    totals['skipped'] += result.pages_skipped
+    for encoding, (raw, packed) in result.compression.items():
+        sizes = totals['compression'].setdefault(encoding, [0, 0])
+        sizes[0] += raw
+        sizes[1] += packed
+
+def print_totals(totals, opts):
+    """Summary lines of a run"""
+    if opts.verbose or opts.incremental or opts.resume or totals['errors']:
+        print(f"Rendered {totals['rendered']} directories, {totals['unchanged']} unchanged, "
+              + (f"{totals['resumed']} resumed, " if totals['resumed'] else '') + f"{totals['failed']} failed")
+    if not opts.dryrun:
+        print(f"Wrote {totals['written']} pages, skipped {totals['skipped']} identical pages")
+    for encoding, (raw, packed) in sorted(totals['compression'].items()):
+        print(f'{encoding}: {pretty_size(raw)} -> {pretty_size(packed)} '
+              f'({100 * packed / max(raw, 1):.1f}% of rendered pages)')
+    if totals['errors']:
+        print(f"{len(totals['errors'])} error(s) during the run:")
+        for message in totals['errors']:
+            print(f'  {message}')
+
+def io_pool(opts, source=None):
+    """Options for the thread pool that keeps --list-jobs directory reads and stats in flight at once:
+    a listing of a bucket or a folder on NFS or sshfs mostly waits on round trips. Local folders are read
+    one call at a time unless asked otherwise"""
+    jobs = max(1, opts.list_jobs or (16 if source is not None else 1))
+    return {'list_jobs': jobs, 'io_pool': ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None}
+
+def resumed_run(db):
+    """Id of the last run if it never finished, which --resume then continues"""
+    row = db.execute('SELECT id, finished FROM runs ORDER BY id DESC LIMIT 1').fetchone()
+    if row is None or row[1] is not None:
+        print('No interrupted run to resume, indexing everything')
+        return None
+    print(f'Resuming run {row[0]}')
+    return row[0]
+
+def process_dir(top_dir, password, opts):
+    """Process directory recursively and create index files"""
+    manifest_path = manifest_location(top_dir, opts)
+    if opts.dryrun and not os.path.exists(manifest_path):
+        manifest_path = ':memory:'
+    stats = RunStats()
+    # A bucket URL is listed instead of walked, and feeds the same listings
+    source = open_source(top_dir)
+    # Patterns are compiled once per run and travel with the options to every worker, as do the target
+    # and the pool that directory reads and stats wait on
+    opts = argparse.Namespace(**dict(vars(opts), matcher=path_matcher(top_dir, opts),
+                                     target=open_target(top_dir, opts),
+                                     checksum_cache=open_checksum_cache(top_dir, opts),
+                                     archive_cache=open_archive_cache(top_dir, opts),
+                                     **io_pool(opts, source)))
+    db = open_manifest(manifest_path)
+    run = resumed_run(db) if opts.resume else None
+    if run is None:
+        run = db.execute('INSERT INTO runs (started) VALUES (?)', (time.time(),)).lastrowid
+    # Key derivation is deliberately slow, so it happens exactly once per run
+    with stats.phase('kdf'):
+        cipher = PageCipher(password, manifest_salt(db), opts.kdf_iterations)
+    if not opts.dryrun:
+        reset_search(top_dir, db, cipher, opts)
+        # publish reads the pages from wherever they were written
+        db.execute("DELETE FROM settings WHERE name = 'output'")
+        if opts.output or opts.output_tar:
+            db.execute("INSERT INTO settings (name, value) VALUES ('output', ?)",
+                       (os.path.abspath(opts.output or opts.output_tar),))
+        if not opts.sha256sums:
+            remove_sha256sums(db, opts.target)
+        # Files of an indexed bucket are already where publish would put them
+        db.execute("DELETE FROM settings WHERE name = 'source'")
+        if '://' in top_dir:
+            db.execute("INSERT INTO settings (name, value) VALUES ('source', ?)", (top_dir,))
+        # The run is journaled from here on, so --resume can pick it up if it is interrupted
+        db.commit()
+
+    if source is None:
+        listings = walk_tree(top_dir, opts.matcher, opts.io_pool, 2 * opts.list_jobs)
+    else:
+        listings = walk_bucket(source, top_dir, opts.matcher, opts.io_pool, 2 * opts.list_jobs)
+    totals = index_listings(top_dir, listings, cipher, db, run, opts, stats)
+    if opts.io_pool is not None:
+        opts.io_pool.shutdown()
+    for name, value in opts.matcher.counts.items():
+        stats.count(name, value)
+    for cache in (opts.checksum_cache, opts.archive_cache):
+        if cache is not None:
+            for name, value in cache.counts.items():
+                stats.count(name, value)
+            cache.close()
+    if not opts.dryrun:
+        add_support_totals(totals, write_assets(top_dir, db, opts, stats))
+        with stats.phase('manifest'):
+            prune_listings(db, run, opts.target)
+        if opts.search:
+            with stats.phase('manifest'):
+                prune_search_paths(db)
+            add_support_totals(totals, write_search(top_dir, db, cipher, opts, stats))
+        if opts.mode == 'spa':
+            add_support_totals(totals, write_spa(top_dir, db, cipher, opts, stats))
+        else:
+            # Left over from an earlier --mode spa run
+            opts.target.rmtree(os.path.join(support_dir_name, 'tree'))
+        opts.target.close()
+
+    with stats.phase('manifest'):
+        if opts.dryrun:
+            db.rollback()
+        else:
+            db.execute('UPDATE runs SET finished = ? WHERE id = ?', (time.time(), run))
+            db.commit()
+        db.close()
+    stats.finish()
+
+    print_totals(totals, opts)
+    if opts.stats:
+        stats.print_summary()
+    if opts.stats_json:
+        with open(opts.stats_json, 'w') as f:
+            json.dump(stats.as_dict(), f, indent=2)
+    return stats
+
+def remove_sha256sums(db, target):
+    """Delete the SHA256SUMS files of an earlier --sha256sums run, before the walk could list them"""
+    keys = db.execute("SELECT path FROM pages WHERE path = ? OR path LIKE ? ESCAPE '!'",
+                      (checksums_file_name, '%/' + checksums_file_name)).fetchall()
+    for key, in keys:
+        target.remove(*target_key_path(key))
+    db.executemany('DELETE FROM pages WHERE path = ?', keys)
+
+def prune_listings(db, run, target):
+    """Forget directories that disappeared or got excluded since the last full run, and delete their pages"""
+    db.execute('DELETE FROM dirs WHERE run != ?', (run,))
+    gone = db.execute('SELECT path FROM pages WHERE dir NOT IN (SELECT path FROM dirs) AND dir != ?',
+                      (support_dir_name,)).fetchall()
+    for key, in gone:
+        target.remove(*target_key_path(key))
+    db.execute('DELETE FROM pages WHERE dir NOT IN (SELECT path FROM dirs) AND dir != ?', (support_dir_name,))
+    db.execute('DELETE FROM spilled_files WHERE dir NOT IN (SELECT path FROM dirs)')
+
+class InotifyWatcher:
+    """Report directories with changes below the top folder, using Linux inotify through libc"""
+
+    def __init__(self, top_dir, known_dirs, matcher, db):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {}
+        self.top_dir = os.path.abspath(top_dir)
+        self.matcher = matcher
+        self.db = db
+        # The manifest already knows every directory, so no extra walk is needed to set up watches
+        for parentdir in known_dirs:
+            self.add(parentdir)
+
+    def add(self, parentdir):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(parentdir), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, 'too many directories for inotify, raise fs.inotify.max_user_watches')
+            if err not in (errno.ENOENT, errno.ENOTDIR):
+                raise OSError(err, f'cannot watch {parentdir}')
+            return
+        self.paths[wd] = parentdir
+
+    def read_events(self, changed):
+        """Drain pending events into the set of changed directories; False means the queue overflowed"""
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return True
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                offset += 16 + length
+                if mask & IN_Q_OVERFLOW:
+                    return False
+                parentdir = self.paths.get(wd)
+                if parentdir is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.paths[wd]
+                    continue
+                name = os.fsdecode(name)
+                # Our own page writes must not trigger another round; they are in the manifest by the time
+                # their events are read
+                if name and (is_generated_file(name, recorded_pages(self.db, os.path.relpath(parentdir, self.top_dir)))
+                             or (parentdir == self.top_dir and name == support_dir_name)):
+                    continue
+                # Neither do changes to what the listings leave out
+                if name and self.matcher.skips(self.matcher.prefix(parentdir), name, bool(mask & IN_ISDIR)):
+                    continue
+                changed.add(parentdir)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    new_dir = os.path.join(parentdir, name)
+                    changed.add(new_dir)
+                    for subdir, _, _ in walk_tree(new_dir, self.matcher):
+                        self.add(subdir)
+
+    def wait(self, debounce):
+        """Block until something changes, then return the changed directories once things are quiet for
+        `debounce` seconds, or None when the whole tree has to be rescanned"""
+        changed = set()
+        while True:
+            # Events for our own writes (pages, manifest) are dropped, so keep blocking until a real one arrives
+            if not select.select([self.fd], [], [], debounce if changed else None)[0]:
+                return changed
+            if not self.read_events(changed):
+                return None
+
+class PollingWatcher:
+    """Fallback for platforms or filesystems without inotify: rescan the tree at a fixed interval"""
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def wait(self, debounce):
+        time.sleep(self.interval)
+        return None
+
+def open_watcher(top_dir, db, opts):
+    """inotify where available, polling everywhere else"""
+    if sys.platform.startswith('linux') and not opts.watch_poll:
+        try:
+            known_dirs = [os.path.normpath(os.path.join(os.path.abspath(top_dir), path))
+                          for path, in db.execute('SELECT path FROM dirs')]
+            return InotifyWatcher(top_dir, known_dirs, opts.matcher, db)
+        except OSError as e:
+            print(f'Cannot use inotify ({e}), polling every {opts.watch_interval}s instead')
+    return PollingWatcher(opts.watch_interval)
+
+def changed_listings(top_dir, changed, db, opts):
+    """Listings to refresh for a batch of changed directories: each one and all of its ancestors, whose
+    recursive totals depend on it, deepest first"""
+    top_dir = os.path.abspath(top_dir)
+    refresh = set()
+    for parentdir in changed:
+        parentdir = os.path.abspath(parentdir)
+        while parentdir not in refresh:
+            refresh.add(parentdir)
+            if parentdir == top_dir or not parentdir.startswith(top_dir):
+                break
+            parentdir = os.path.dirname(parentdir)
+
+    for parentdir in sorted(refresh, key=lambda path: (-path.count(os.sep), path)):
+        rel_path = os.path.relpath(parentdir, top_dir)
+        try:
+            dirs, files, descend = scan_dir(parentdir, parentdir == top_dir, opts.matcher)
+        except FileNotFoundError:
+            # Gone: its parent is refreshed too and drops the link
+            forget_subtree(db, rel_path, opts.target)
+            continue
+        except OSError as e:
+            print(f'ERROR reading directory {parentdir}: {e}')
+            continue
+
+        # Subdirectories that were removed since the listing was recorded
+        row = db.execute('SELECT entries FROM dirs WHERE path = ?', (rel_path,)).fetchone()
+        if row:
+            for name in set(json.loads(row[0])['dirs']) - set(dirs):
+                forget_subtree(db, os.path.normpath(os.path.join(rel_path, name)), opts.target)
+
+        # Directories the manifest has never seen (new, or moved in) are indexed in full, before
+        # this listing sums them up
+        for subdir in descend:
+            sub_rel = os.path.relpath(subdir, top_dir)
+            if subdir not in refresh and not db.execute('SELECT 1 FROM dirs WHERE path = ?', (sub_rel,)).fetchone():
+                yield from walk_tree(subdir, opts.matcher)
+
+        yield parentdir, dirs, files
+
+def forget_subtree(db, rel_path, target):
+    """Drop a removed directory and everything below it from the manifest, and its pages from the target"""
+    prefix = rel_path.replace('!', '!!').replace('%', '!%').replace('_', '!_') + os.sep + '%'
+    for key, in db.execute("SELECT path FROM pages WHERE dir = ? OR dir LIKE ? ESCAPE '!'", (rel_path, prefix)):
+        target.remove(*target_key_path(key))
+    for table, column in (('dirs', 'path'), ('pages', 'dir'), ('spilled_files', 'dir')):
+        db.execute(f"DELETE FROM {table} WHERE {column} = ? OR {column} LIKE ? ESCAPE '!'", (rel_path, prefix))
+
+def watch_dir(top_dir, password, opts):
+    """Index the tree once, then keep re-rendering only the directories that change"""
+    process_dir(top_dir, password, opts)
+
+    # Unchanged listings are detected by digest, so every refresh is incremental
+    opts = argparse.Namespace(**dict(vars(opts), incremental=True, resume=False, stats=False, stats_json=None,
+                                     matcher=path_matcher(top_dir, opts), target=open_target(top_dir, opts),
+                                     checksum_cache=open_checksum_cache(top_dir, opts),
+                                     archive_cache=open_archive_cache(top_dir, opts), **io_pool(opts)))
+    db = open_manifest(manifest_location(top_dir, opts))
+    cipher = PageCipher(password, manifest_salt(db), opts.kdf_iterations)
+    watcher = open_watcher(top_dir, db, opts)
+    print(f'Watching {top_dir} for changes ({type(watcher).__name__}), press Ctrl-C to stop')
+
+    try:
+        while True:
+            changed = watcher.wait(opts.watch_debounce)
+            started = time.perf_counter()
+            stats = RunStats()
+            if changed is None:
+                listings = walk_tree(top_dir, opts.matcher, opts.io_pool, 2 * opts.list_jobs)
+            else:
+                listings = changed_listings(top_dir, changed, db, opts)
+            run = db.execute('INSERT INTO runs (started) VALUES (?)', (time.time(),)).lastrowid
+            totals = index_listings(top_dir, listings, cipher, db, run, opts, stats)
+            if changed is None:
+                prune_listings(db, run, opts.target)
+            if opts.search and (totals['rendered'] or changed is None):
+                prune_search_paths(db)
+                add_support_totals(totals, write_search(top_dir, db, cipher, opts, stats))
+            if opts.mode == 'spa' and (totals['rendered'] or changed is None):
+                add_support_totals(totals, write_spa(top_dir, db, cipher, opts, stats))
+            db.execute('UPDATE runs SET finished = ? WHERE id = ?', (time.time(), run))
+            db.commit()
+            for cache in (opts.checksum_cache, opts.archive_cache):
+                if cache is not None:
+                    cache.commit()
+            if totals['written'] or totals['errors'] or opts.verbose:
+                print(f"{time.strftime('%H:%M:%S')} refreshed {totals['rendered']} directories, "
+                      f"wrote {totals['written']} pages in {time.perf_counter() - started:.2f}s")
+                for message in totals['errors']:
+                    print(f'  {message}')
+    except KeyboardInterrupt:
+        print('Stopped watching')
+    finally:
+        db.close()
+        for cache in (opts.checksum_cache, opts.archive_cache):
+            if cache is not None:
+                cache.close()
+        if opts.io_pool is not None:
+            opts.io_pool.shutdown()
+
+def compress_page(data, encoding):
+    """Compress a page for the given Content-Encoding, reproducibly so unchanged pages stay unchanged"""
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == 'br':
+        import brotli
+        return brotli.compress(data, quality=11, mode=brotli.MODE_TEXT)
+    raise ValueError(f'Unsupported encoding: {encoding}')
+
+def compress_stream(chunks, encoding):
+    """compress_page() over a stream of bytes chunks"""
+    if encoding == 'gzip':
+        yield from gzip_stream(stream_blocks(chunks))
+        return
+    if encoding == 'br':
+        import brotli
+        compressor = brotli.Compressor(quality=11, mode=brotli.MODE_TEXT)
+        for block in stream_blocks(chunks):
+            yield compressor.process(block)
+        yield compressor.finish()
+        return
+    raise ValueError(f'Unsupported encoding: {encoding}')
+
+def file_digest(path, rate=None):
+    """SHA-256 of a file's contents, read in 1 MiB blocks into one reused buffer. rate caps the
+    read throughput in bytes per second"""
+    digest = hashlib.sha256()
+    block = bytearray(1 << 20)
+    view = memoryview(block)
+    started = time.monotonic()
+    done = 0
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(block)
+            if not size:
+                break
+            digest.update(view[:size])
+            done += size
+            if rate:
+                ahead = done / rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+    return digest.hexdigest()
+
+def file_digests(paths, rate=None):
+    """file_digest() of several files in one task, with the error in place of the digest of a file
+    that cannot be read"""
+    digests = []
+    for path in paths:
+        try:
+            digests.append(file_digest(path, rate))
+        except OSError as e:
+            digests.append(e)
+    return digests
+
+class ChecksumCache:
+    """SHA-256 checksums of listed files for --checksums, kept across runs in a SQLite file keyed on
+    (device, inode) and checked against size and mtime, so only new or changed files are read again.
+    Files are hashed on a process pool, at most `rate` bytes per second in total. Worker threads
+    share one instance, so the connection is only used under the lock"""
+
+    def __init__(self, path, jobs, rate=None):
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS checksums (
+            dev INTEGER NOT NULL,
+            ino INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            used INTEGER NOT NULL,
+            PRIMARY KEY (dev, ino))''')
+        self.lock = threading.Lock()
+        self.jobs = jobs
+        # The cap is split evenly between the hashing processes
+        self.rate = rate / jobs if rate else None
+        self.pool = None
+        # Checksums are marked used at most once a day, which keeps unchanged trees from rewriting the cache
+        self.today = int(time.time() // 86400)
+        self.committed = time.monotonic()
+        # Files hashed and found in the cache, reported by --stats
+        self.counts = Counter()
+
+    def lookup(self, batch):
+        """Cached checksums of a batch of (name, stat result) pairs, by (dev, ino, size, mtime_ns)"""
+        inodes = {}
+        for _, st in batch:
+            inodes.setdefault(st.st_dev, []).append(st.st_ino)
+        found = []
+        with self.lock:
+            # Files of one directory are nearly always on one device, so this is one indexed query
+            for dev, ino in inodes.items():
+                found += self.db.execute(
+                    'SELECT dev, ino, size, mtime_ns, sha256, used FROM checksums '
+                    f'WHERE dev = ? AND ino IN ({", ".join("?" * len(ino))})', (dev, *ino)).fetchall()
+            self.db.executemany('UPDATE checksums SET used = ? WHERE dev = ? AND ino = ?',
+                                [(self.today, dev, ino) for dev, ino, _, _, _, used in found if used != self.today])
+        return {(dev, ino, size, mtime_ns): sha256 for dev, ino, size, mtime_ns, sha256, _ in found}
+
+    def rows(self, parentdir, files, errors=None):
+        """FileEntry rows with checksums for (name, stat result) pairs, in the same order. Files missing
+        from the cache are hashed in the background while the following ones are looked up"""
+        files = iter(files)
+        window = deque()
+        for batch in iter(lambda: list(itertools.islice(files, CHECKSUM_BATCH)), []):
+            # DirEntry.stat() leaves the inode at 0 on Windows, which cannot tell files apart
+            batch = [(name, st if st.st_ino else os.stat(os.path.join(parentdir, name))) for name, st in batch]
+            cached = self.lookup(batch)
+            missing = [(name, st) for name, st in batch
+                       if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) not in cached]
+            hashing = {}
+            for group in self.groups(missing):
+                future = self.submit([os.path.join(parentdir, name) for name in group])
+                for index, name in enumerate(group):
+                    hashing[name] = (future, index)
+            for name, st in batch:
+                window.append((name, st, cached.get((st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns))
+                               or hashing[name]))
+                # The next batch is looked up and queued while this one is still being hashed
+                while window and (len(window) > 2 * CHECKSUM_BATCH or isinstance(window[0][2], str)
+                                  or window[0][2][0].done()):
+                    yield self.resolve(parentdir, *window.popleft(), errors)
+        while window:
+            yield self.resolve(parentdir, *window.popleft(), errors)
+
+    def groups(self, missing):
+        """Split files to hash into about one task per process, so small files do not cost a round trip
+        each; big files go alone"""
+        size = max(1, -(-len(missing) // self.jobs))
+        group, group_bytes = [], 0
+        for name, st in missing:
+            if group and (len(group) >= size or group_bytes + st.st_size > CHECKSUM_TASK_BYTES):
+                yield group
+                group, group_bytes = [], 0
+            group.append(name)
+            group_bytes += st.st_size
+        if group:
+            yield group
+
+    def submit(self, paths):
+        with self.lock:
+            if self.pool is None:
+                # Spawned rather than forked, since the parent runs threads
+                self.pool = ProcessPoolExecutor(max_workers=self.jobs, mp_context=multiprocessing.get_context('spawn'))
+        return self.pool.submit(file_digests, paths, self.rate)
+
+    def resolve(self, parentdir, name, st, sha256, errors):
+        if isinstance(sha256, str):
+            with self.lock:
+                self.counts['checksums_cached'] += 1
+            return FileEntry(name, st.st_size, st.st_mtime_ns, sha256)
+
+        future, index = sha256
+        try:
+            sha256 = future.result()[index]
+            if isinstance(sha256, OSError):
+                raise sha256
+            after = os.stat(os.path.join(parentdir, name))
+        except OSError as e:
+            message = f'ERROR hashing file {name}: {e}'
+            if errors is None:
+                print(message)
+            else:
+                errors.append(message)
+            return FileEntry(name, st.st_size, st.st_mtime_ns)
+        # A file that changed while it was read gets no checksum this time
+        if (after.st_size, after.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+            return FileEntry(name, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO checksums (dev, ino, size, mtime_ns, sha256, used) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, sha256, self.today))
+            self.counts['files_hashed'] += 1
+            self.counts['bytes_hashed'] += st.st_size
+            # Hashing a big tree takes hours, which an interruption should not throw away
+            if time.monotonic() - self.committed > 60:
+                self.commit()
+        return FileEntry(name, st.st_size, st.st_mtime_ns, sha256)
+
+    def commit(self):
+        self.db.commit()
+        self.committed = time.monotonic()
+
+    def close(self):
+        """Stop the hashing processes and drop checksums no listing used for CHECKSUM_CACHE_DAYS"""
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        self.db.execute('DELETE FROM checksums WHERE used < ?', (self.today - CHECKSUM_CACHE_DAYS,))
+        self.db.commit()
+        self.db.close()
+
+def cache_location(top_dir, opts, file_name):
+    """Path of a cache file kept next to the manifest or, when that is kept in memory, to the archive"""
+    manifest_path = manifest_location(top_dir, opts)
+    if manifest_path == ':memory:':
+        manifest_path = os.path.abspath(opts.output_tar)
+    return os.path.join(os.path.dirname(os.path.abspath(manifest_path)), file_name)
+
+def open_checksum_cache(top_dir, opts):
+    """ChecksumCache of a run with --checksums or --sha256sums; dry runs do not read file contents"""
+    if not (opts.checksums or opts.sha256sums) or opts.dryrun:
+        return None
+    jobs = opts.checksum_jobs or min(4, os.cpu_count() or 1)
+    return ChecksumCache(cache_location(top_dir, opts, checksum_cache_file_name),
+                         jobs, opts.checksum_rate and opts.checksum_rate * (1 << 20))
+
+def peek_archive(path, limit=ARCHIVE_ENTRIES):
+    """(name, size) of the first `limit` entries of a zip or uncompressed tar archive, size None for folders,
+    and whether it holds more. Only a zip's central directory or the tar headers are read, skipping over
+    the data in between, and nothing is decompressed"""
+    if path.lower().endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            infos = archive.infolist()
+            return ([(info.filename, None if info.is_dir() else info.file_size) for info in infos[:limit]],
+                    len(infos) > limit)
+    entries = []
+    # 'r:' refuses compressed tars rather than reading through them
+    with tarfile.open(path, 'r:') as archive:
+        for member in archive:
+            if len(entries) == limit:
+                return entries, True
+            entries.append((member.name + '/', None) if member.isdir() else (member.name, member.size))
+    return entries, False
+
+class ArchiveCache:
+    """Entries of zip and tar archives for --archive-contents, kept across runs in a SQLite file keyed on
+    (device, inode) and checked against size and mtime like ChecksumCache, so unchanged archives are not
+    opened again. Worker threads share one instance, so the connection is only used under the lock"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS archives (
+            dev INTEGER NOT NULL,
+            ino INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            entries BLOB NOT NULL,
+            used INTEGER NOT NULL,
+            PRIMARY KEY (dev, ino))''')
+        self.lock = threading.Lock()
+        self.today = int(time.time() // 86400)
+        self.committed = time.monotonic()
+        # Archives opened and found in the cache, reported by --stats
+        self.counts = Counter()
+
+    def entries(self, path):
+        """peek_archive() of an archive, from the cache while it is unchanged"""
+        st = os.stat(path)
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime_ns, entries, used FROM archives WHERE dev = ? AND ino = ?',
+                                  (st.st_dev, st.st_ino)).fetchone()
+            if row and (row[0], row[1]) == (st.st_size, st.st_mtime_ns):
+                if row[3] != self.today:
+                    self.db.execute('UPDATE archives SET used = ? WHERE dev = ? AND ino = ?',
+                                    (self.today, st.st_dev, st.st_ino))
+                self.counts['archives_cached'] += 1
+                entries, more = json.loads(zlib.decompress(row[2]))
+                return [tuple(entry) for entry in entries], more
+
+        entries, more = peek_archive(path)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO archives (dev, ino, size, mtime_ns, entries, used) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                             zlib.compress(json.dumps([entries, more], ensure_ascii=False).encode('utf-8')),
+                             self.today))
+            self.counts['archives_read'] += 1
+            if time.monotonic() - self.committed > 60:
+                self.commit()
+        return entries, more
+
+    def commit(self):
+        self.db.commit()
+        self.committed = time.monotonic()
+
+    def close(self):
+        """Drop archives no listing showed for CHECKSUM_CACHE_DAYS"""
+        self.db.execute('DELETE FROM archives WHERE used < ?', (self.today - CHECKSUM_CACHE_DAYS,))
+        self.db.commit()
+        self.db.close()
+
+def open_archive_cache(top_dir, opts):
+    """ArchiveCache of a run with --archive-contents; dry runs do not open archives"""
+    if not opts.archive_contents or opts.dryrun:
+        return None
+    return ArchiveCache(cache_location(top_dir, opts, archive_cache_file_name))
+
+def write_page(abs_path, chunks):
+    """Atomically replace a page unless its content is unchanged, returning (changed, sha256)"""
+    parentdir, name = os.path.split(abs_path)
+    fd, tmp_path = tempfile.mkstemp(dir=parentdir, prefix=f'{TEMP_FILE_PREFIX}{name}.', suffix='.tmp')
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            for chunk in chunks:
+                data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                digest.update(data)
+                size += len(data)
+                tmp_file.write(data)
+        digest = digest.hexdigest()
+
+        # Leave identical pages alone so their mtime keeps rsync's quick check cheap
+        try:
+            if os.path.getsize(abs_path) == size and file_digest(abs_path) == digest:
+                os.remove(tmp_path)
+                return False, digest
+        except OSError:
+            pass
+
+        os.chmod(tmp_path, 0o666 & ~UMASK)
+        os.replace(tmp_path, abs_path)
+        return True, digest
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class DirectoryOutput:
+    """Where pages go by default, next to the files they list, or into a separate mirror of the
+    tree with --output. Paths are directories relative to the top folder plus a file name"""
+
+    def __init__(self, root, in_place):
+        self.root = os.path.abspath(root)
+        self.in_place = in_place
+
+    def path(self, rel_dir, name):
+        return os.path.normpath(os.path.join(self.root, rel_dir, name))
+
+    def writable(self, rel_dir):
+        # A mirror's folders are created on demand, the source tree is never written to
+        return not self.in_place or os.access(os.path.join(self.root, rel_dir), os.W_OK)
+
+    def makedirs(self, rel_dir):
+        os.makedirs(os.path.join(self.root, rel_dir), exist_ok=True)
+
+    def write(self, rel_dir, name, chunks):
+        """write_page() into the target, returning (changed, sha256)"""
+        if not self.in_place:
+            self.makedirs(rel_dir)
+        return write_page(self.path(rel_dir, name), chunks)
+
+    def exists(self, rel_dir, name):
+        return os.path.exists(self.path(rel_dir, name))
+
+    def listdir(self, rel_dir):
+        try:
+            return os.listdir(os.path.join(self.root, rel_dir))
+        except FileNotFoundError:
+            return []
+
+    def remove(self, rel_dir, name):
+        """Delete a page if it is there; in a mirror, also the folders that leaves empty"""
+        path = self.path(rel_dir, name)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        if self.in_place:
+            return
+        parentdir = os.path.dirname(path)
+        while parentdir != self.root and parentdir.startswith(self.root + os.sep):
+            try:
+                os.rmdir(parentdir)
+            except OSError:
+                break
+            parentdir = os.path.dirname(parentdir)
+
+    def rmtree(self, rel_dir):
+        shutil.rmtree(os.path.join(self.root, rel_dir), ignore_errors=True)
+
+    def close(self):
+        pass
+
+class ArchiveOutput:
+    """Pages streamed one after another into a single .tar, .tar.gz/.tgz, .tar.bz2, .tar.xz or .zip
+    (--output-tar). The archive is written fresh every run and only appears once it is complete"""
+
+    TAR_MODES = (('.tar.gz', 'w:gz'), ('.tgz', 'w:gz'), ('.tar.bz2', 'w:bz2'), ('.tar.xz', 'w:xz'), ('.tar', 'w'))
+
+    in_place = False
+
+    def __init__(self, path):
+        self.file = os.path.abspath(path)
+        self.archive = None
+        self.lock = threading.Lock()
+        self.mtime = time.time()
+
+    def path(self, rel_dir, name):
+        return f'{self.file}:{self.member(rel_dir, name)}'
+
+    @staticmethod
+    def member(rel_dir, name):
+        return object_key(os.path.normpath(rel_dir), name)
+
+    def open(self):
+        # Opened on the first page, so a dry run leaves nothing behind
+        if self.file.endswith('.zip'):
+            self.archive = zipfile.ZipFile(self.file + '.part', 'w')
+        else:
+            mode = next(mode for suffix, mode in self.TAR_MODES if self.file.endswith(suffix))
+            self.archive = tarfile.open(self.file + '.part', mode)
+
+    def writable(self, rel_dir):
+        return True
+
+    def makedirs(self, rel_dir):
+        pass
+
+    def write(self, rel_dir, name, chunks):
+        """Add a page to the archive, returning (changed, sha256); pages are always new here"""
+        member = self.member(rel_dir, name)
+        digest = hashlib.sha256()
+        # Workers render concurrently, but members have to go into the archive one at a time
+        with tempfile.SpooledTemporaryFile(max_size=1 << 20) as spool:
+            for chunk in chunks:
+                data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                digest.update(data)
+                spool.write(data)
+            size = spool.tell()
+            spool.seek(0)
+            with self.lock:
+                if self.archive is None:
+                    self.open()
+                if isinstance(self.archive, zipfile.ZipFile):
+                    info = zipfile.ZipInfo(member, time.localtime(self.mtime)[:6])
+                    # Precompressed variants and encrypted shards do not shrink any further
+                    compressed = name.endswith(tuple(COMPRESSED_SUFFIXES.values()) + ('.bin',))
+                    info.compress_type = zipfile.ZIP_STORED if compressed else zipfile.ZIP_DEFLATED
+                    info.external_attr = 0o100644 << 16
+                    with self.archive.open(info, 'w') as dest:
+                        shutil.copyfileobj(spool, dest)
+                else:
+                    info = tarfile.TarInfo(member)
+                    info.size = size
+                    info.mtime = self.mtime
+                    info.mode = 0o644
+                    self.archive.addfile(info, spool)
+        return True, digest.hexdigest()
+
+    def exists(self, rel_dir, name):
+        return False
+
+    def listdir(self, rel_dir):
+        return []
+
+    def remove(self, rel_dir, name):
+        pass
+
+    def rmtree(self, rel_dir):
+        pass
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            os.replace(self.file + '.part', self.file)
+            self.archive = None
+
+def open_target(top_dir, opts):
+    """Output target of a run: the tree itself, a mirror folder (--output) or an archive (--output-tar)"""
+    if opts.output_tar:
+        return ArchiveOutput(opts.output_tar)
+    if opts.output:
+        if not opts.dryrun:
+            os.makedirs(opts.output, exist_ok=True)
+        return DirectoryOutput(opts.output, in_place=False)
+    return DirectoryOutput(top_dir, in_place=True)
+
+def manifest_location(top_dir, opts):
+    """--manifest, else next to the pages; a one-off archive keeps it in memory"""
+    if opts.manifest:
+        return opts.manifest
+    if opts.output_tar:
+        return ':memory:'
+    return os.path.join(opts.output or top_dir, manifest_file_name)
+
+def target_key_path(key):
+    """Split a manifest page key into the (relative directory, name) an output target takes"""
+    rel_dir, _, name = key.rpartition('/')
+    return (rel_dir.replace('/', os.sep) or os.curdir), name
+
+def object_key(rel_dir, name):
+    """Bucket key of a file, given its directory relative to the top folder"""
+    if rel_dir == os.curdir:
+        return name
+    return '/'.join(rel_dir.split(os.sep) + [name])
+
+class StorageBackend:
+    """Destination that `publish` uploads to; methods are called from several threads at once"""
+
+    def upload(self, local_path, key, content_type, content_encoding=None, cache_control=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+class LocalDirBackend(StorageBackend):
+    """Mirror into a local directory (file://path), e.g. a staging area or a mounted bucket"""
+
+    def __init__(self, location):
+        self.root = os.path.abspath(location)
+
+    def upload(self, local_path, key, content_type, content_encoding=None, cache_control=None):
+        target = os.path.join(self.root, *key.split('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(local_path, target + '.part')
+        os.replace(target + '.part', target)
+
+    def delete(self, key):
+        try:
+            os.remove(os.path.join(self.root, *key.split('/')))
+        except FileNotFoundError:
+            pass
+
+class MemoryBackend(StorageBackend):
+    """In-process fake bucket (mem://name) for tests and offline dry runs"""
+
+    buckets = {}
+
+    def __init__(self, location):
+        self.objects = self.buckets.setdefault(location, {})
+        self.lock = threading.Lock()
+
+    def upload(self, local_path, key, content_type, content_encoding=None, cache_control=None):
+        with open(local_path, 'rb') as f:
+            data = f.read()
+        with self.lock:
+            self.objects[key] = (data, content_type, content_encoding, cache_control, time.time_ns())
+
+    def delete(self, key):
+        with self.lock:
+            self.objects.pop(key, None)
+
+class GCSBackend(StorageBackend):
+    """Google Cloud Storage (gs://bucket/prefix), needs google-cloud-storage"""
+
+    def __init__(self, location):
+        try:
+            from google.cloud import storage
+        except ImportError:
+            raise SystemExit('Publishing to gs:// needs google-cloud-storage: pip install google-cloud-storage')
+        bucket, _, self.prefix = location.partition('/')
+        self.bucket = storage.Client().bucket(bucket)
+
+    def upload(self, local_path, key, content_type, content_encoding=None, cache_control=None):
+        blob = self.bucket.blob(posixpath.join(self.prefix, key))
+        # With Content-Encoding: gzip, GCS transcodes for clients that don't accept gzip
+        blob.content_encoding = content_encoding
+        blob.cache_control = cache_control
+        blob.upload_from_filename(local_path, content_type=content_type)
+
+    def delete(self, key):
+        from google.api_core.exceptions import NotFound
+        try:
+            self.bucket.blob(posixpath.join(self.prefix, key)).delete()
+        except NotFound:
+            pass
+
+class S3Backend(StorageBackend):
+    """Amazon S3 or any S3-compatible store (s3://bucket/prefix), needs boto3"""
+
+    def __init__(self, location):
+        try:
+            import boto3
+        except ImportError:
+            raise SystemExit('Publishing to s3:// needs boto3: pip install boto3')
+        self.bucket, _, self.prefix = location.partition('/')
+        self.client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+
+    def upload(self, local_path, key, content_type, content_encoding=None, cache_control=None):
+        extra_args = {'ContentType': content_type}
+        if content_encoding:
+            extra_args['ContentEncoding'] = content_encoding
+        if cache_control:
+            extra_args['CacheControl'] = cache_control
+        self.client.upload_file(local_path, self.bucket, posixpath.join(self.prefix, key),
+                                ExtraArgs=extra_args)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=posixpath.join(self.prefix, key))
+
+# URL scheme -> backend; register more here
+BACKENDS = {
+    'file': LocalDirBackend,
+    'mem': MemoryBackend,
+    'gs': GCSBackend,
+    's3': S3Backend,
+}
+
+def open_backend(dest):
+    """Instantiate the backend for a destination URL; plain paths mean file://"""
+    scheme, sep, location = dest.partition('://')
+    if not sep:
+        scheme, location = 'file', dest
+    if scheme not in BACKENDS:
+        raise SystemExit(f"Unknown destination scheme '{scheme}://', expected one of: "
+                         + ', '.join(f'{name}://' for name in BACKENDS))
+    if scheme == 'file':
+        location = os.path.abspath(location)
+    backend = BACKENDS[scheme](location)
+    # Canonical form, under which publish state is recorded in the manifest
+    backend.url = f'{scheme}://{location.rstrip("/")}'
+    return backend
+
+class ObjectSource:
+    """A bucket indexed directly instead of a local tree; list_page() is called from several threads at once"""
+
+    def list_page(self, prefix, token=None):
+        """One page of a delimiter listing of the keys below prefix ('' or 'a/b/'), as (names of common
+        prefixes, (name, size, mtime_ns) of objects, token of the next page or None)"""
+        raise NotImplementedError
+
+class LocalDirSource(ObjectSource):
+    """A local folder listed page by page like a bucket (file://path), e.g. one that publish mirrored
+    into, or to try out bucket indexing without a bucket"""
+
+    page_size = 1000
+
+    def __init__(self, location):
+        self.root = os.path.abspath(location)
+        # Sorted names of folders whose listing is only partly paged through
+        self.listed = {}
+        self.lock = threading.Lock()
+
+    def list_page(self, prefix, token=None):
+        path = os.path.join(self.root, *prefix.split('/'))
+        with self.lock:
+            names = self.listed.pop(prefix, None) if token else None
+        if names is None:
+            names = sorted(os.listdir(path))
+        start = bisect.bisect_left(names, token) if token else 0
+        dirs, objects = [], []
+        for name in names[start:start + self.page_size]:
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError as e:
+                # A dangling symlink, or a file deleted since the folder was read
+                print(f'ERROR reading file {os.path.join(path, name)}: {e}')
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(name)
+            else:
+                objects.append((name, st.st_size, st.st_mtime_ns))
+        if start + self.page_size >= len(names):
+            return dirs, objects, None
+        with self.lock:
+            self.listed[prefix] = names
+        return dirs, objects, names[start + self.page_size]
+
+class MemorySource(ObjectSource):
+    """Index a MemoryBackend bucket (mem://name), with the paging and delimiter semantics of S3. The buckets
+    only live in the process that filled them, so this is for tests"""
+
+    page_size = 1000
+
+    def __init__(self, location):
+        objects = MemoryBackend.buckets.get(location, {})
+        self.objects = {key: (len(value[0]), value[4]) for key, value in list(objects.items())}
+        self.keys = sorted(self.objects)
+
+    def list_page(self, prefix, token=None):
+        keys = self.keys
+        i = bisect.bisect_left(keys, token or prefix)
+        dirs, objects = [], []
+        while i < len(keys) and keys[i].startswith(prefix) and len(dirs) + len(objects) < self.page_size:
+            name, slash, _ = keys[i][len(prefix):].partition('/')
+            if slash:
+                dirs.append(name)
+                # Everything below a common prefix is rolled up into it
+                i = bisect.bisect_left(keys, prefix + name + chr(ord('/') + 1))
+            else:
+                objects.append((name, *self.objects[keys[i]]))
+                i += 1
+        return dirs, objects, keys[i] if i < len(keys) and keys[i].startswith(prefix) else None
+
+class GCSSource(ObjectSource):
+    """Google Cloud Storage (gs://bucket/prefix), needs google-cloud-storage"""
+
+    def __init__(self, location):
+        try:
+            from google.cloud import storage
+        except ImportError:
+            raise SystemExit('Indexing gs:// needs google-cloud-storage: pip install google-cloud-storage')
+        bucket, _, prefix = location.partition('/')
+        self.prefix = prefix + '/' if prefix else ''
+        self.bucket = storage.Client().bucket(bucket)
+
+    def list_page(self, prefix, token=None):
+        iterator = self.bucket.list_blobs(prefix=self.prefix + prefix, delimiter='/', page_token=token)
+        page = next(iterator.pages)
+        objects = [(blob.name[len(self.prefix + prefix):], blob.size, int(blob.updated.timestamp() * 1e6) * 1000)
+                   for blob in page]
+        dirs = [name[len(self.prefix + prefix):].rstrip('/') for name in page.prefixes]
+        return dirs, objects, iterator.next_page_token
+
+class S3Source(ObjectSource):
+    """Amazon S3 or any S3-compatible store (s3://bucket/prefix, S3_ENDPOINT_URL for others), needs boto3"""
+
+    def __init__(self, location):
+        try:
+            import boto3
+        except ImportError:
+            raise SystemExit('Indexing s3:// needs boto3: pip install boto3')
+        self.bucket, _, prefix = location.partition('/')
+        self.prefix = prefix + '/' if prefix else ''
+        self.client = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+
+    def list_page(self, prefix, token=None):
+        kwargs = {'ContinuationToken': token} if token else {}
+        response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix + prefix, Delimiter='/',
+                                               **kwargs)
+        objects = [(item['Key'][len(self.prefix + prefix):], item['Size'],
+                    int(item['LastModified'].timestamp() * 1e6) * 1000) for item in response.get('Contents', ())]
+        dirs = [item['Prefix'][len(self.prefix + prefix):].rstrip('/') for item in response.get('CommonPrefixes', ())]
+        return dirs, objects, response.get('NextContinuationToken') if response.get('IsTruncated') else None
+
+# URL scheme -> source for indexing a bucket directly; register more here
+SOURCES = {
+    'file': LocalDirSource,
+    'mem': MemorySource,
+    'gs': GCSSource,
+    's3': S3Source,
+}
+
+def open_source(top_dir):
+    """ObjectSource for a bucket URL given as the top folder, or None for a local folder"""
+    scheme, sep, location = top_dir.partition('://')
+    if not sep:
+        return None
+    if scheme not in SOURCES:
+        raise SystemExit(f"Unknown source scheme '{scheme}://', expected a folder or one of: "
+                         + ', '.join(f'{name}://' for name in SOURCES))
+    return SOURCES[scheme](location.rstrip('/'))
+
+def list_prefix(source, prefix, matcher=None):
+    """Read one level of a bucket through all pages of its delimiter listing, like scan_dir(): returns
+    (dirs, file rows, entries the matcher skipped). Rows of wide prefixes are spilled to disk"""
+    dirs, files = [], []
+    skipped = Counter()
+    token = None
+    while True:
+        subdirs, objects, token = source.list_page(prefix, token)
+        for name in subdirs:
+            # Keys with an empty path component cannot be shown as a folder
+            if not name or (not prefix and name == support_dir_name):
+                continue
+            if matcher and matcher.skips(prefix, name, True):
+                skipped['dirs_pruned'] += 1
+                continue
+            dirs.append(name)
+        for name, size, mtime_ns in objects:
+            # Folder placeholders and what an earlier publish put there; pages other than index.html are
+            # told apart by the manifest, in scan_files()
+            if not name or is_generated_file(name):
+                continue
+            if matcher and matcher.skips(prefix, name, False):
+                skipped['files_excluded'] += 1
+                continue
+            if isinstance(files, SpillSorter):
+                files.add(FileEntry(name, size, mtime_ns))
+                continue
+            files.append(FileEntry(name, size, mtime_ns))
+            if len(files) > LISTING_BUFFER_ROWS:
+                rows = SpillSorter(FileEntry)
+                for row in files:
+                    rows.add(row)
+                files = rows
+        if not token:
+            return dirs, files, skipped
+
+def walk_bucket(source, top_dir, matcher=None, pool=None, ahead=0):
+    """walk_tree() for an ObjectSource: the same bottom-up (parentdir, dirs, file rows) listings, with
+    parentdir a path below the top_dir URL. A prefix that cannot be listed comes out as (parentdir, None,
+    error message), so the run counts it as failed. With a pool, up to `ahead` prefixes are listed ahead
+    of the walk"""
+    def location(prefix):
+        return os.path.join(top_dir, *prefix.split('/')[:-1])
+
+    def read(prefix):
+        dirs, files, skipped = list_prefix(source, prefix, matcher)
+        return (dirs, files, skipped), [prefix + name + '/' for name in sorted(dirs)]
+
+    def report(prefix, e):
+        return None, f'ERROR listing {location(prefix)}: {e}', None
+
+    for prefix, (dirs, files, skipped) in walk_ahead(read, report, '', pool, ahead):
+        if matcher and skipped:
+            matcher.counts.update(skipped)
+        yield location(prefix), dirs, files
+
+def publish_plan(db, top_dir, pages_dir=None):
+    """Everything the manifest says should be in the bucket, as {key: (local path, signature, encoding)}.
+    Listed files come from the tree and pages from pages_dir, which is the tree too unless --output was used.
+    The files of an indexed bucket are not uploaded again, only its pages"""
+    wanted = {}
+    if not db.execute("SELECT 1 FROM settings WHERE name = 'source'").fetchone():
+        for rel_path, entries in db.execute('SELECT path, entries FROM dirs').fetchall():
+            parentdir = os.path.join(top_dir, rel_path)
+            for name, size, mtime_ns, _ in listing_files(db, rel_path, json.loads(entries)):
+                wanted[object_key(rel_path, name)] = (os.path.join(parentdir, name), f'{size}:{mtime_ns}', None)
+    for key, digest, encoding in db.execute('SELECT path, digest, encoding FROM pages'):
+        wanted[key] = (os.path.join(pages_dir or top_dir, *key.split('/')), digest, encoding)
+    return wanted
+
+def upload_with_retries(backend, local_path, key, content_encoding, retries):
+    """Upload one object, backing off exponentially between failed attempts"""
+    # index.html.gz is still text/html, only with a Content-Encoding
+    type_key = key
+    if content_encoding and key.endswith(COMPRESSED_SUFFIXES[content_encoding]):
+        type_key = key[:-len(COMPRESSED_SUFFIXES[content_encoding])]
+    content_type = mimetypes.guess_type(type_key)[0] or 'application/octet-stream'
+    # Hashed assets never change under the same name
+    cache_control = ASSET_CACHE_CONTROL if key.startswith(f'{support_dir_name}/assets/') else None
+    for attempt in range(retries + 1):
+        try:
+            backend.upload(local_path, key, content_type, content_encoding, cache_control)
+            return
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
+def publish(top_dir, opts):
+    """Upload what changed since the last publish to the same destination, using the generator's manifest"""
+    manifest_path = manifest_location(top_dir, opts)
+    if not os.path.exists(manifest_path):
+        print(f'***ERROR*** no manifest at {manifest_path}, generate the indexes first')
+        return 1
+    db = open_manifest(manifest_path)
+    row = db.execute("SELECT value FROM settings WHERE name = 'output'").fetchone()
+    if row and not os.path.isdir(row[0]):
+        print(f'***ERROR*** the pages were written to the archive {row[0]}, generate them with --output to publish')
+        return 1
+    backend = open_backend(opts.dest)
+
+    wanted = publish_plan(db, top_dir, row[0] if row else top_dir)
+    published = dict(db.execute('SELECT key, signature FROM published WHERE dest = ?', (backend.url,)))
+    if opts.full:
+        # Forget the signatures but keep the keys, so --delete still knows what it owns
+        published = dict.fromkeys(published, None)
+    uploads = sorted(key for key, (_, signature, _) in wanted.items() if published.get(key) != signature)
+    deletes = sorted(set(published) - set(wanted)) if opts.delete else []
+    print(f'{len(uploads)} to upload, {len(deletes)} to delete, '
+          f'{len(wanted) - len(uploads)} unchanged')
+
+    if opts.dryrun:
+        for key in uploads:
+            print(f'Would upload: {key}')
+        for key in deletes:
+            print(f'Would delete: {key}')
+        db.close()
+        return 0
+
+    errors = []
+    done = 0
+    total = len(uploads) + len(deletes)
+    last_progress = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, opts.jobs)) as pool:
+        futures = {pool.submit(upload_with_retries, backend, wanted[key][0], key, wanted[key][2], opts.retries):
+                   ('upload', key) for key in uploads}
+        futures.update({pool.submit(backend.delete, key): ('delete', key) for key in deletes})
+        for future in as_completed(futures):
+            action, key = futures[future]
+            done += 1
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(f'Cannot {action} {key}: {e}')
+                print(errors[-1])
+                continue
+
+            # Record progress as it happens so an interrupted publish resumes where it stopped
+            if action == 'upload':
+                db.execute('INSERT OR REPLACE INTO published (dest, key, signature) VALUES (?, ?, ?)',
+                           (backend.url, key, wanted[key][1]))
+            else:
+                db.execute('DELETE FROM published WHERE dest = ? AND key = ?', (backend.url, key))
+            if opts.verbose:
+                print(f'{"Uploaded" if action == "upload" else "Deleted"} [{done}/{total}]: {key}')
+            elif time.monotonic() - last_progress > 2:
+                print(f'Progress: {done}/{total}')
+                last_progress = time.monotonic()
+            if done % 500 == 0:
+                db.commit()
+
+    db.commit()
+    db.close()
+    print(f'Published {done - len(errors)}/{total} changes to {backend.url}')
+    if errors:
+        print(f'{len(errors)} error(s) during publish')
+        return 1
+    return 0
+
+def publish_main(argv):
+    """Command line of the `publish` subcommand"""
+    parser = argparse.ArgumentParser(prog='encrypt_indexpage.py publish', description='''DESCRIPTION:
+    Upload the generated indexes and listed files to an object store.
+    Only what changed since the last publish to the same destination is sent,
+    based on the manifest written by the generator.''')
+
+    parser.add_argument('top_dir',
+                      nargs='?',
+                      action='store',
+                      help='top folder that was indexed, use current folder if not specified',
+                      default=os.getcwd())
+
+    parser.add_argument('--dest', '-t',
+                      help='destination: gs://bucket/prefix, s3://bucket/prefix or file://path '
+                           '(mem://name is an in-process fake that only tests can read back)',
+                      required=True)
+
+    parser.add_argument('--manifest', '-m',
+                      help=f'manifest written by the generator (default: {manifest_file_name} in the top folder, '
+                           'or in the --output folder)',
+                      required=False)
+
+    parser.add_argument('--output', '-o',
+                      metavar='DIR',
+                      help='folder the pages were generated into with --output',
+                      required=False)
+
+    parser.add_argument('--jobs', '-j',
+                      type=int,
+                      default=8,
+                      help='number of concurrent uploads (default: 8)',
+                      required=False)
+
+    parser.add_argument('--retries', '-r',
+                      type=int,
+                      default=3,
+                      help='retries per object before giving up (default: 3)',
+                      required=False)
+
+    parser.add_argument('--delete',
+                      action='store_true',
+                      help='delete previously published objects that are gone locally',
+                      required=False)
+
+    parser.add_argument('--full',
+                      action='store_true',
+                      help='upload everything again, e.g. after the bucket was modified by hand',
+                      required=False)
+
+    parser.add_argument('--verbose', '-v',
+                      action='store_true',
+                      help='print every uploaded object',
+                      required=False)
+
+    parser.add_argument('--dryrun', '-d',
+                      action='store_true',
+                      help="only list what would be uploaded or deleted",
+                      required=False)
+
+    # Pages streamed into an archive cannot be published, so there is no --output-tar
+    parser.set_defaults(output_tar=None)
+    opts = parser.parse_args(argv)
+    return publish(opts.top_dir, opts)
+
+def preview_manifest(top_dir):
+    """URI opening the manifest of a tree indexed before read-only, so `serve` never writes to it; None
+    for a tree without one"""
+    path = os.path.join(top_dir, manifest_file_name)
+    return pathlib.Path(path).resolve().as_uri() + '?mode=ro' if os.path.exists(path) else None
+
+def preview_salt(manifest):
+    """KDF salt of a tree indexed before, so a login remembered for the published pages works on the
+    preview too; a fresh salt otherwise"""
+    if manifest:
+        try:
+            db = sqlite3.connect(manifest, uri=True)
+            try:
+                row = db.execute("SELECT value FROM settings WHERE name = 'salt'").fetchone()
+            finally:
+                db.close()
+            if row:
+                return bytes.fromhex(row[0])
+        except sqlite3.Error:
+            pass
+    return secrets.token_bytes(16)
+
+class PageCache:
+    """Rendered pages of `serve` with their ETag, least recently used first out. Every page is kept with
+    the stamp of what it was rendered from and rendered again once that changed"""
+
+    def __init__(self, size):
+        self.size = size
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, stamp, render):
+        """(body, etag) of a page, from the cache while its stamp is unchanged; render() returns the body,
+        or None for a page that does not exist"""
+        with self.lock:
+            cached = self.pages.get(key)
+            if cached is not None and cached[0] == stamp:
+                self.pages.move_to_end(key)
+                return cached[1:]
+        # Rendered outside the lock, so a slow folder does not hold up every other request
+        body = render()
+        if body is None:
+            return None, None
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        with self.lock:
+            self.pages[key] = (stamp, body, etag)
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+        return body, etag
+
+class PreviewServer(http.server.HTTPServer):
+    """HTTP server of `serve`, handling requests on a fixed pool of threads rather than a thread each"""
+
+    def __init__(self, address, top_dir, cipher, opts):
+        self.top_dir = os.path.abspath(top_dir)
+        self.cipher = cipher
+        self.opts = opts
+        self.matcher = path_matcher(top_dir, opts)
+        self.manifest = preview_manifest(top_dir)
+        # sqlite connections stay on the thread that opened them
+        self.local = threading.local()
+        self.page_cache = PageCache(opts.cache_pages)
+        self.assets = {asset_name(name): name for name in ASSETS}
+        self.pool = ThreadPoolExecutor(max_workers=opts.jobs)
+        super().__init__(address, functools.partial(PreviewHandler, directory=self.top_dir))
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_on_pool, request, client_address)
+
+    def process_request_on_pool(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+
+    def hidden(self, parts, is_dir):
+        """Whether a path below the top folder is left out of the listings, and so not served either"""
+        for index, name in enumerate(parts):
+            if index == 0 and name == support_dir_name:
+                return True
+            prefix = ''.join(part + '/' for part in parts[:index])
+            if self.matcher.skips(prefix, name, is_dir or index < len(parts) - 1):
+                return True
+        return False
+
+    def generated(self, rel_path):
+        """Pages the manifest records as written into a folder, which stay out of the preview"""
+        if self.manifest is None:
+            return frozenset()
+        try:
+            if getattr(self.local, 'db', None) is None:
+                self.local.db = sqlite3.connect(self.manifest, uri=True)
+            return recorded_pages(self.local.db, rel_path)
+        except sqlite3.Error:
+            return frozenset()
+
+    def render_listing(self, parentdir, page):
+        """Encrypted page of a folder's listing, as the generator would write it but without folder totals,
+        which would take walking everything below it"""
+        rel_path = os.path.relpath(parentdir, self.top_dir)
+        dirs, files, _ = scan_dir(parentdir, parentdir == self.top_dir, self.matcher)
+        rows = None
+        try:
+            rows = scan_files(parentdir, files, generated=self.generated(rel_path))
+            if not 1 <= page <= listing_page_count(dirs, rows, self.opts.page_size):
+                return None
+            archives = ({row.name for row in rows if row.name.lower().endswith(ARCHIVE_SUFFIXES)}
+                        if self.opts.archive_contents else None)
+            content = generate_directory_listing(parentdir, dirs, rows, page=page, page_size=self.opts.page_size,
+                                                 head=listing_head(rel_path), archives=archives)
+        finally:
+            for listing in (files, rows):
+                if isinstance(listing, SpillSorter):
+                    listing.close()
+        return render_login_page(content, self.cipher, self.opts, rel_path).encode('utf-8')
+
+    def render_archive(self, path):
+        """Encrypted contents page of an archive"""
+        rel_path = os.path.relpath(os.path.dirname(path), self.top_dir)
+        entries, more = peek_archive(path)
+        content = generate_archive_listing(os.path.basename(path), entries, more, head=listing_head(rel_path))
+        return render_login_page(content, self.cipher, self.opts, rel_path).encode('utf-8')
+
+class PreviewHandler(http.server.SimpleHTTPRequestHandler):
+    """Requests of `serve`: listing pages are rendered from the tree, assets come from memory, and the
+    listed files are served as they are"""
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def respond(self, send_body):
+        server = self.server
+        abs_path = self.translate_path(self.path)
+        rel_path = os.path.relpath(abs_path, server.top_dir)
+        parts = [] if rel_path == os.curdir else rel_path.split(os.sep)
+        parentdir, name = os.path.split(abs_path.rstrip(os.sep)) if parts else (server.top_dir, '')
+
+        # Assets are named by their content, so they never change
+        if len(parts) == 3 and parts[:2] == [support_dir_name, 'assets'] and parts[2] in server.assets:
+            body = ASSETS[server.assets[parts[2]]].encode('utf-8')
+            return self.send_page(body, f'"{parts[2]}"', send_body, ASSET_CACHE_CONTROL,
+                                  mimetypes.guess_type(parts[2])[0])
+        is_dir = os.path.isdir(abs_path)
+        if server.hidden(parts, is_dir):
+            return self.send_error(404)
+
+        if is_dir:
+            if not self.path.split('?', 1)[0].endswith('/'):
+                # Redirected, so relative links resolve against the folder
+                return super().do_HEAD() if not send_body else super().do_GET()
+            parentdir, name = abs_path.rstrip(os.sep) or os.sep, index_file_name
+        pages = server.generated(os.path.relpath(parentdir, server.top_dir))
+        # A listed file named like a page is served as it is
+        listed = not is_dir and os.path.isfile(abs_path) and not is_generated_entry(parentdir, name, pages)
+        match = PAGE_FILE_RE.match(name)
+        archive_match = ARCHIVE_PAGE_RE.match(name)
+        try:
+            if listed:
+                return super().do_HEAD() if not send_body else super().do_GET()
+            if match and not match.group(2) and os.path.isdir(parentdir):
+                page = int(match.group(1) or 1)
+                body, etag = server.page_cache.get((parentdir, page), dir_stamp(parentdir),
+                                                   lambda: server.render_listing(parentdir, page))
+            elif (server.opts.archive_contents and archive_match and not archive_match.group(2)
+                  and os.path.isfile(os.path.join(parentdir, archive_match.group(1)))):
+                archive = os.path.join(parentdir, archive_match.group(1))
+                st = os.stat(archive)
+                body, etag = server.page_cache.get(archive, (st.st_ino, st.st_size, st.st_mtime_ns),
+                                                   lambda: server.render_archive(archive))
+            elif is_generated_file(name, pages):
+                return self.send_error(404)
+            else:
+                return super().do_HEAD() if not send_body else super().do_GET()
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            return self.send_error(404, str(e))
+        if body is None:
+            return self.send_error(404)
+        return self.send_page(body, etag, send_body, 'no-cache', 'text/html; charset=utf-8')
+
+    def send_page(self, body, etag, send_body, cache_control, content_type):
+        """Send a page from memory, or 304 Not Modified when the browser already has it"""
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type or 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.opts.verbose:
+            super().log_message(format, *args)
+
+def serve(top_dir, opts):
+    """Serve the listings of a tree rendered on the fly, writing nothing into it"""
+    # Key derivation is deliberately slow, so it happens once per server
+    cipher = PageCipher(opts.password, preview_salt(preview_manifest(top_dir)), opts.kdf_iterations)
+    server = PreviewServer((opts.bind, opts.port), top_dir, cipher, opts)
+    host, port = server.server_address[:2]
+    print(f'Serving {top_dir} at http://{host}:{port}/, press Ctrl-C to stop')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopped serving')
+    finally:
+        server.server_close()
+
+def serve_main(argv):
+    """Command line of the `serve` subcommand"""
+    parser = argparse.ArgumentParser(prog='encrypt_indexpage.py serve', description='''DESCRIPTION:
+    Preview the encrypted listings of a folder in the browser without writing anything.
+    Pages are rendered when they are requested and kept in memory until their folder changes.''')
+
+    parser.add_argument('top_dir',
+                      nargs='?',
+                      action='store',
+                      help='top folder to serve, use current folder if not specified',
+                      default=os.getcwd())
+
+    parser.add_argument('--password', '-p',
+                      help='password for the listings',
+                      required=True)
+
+    parser.add_argument('--bind',
+                      default='127.0.0.1',
+                      help='address to listen on (default: 127.0.0.1)',
+                      required=False)
+
+    parser.add_argument('--port',
+                      type=int,
+                      default=8000,
+                      help='port to listen on, 0 for any free one (default: 8000)',
+                      required=False)
+
+    parser.add_argument('--jobs', '-j',
+                      type=int,
+                      default=8,
+                      help='number of requests handled at once (default: 8)',
+                      required=False)
+
+    parser.add_argument('--cache-pages',
+                      type=int,
+                      default=256,
+                      help='rendered pages kept in memory (default: 256)',
+                      required=False)
+
+    parser.add_argument('--filter', '-f',
+                      help='only include files matching glob (same as --include)',
+                      required=False)
+
+    parser.add_argument('--include',
+                      action='append',
+                      metavar='PATTERN',
+                      help='only list files matching this glob; repeat for more patterns',
+                      required=False)
+
+    parser.add_argument('--exclude',
+                      action='append',
+                      metavar='PATTERN',
+                      help='leave out files and folders matching this glob; repeat for more patterns',
+                      required=False)
+
+    parser.add_argument('--ignore-file',
+                      metavar='FILE',
+                      help=f'file with one exclude pattern per line (default: {ignore_file_name} in the top folder)',
+                      required=False)
+
+    parser.add_argument('--footer', '-b',
+                      help='footer text to display on login page',
+                      required=False)
+
+    parser.add_argument('--page-size',
+                      type=int,
+                      help='split listings into index.html, index-2.html, ... of at most N entries',
+                      required=False)
+
+    parser.add_argument('--archive-contents',
+                      action='store_true',
+                      help='give every .zip and uncompressed .tar file a page listing its contents',
+                      required=False)
+
+    parser.add_argument('--kdf-iterations',
+                      type=int,
+                      default=KDF_ITERATIONS,
+                      help=f'PBKDF2 iterations for the page key (default: {KDF_ITERATIONS})',
+                      required=False)
+
+    parser.add_argument('--verbose', '-v',
+                      action='store_true',
+                      help='log every request',
+                      required=False)
+
+    # Nothing is written, so there is no output to keep out of the listings
+    parser.set_defaults(output=None, output_tar=None)
+    opts = parser.parse_args(argv)
+    if not os.path.isdir(opts.top_dir):
+        parser.error(f'{opts.top_dir} is not a folder')
+    if opts.page_size is not None and opts.page_size < 1:
+        parser.error("--page-size needs at least 1 entry per page")
+    if opts.jobs < 1:
+        parser.error("--jobs needs at least 1 thread")
+    return serve(opts.top_dir, opts)
+
+# Bytes pretty-printing
+UNITS_MAPPING = [
+    (1024 ** 5, ' PB'),
+    (1024 ** 4, ' TB'),
+    (1024 ** 3, ' GB'),
+    (1024 ** 2, ' MB'),
+    (1024 ** 1, ' KB'),
+    (1024 ** 0, (' byte', ' bytes')),
+]
+
+def pretty_size(bytes, units=UNITS_MAPPING):
+    """Human-readable file sizes."""
+    for factor, suffix in units:
+        if bytes >= factor:
+            break
+    amount = int(bytes / factor)
+
     if isinstance(suffix, tuple):
         singular, multiple = suffix
         if amount == 1:
@@ -618,26 +4257,47 @@ def pretty_size(bytes, units=UNITS_MAPPING):
             suffix = multiple
     return str(amount) + suffix
 
-if __name__ == "__main__":
+def build_parser():
+    """Command line of the generator"""
     parser = argparse.ArgumentParser(description='''DESCRIPTION:
     Generate directory index files recursively.
-    Only the top-level index.html is encrypted with password protection.
+    Every index.html is encrypted with AES-GCM under a key derived from the password.
     Start from current dir or from folder passed as first positional argument.
-    Optionally filter by file types with --filter "*.py".''')
+    Optionally filter by file types with --include "*.py" and skip whole folders with --exclude node_modules/.''')
 
     parser.add_argument('top_dir',
                       nargs='?',
                       action='store',
                       help='top folder from which to start generating indexes, '
-                           'use current folder if not specified',
+                           'use current folder if not specified; or a bucket to index directly: '
+                           's3://bucket/prefix, gs://bucket/prefix or file://path '
+                           '(mem://name only works in-process, from tests; it is empty from the command line)',
                       default=os.getcwd())
 
     parser.add_argument('--password', '-p',
-                      help='password to encrypt the top-level index file',
+                      help='password to encrypt the index files',
                       required=True)
 
     parser.add_argument('--filter', '-f',
-                      help='only include files matching glob',
+                      help='only include files matching glob (same as --include)',
+                      required=False)
+
+    parser.add_argument('--include',
+                      action='append',
+                      metavar='PATTERN',
+                      help='only list files matching this glob; repeat for more patterns',
+                      required=False)
+
+    parser.add_argument('--exclude',
+                      action='append',
+                      metavar='PATTERN',
+                      help='leave out files and folders matching this glob, without walking excluded folders; '
+                           'a trailing / matches folders only; repeat for more patterns',
+                      required=False)
+
+    parser.add_argument('--ignore-file',
+                      metavar='FILE',
+                      help=f'file with one exclude pattern per line (default: {ignore_file_name} in the top folder)',
                       required=False)
 
     parser.add_argument('--verbose', '-v',
@@ -654,9 +4314,202 @@ if __name__ == "__main__":
                       help='footer text to display on login page',
                       required=False)
 
+    parser.add_argument('--kdf-iterations',
+                      type=int,
+                      default=KDF_ITERATIONS,
+                      help=f'PBKDF2 iterations for the page key (default: {KDF_ITERATIONS})',
+                      required=False)
+
+    parser.add_argument('--precompress',
+                      action='append',
+                      choices=sorted(COMPRESSED_SUFFIXES),
+                      help='also write index.html.gz / index.html.br next to every page (repeatable)',
+                      required=False)
+
+    parser.add_argument('--compressed-pages',
+                      action='store_true',
+                      help='store index.html itself gzipped, to be served with Content-Encoding: gzip',
+                      required=False)
+
+    parser.add_argument('--incremental', '-i',
+                      action='store_true',
+                      help='only re-render directories whose listing changed since the last run',
+                      required=False)
+
+    parser.add_argument('--resume',
+                      action='store_true',
+                      help='continue an interrupted run, skipping the directories it finished that gained, lost or '
+                           'renamed no entry since (files rewritten in place are not noticed)',
+                      required=False)
+
+    parser.add_argument('--jobs', '-j',
+                      type=int,
+                      default=1,
+                      help='number of directories to stat, render and write in parallel',
+                      required=False)
+
+    parser.add_argument('--mode',
+                      choices=['pages', 'spa'],
+                      default='pages',
+                      help='pages: one index.html per directory (default); '
+                           'spa: one viewer page plus an encrypted tree manifest',
+                      required=False)
+
+    parser.add_argument('--shard-depth',
+                      type=int,
+                      default=0,
+                      help='with --mode spa, split the tree manifest into one shard per directory '
+                           'at this depth (default: 0, a single manifest)',
+                      required=False)
+
+    parser.add_argument('--search',
+                      action='store_true',
+                      help='build an encrypted filename search index and add a search box to every listing',
+                      required=False)
+
+    parser.add_argument('--page-size',
+                      type=int,
+                      help='split listings into index.html, index-2.html, ... of at most N entries',
+                      required=False)
+
+    parser.add_argument('--watch', '-w',
+                      action='store_true',
+                      help='keep running and re-render only the directories that change',
+                      required=False)
+
+    parser.add_argument('--watch-debounce',
+                      type=float,
+                      default=1.0,
+                      help='seconds without changes before a burst is processed (default: 1)',
+                      required=False)
+
+    parser.add_argument('--watch-poll',
+                      action='store_true',
+                      help='poll instead of using inotify, e.g. on network filesystems',
+                      required=False)
+
+    parser.add_argument('--watch-interval',
+                      type=float,
+                      default=60.0,
+                      help='seconds between rescans when polling (default: 60)',
+                      required=False)
+
+    parser.add_argument('--stats',
+                      action='store_true',
+                      help='print per-phase timings, counters, slowest directories and peak memory',
+                      required=False)
+
+    parser.add_argument('--stats-json',
+                      help='also write those statistics as JSON to this file',
+                      required=False)
+
+    parser.add_argument('--profile',
+                      help='run under cProfile and write the profile to this file '
+                           '(worker threads are only profiled with --jobs 1)',
+                      required=False)
+
+    parser.add_argument('--manifest', '-m',
+                      help='manifest used by incremental runs '
+                           f'(default: {manifest_file_name} next to the pages)',
+                      required=False)
+
+    parser.add_argument('--checksums',
+                      action='store_true',
+                      help='show the SHA-256 of every file in the listings; files are only read again once '
+                           f'they change, the checksums are cached in {checksum_cache_file_name} next to the manifest',
+                      required=False)
+
+    parser.add_argument('--sha256sums',
+                      action='store_true',
+                      help=f'also write a {checksums_file_name} file for sha256sum -c into every folder '
+                           '(implies --checksums)',
+                      required=False)
+
+    parser.add_argument('--archive-contents',
+                      action='store_true',
+                      help='give every .zip and uncompressed .tar file a page listing its contents, read from '
+                           'the zip directory or tar headers only and cached between runs',
+                      required=False)
+
+    parser.add_argument('--checksum-jobs',
+                      type=int,
+                      help='number of processes hashing files (default: up to 4, one per CPU)',
+                      required=False)
+
+    parser.add_argument('--checksum-rate',
+                      type=float,
+                      metavar='MIB_PER_S',
+                      help='read at most this many MiB/s for hashing, to leave I/O for everything else',
+                      required=False)
+
+    parser.add_argument('--list-jobs',
+                      type=int,
+                      help='number of directories (or bucket prefixes) read and batches of files stat\'ed at once, '
+                           'for high-latency mounts such as NFS or sshfs (default: 16 for a bucket URL, 1 otherwise)',
+                      required=False)
+
+    parser.add_argument('--output', '-o',
+                      metavar='DIR',
+                      help='write the pages into a mirror of the tree in DIR instead of next to the files, '
+                           'so the tree itself can be read-only',
+                      required=False)
+
+    parser.add_argument('--output-tar',
+                      metavar='FILE',
+                      help='stream the pages into a single archive instead: .tar, .tar.gz, .tgz, .tar.bz2, '
+                           '.tar.xz or .zip',
+                      required=False)
+
+    return parser
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['publish']:
+        sys.exit(publish_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['serve']:
+        sys.exit(serve_main(sys.argv[2:]))
+
+    parser = build_parser()
     config = parser.parse_args()
     
     if not config.password:
         parser.error("Password is required. Use --password to specify.")
-        
-    process_dir(config.top_dir, config.password, config)
+
+    if config.page_size is not None and config.page_size < 1:
+        parser.error("--page-size needs at least 1 entry per page")
+    if config.output and config.output_tar:
+        parser.error("--output and --output-tar are mutually exclusive")
+    if '://' in config.top_dir:
+        # Pages cannot be written into a bucket, and its files are not read
+        if not (config.output or config.output_tar):
+            parser.error("indexing a bucket needs --output or --output-tar for the pages")
+        if config.checksums or config.sha256sums or config.archive_contents or config.watch:
+            parser.error("--checksums, --sha256sums, --archive-contents and --watch only work on local folders")
+    if config.output_tar:
+        if not config.output_tar.endswith(('.zip',) + tuple(suffix for suffix, _ in ArchiveOutput.TAR_MODES)):
+            parser.error("--output-tar needs a .tar, .tar.gz, .tgz, .tar.bz2, .tar.xz or .zip file name")
+        # An archive is written from scratch, so there are no earlier pages to keep or refresh
+        if config.incremental or config.watch or config.resume:
+            parser.error("--output-tar cannot be combined with --incremental, --resume or --watch")
+
+    # Watching keeps the manifest up to date between refreshes, which a dry run must not touch
+    if config.watch and config.dryrun:
+        parser.error("--watch cannot be combined with --dryrun")
+
+    if config.archive_contents and config.mode == 'spa':
+        parser.error("--archive-contents needs --mode pages")
+
+    if 'br' in (config.precompress or ()):
+        try:
+            import brotli
+        except ImportError:
+            parser.error("--precompress br needs the brotli module: pip install brotli")
+
+    if config.watch:
+        watch_dir(config.top_dir, config.password, config)
+    elif config.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(process_dir, config.top_dir, config.password, config)
+        profiler.dump_stats(config.profile)
+        print(f'Profile written to {config.profile} (inspect with: python -m pstats {config.profile})')
+    else:
+        process_dir(config.top_dir, config.password, config)
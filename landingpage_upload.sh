@@ -1,13 +1,10 @@
 #!/bin/sh
 start=`date +%s`
-echo "Purge directory indices"
-find ./ -iname "index.html" -delete
-
 echo "Generating indices and encrypting frontpage..."
-python3 encrypt_indexpage.py ./ --password $1 --verbose
+python3 encrypt_indexpage.py ./ --password $1 --verbose --incremental
 
-echo "Sync with Google Cloud Storage..."
-gsutil -m rsync -r -d . gs://your-bucket-name
+echo "Publish changes to Google Cloud Storage..."
+python3 encrypt_indexpage.py publish ./ --dest gs://your-bucket-name --delete
 
 end=`date +%s`
 echo "Operation completed in $(($end-$start))s"
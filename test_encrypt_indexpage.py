@@ -0,0 +1,162 @@
+"""Bucket listing (delimiter paging of the in-process and local folder sources, the bottom-up walk), the
+script's own files among the listed ones, and publishing to the in-process bucket.
+Run with: python -m pytest -q"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import encrypt_indexpage as indexer
+
+KEYS = ['a.txt', 'd/b.txt', 'd/e/c.txt', 'd/f.txt', 'index.html', 'z/x.bin', 'zz.txt', '_vault/assets/x.css']
+
+@pytest.fixture(params=['mem', 'file'])
+def source(request, monkeypatch, tmp_path):
+    """The same keys behind either source, listed one entry per page"""
+    if request.param == 'mem':
+        monkeypatch.setattr(indexer.MemoryBackend, 'buckets', {})
+        objects = indexer.MemoryBackend('test').objects
+        for key in KEYS:
+            objects[key] = (key.encode('utf-8'), 'text/plain', None, None, 1000)
+        source = indexer.MemorySource('test')
+    else:
+        for key in KEYS:
+            path = tmp_path.joinpath(*key.split('/'))
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(key.encode('utf-8'))
+        source = indexer.LocalDirSource(str(tmp_path))
+    source.page_size = 1
+    return source
+
+def test_list_prefix_rolls_up_common_prefixes(source):
+    dirs, files, skipped = indexer.list_prefix(source, '')
+    assert dirs == ['d', 'z']
+    assert [(row.name, row.size) for row in files] == [('a.txt', 5), ('zz.txt', 6)]
+    assert not skipped
+
+    dirs, files, _ = indexer.list_prefix(source, 'd/')
+    assert dirs == ['e']
+    assert [row.name for row in files] == ['b.txt', 'f.txt']
+
+def test_list_prefix_counts_what_the_matcher_skips(source, tmp_path):
+    matcher = indexer.PathMatcher(str(tmp_path), [], ['z/', 'f.txt'])
+    dirs, files, skipped = indexer.list_prefix(source, '', matcher)
+    assert dirs == ['d']
+    assert skipped == {'dirs_pruned': 1}
+    _, files, skipped = indexer.list_prefix(source, 'd/', matcher)
+    assert [row.name for row in files] == ['b.txt']
+    assert skipped == {'files_excluded': 1}
+
+@pytest.mark.parametrize('jobs', [0, 4])
+def test_walk_bucket_is_bottom_up(source, jobs):
+    pool = ThreadPoolExecutor(max_workers=jobs) if jobs else None
+    try:
+        listings = list(indexer.walk_bucket(source, 'mem://test', pool=pool, ahead=2 * jobs))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    top = 'mem://test'
+    assert [parentdir for parentdir, _, _ in listings] == [
+        os.path.join(top, 'd', 'e'), os.path.join(top, 'd'), os.path.join(top, 'z'), top]
+    assert [[row.name for row in files] for _, _, files in listings] == [
+        ['c.txt'], ['b.txt', 'f.txt'], ['x.bin'], ['a.txt', 'zz.txt']]
+
+def index(tmp_path, *args):
+    """Run the generator on the tree under tmp_path with a cheap key derivation"""
+    opts = indexer.build_parser().parse_args([str(tmp_path), '--password', 'secret', '--kdf-iterations', '1000',
+                                              *args])
+    return indexer.process_dir(opts.top_dir, opts.password, opts)
+
+def test_pages_are_recognised_without_the_manifest(tmp_path, capsys):
+    for n in range(5):
+        tmp_path.joinpath(f'{n}.txt').write_text(str(n))
+    index(tmp_path, '--page-size', '2')
+    assert tmp_path.joinpath('index-3.html').exists()
+    tmp_path.joinpath(indexer.manifest_file_name).unlink()
+    capsys.readouterr()
+
+    index(tmp_path, '--page-size', '2', '--incremental')
+    out = capsys.readouterr().out
+    assert 'listed file' not in out
+    assert '0 failed' in out
+    assert sorted(p.name for p in tmp_path.glob('index*.html')) == ['index-2.html', 'index-3.html', 'index.html']
+
+def test_stale_pages_are_removed_under_a_filter(tmp_path, capsys):
+    for n in range(7):
+        tmp_path.joinpath(f'{n}.jpg').write_text(str(n))
+    index(tmp_path, '--page-size', '3', '--filter', '*.jpg')
+    assert tmp_path.joinpath('index-3.html').exists()
+    for n in range(3, 7):
+        tmp_path.joinpath(f'{n}.jpg').unlink()
+
+    stats = index(tmp_path, '--page-size', '3', '--filter', '*.jpg')
+    assert sorted(p.name for p in tmp_path.glob('index*.html')) == ['index.html']
+    assert stats.counters['files_excluded'] == 0
+
+def test_dangling_symlink_is_reported_and_skipped(tmp_path, capsys):
+    tmp_path.joinpath('a.txt').write_text('a')
+    os.symlink(tmp_path / 'gone', tmp_path / 'b.txt')
+    dirs, files, _ = indexer.list_prefix(indexer.LocalDirSource(str(tmp_path)), '')
+    assert (dirs, [row.name for row in files]) == ([], ['a.txt'])
+    assert f"ERROR reading file {tmp_path / 'b.txt'}" in capsys.readouterr().out
+
+@pytest.mark.parametrize('jobs', ['1', '4'])
+def test_prefix_that_cannot_be_listed_fails_its_folder(source, tmp_path, tmp_path_factory, monkeypatch, capsys,
+                                                       jobs):
+    list_page = type(source).list_page
+
+    def failing(self, prefix, token=None):
+        if prefix == 'd/':
+            raise OSError('listing denied')
+        return list_page(self, prefix, token)
+    monkeypatch.setattr(type(source), 'list_page', failing)
+    location = 'mem://test' if isinstance(source, indexer.MemorySource) else f'file://{tmp_path}'
+    opts = indexer.build_parser().parse_args([location, '--password', 'secret', '--kdf-iterations', '1000',
+                                              '--output', str(tmp_path_factory.mktemp('out')), '--jobs', jobs])
+    indexer.process_dir(opts.top_dir, opts.password, opts)
+    out = capsys.readouterr().out
+    assert 'listing denied' in out
+    # d/e is never seen, the top folder and z/ still get their pages
+    assert 'Rendered 2 directories, 0 unchanged, 1 failed' in out
+
+def test_serve_needs_a_thread(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        indexer.serve_main([str(tmp_path), '--password', 'secret', '--jobs', '0'])
+    assert '--jobs needs at least 1 thread' in capsys.readouterr().err
+
+@pytest.mark.parametrize('name', ['.indexpage-SHA256SUMS.k2j4.tmp', '.indexpage-index-2.html.gz.k2j4.tmp',
+                                  '.index.html.k2j4.tmp', '.SHA256SUMS.k2j4.tmp'])
+def test_temp_files_of_any_write_are_generated(name):
+    assert indexer.is_generated_file(name)
+    assert not indexer.is_generated_file('.notes.tmp')
+
+def test_publish_uploads_only_what_changed(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(indexer.MemoryBackend, 'buckets', {})
+    tree = tmp_path / 'tree'
+    for key in ['a.txt', 'd/b.txt']:
+        path = tree.joinpath(*key.split('/'))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(key)
+    index(tree)
+    capsys.readouterr()
+
+    assert indexer.publish_main([str(tree), '--dest', 'mem://pub']) == 0
+    objects = indexer.MemoryBackend('pub').objects
+    assets = [key for key in objects if key.startswith('_vault/assets/')]
+    assert {'a.txt', 'd/b.txt', 'index.html', 'd/index.html'} <= set(objects)
+    assert f'{len(objects)} to upload, 0 to delete, 0 unchanged' in capsys.readouterr().out
+    assert assets and all(objects[key][3] == indexer.ASSET_CACHE_CONTROL for key in assets)
+    assert objects['index.html'][3] is None and objects['a.txt'][3] is None
+
+    uploaded = objects['a.txt'][4]
+    assert indexer.publish_main([str(tree), '--dest', 'mem://pub']) == 0
+    assert f'0 to upload, 0 to delete, {len(objects)} unchanged' in capsys.readouterr().out
+    assert objects['a.txt'][4] == uploaded
+
+    tree.joinpath('a.txt').unlink()
+    index(tree, '--incremental')
+    capsys.readouterr()
+    assert indexer.publish_main([str(tree), '--dest', 'mem://pub', '--delete']) == 0
+    assert '1 to upload, 1 to delete' in capsys.readouterr().out
+    assert 'a.txt' not in objects and 'd/b.txt' in objects